@@ -0,0 +1,96 @@
+"""Per-update cost of rendering the static messages and keyboards.
+
+Compares building the text and ReplyMarkup objects on every update and
+serializing them (what the send path used to do) with the pre-rendered
+templates in main.templates.
+
+Usage: python benchmarks/bench_templates.py [iterations]
+"""
+
+import os
+import sys
+import tempfile
+import timeit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_templates_")
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCH")
+os.environ.setdefault("USER_DB_FILE", os.path.join(WORKDIR, "users.db"))
+os.chdir(WORKDIR)  # importing main opens its store in the working directory
+sys.path.insert(0, REPO_ROOT)
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup  # noqa: E402
+
+import main  # noqa: E402
+
+USER = {'weather_city': 'Mumbai', 'total_requests': 42, 'language_preference': 'en'}
+
+
+def rebuild_start():
+    text = main.templates.text('start')  # the literal itself costs nothing either way
+    keyboard = [
+        [KeyboardButton("🎵 @song"), KeyboardButton("🌤️ @weather"), KeyboardButton("😄 @joke")],
+        [KeyboardButton("💭 @quote"), KeyboardButton("🎬 @movie"), KeyboardButton("🔍 @fact")],
+        [KeyboardButton("🖼️ @image"), KeyboardButton("📚 @w"), KeyboardButton("❓ @help")],
+        [KeyboardButton("⚙️ @settings"), KeyboardButton("📊 @stats")]
+    ]
+    return text, ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False).to_json()
+
+
+def template_start():
+    return main.templates.text('start'), main.bot.get_command_keyboard()
+
+
+def rebuild_settings():
+    settings_text = "⚙️ **Bot Settings:**\n\n"
+    settings_text += f"🌤️ **Weather City:** {USER['weather_city']}\n"
+    keyboard = [
+        [InlineKeyboardButton("🌍 Change Weather City", callback_data="change_weather_city")],
+        [InlineKeyboardButton("🗑️ Reset Weather City", callback_data="reset_weather_city")],
+        [InlineKeyboardButton("📊 View Statistics", callback_data="view_stats")]
+    ]
+    settings_text += f"🎯 **Total Requests:** {USER.get('total_requests', 0)}\n"
+    settings_text += f"🌐 **Language:** {USER.get('language_preference', 'English')}\n\n"
+    settings_text += "Click the buttons below to modify your settings:"
+    return settings_text, InlineKeyboardMarkup(keyboard).to_json()
+
+
+def template_settings():
+    text = main.templates.text(
+        'settings',
+        city=USER['weather_city'],
+        total_requests=USER.get('total_requests', 0),
+        language=USER.get('language_preference', 'English')
+    )
+    return text, main.templates.markup('settings_city')
+
+
+def rebuild_health():
+    health_text = "💊 **Health Tips:**\n\n"
+    health_text += "\n".join([f"• {tip}" for tip in main.bot.health_tips])
+    health_text += "\n\n🏥 **For emergencies, use `@emergency` to get contact numbers.**"
+    return health_text
+
+
+def template_health():
+    return main.templates.text('health')
+
+
+def main_bench():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    assert rebuild_settings() == template_settings()
+    assert rebuild_health() == template_health()
+
+    print(f"{'message':<10} {'rebuilt':>12} {'template':>12} {'speedup':>8}")
+    for name, rebuilt, templated in (
+        ("start", rebuild_start, template_start),
+        ("settings", rebuild_settings, template_settings),
+        ("health", rebuild_health, template_health),
+    ):
+        before = min(timeit.repeat(rebuilt, number=iterations, repeat=3)) / iterations * 1e6
+        after = min(timeit.repeat(templated, number=iterations, repeat=3)) / iterations * 1e6
+        print(f"{name:<10} {before:>10.2f}us {after:>10.2f}us {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
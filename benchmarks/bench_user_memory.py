@@ -0,0 +1,70 @@
+"""Measure resident bytes per user: legacy dict records vs UserRecord.
+
+The legacy layout is what json.load produced from user_cache.json: a
+str(user_id) key mapping to a five-key dict with its own city strings.
+
+Usage: python benchmarks/bench_user_memory.py [user count]
+"""
+
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_user_memory_")
+os.environ.setdefault("USER_DB_FILE", os.path.join(WORKDIR, "import.db"))
+os.chdir(WORKDIR)  # importing main opens its store in the working directory
+sys.path.insert(0, REPO_ROOT)
+
+from main import UserRecord  # noqa: E402
+
+CITIES = ["Mumbai", "Delhi", "Bengaluru", "Chennai", "Kolkata", "Pune", "London", "New York"]
+
+
+def legacy_json(count: int) -> str:
+    now = time.time()
+    return json.dumps({
+        str(100000000 + i): {
+            'weather_city': CITIES[i % len(CITIES)] if i % 3 else None,
+            'language_preference': 'en',
+            'timezone': None,
+            'last_active': now + i,
+            'total_requests': i % 500
+        }
+        for i in range(count)
+    })
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return after - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    payload = legacy_json(count)
+
+    legacy = measure(lambda: json.loads(payload))
+    compact = measure(lambda: {
+        int(user_id): UserRecord.from_dict(record)
+        for user_id, record in json.loads(payload).items()
+    })
+
+    print(f"users: {count}")
+    print(f"legacy dict records : {legacy / count:8.1f} bytes/user")
+    print(f"UserRecord (slots)  : {compact / count:8.1f} bytes/user")
+    print(f"reduction           : {100 * (1 - compact / legacy):8.1f} %")
+
+
+if __name__ == "__main__":
+    main()
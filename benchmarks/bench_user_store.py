@@ -0,0 +1,74 @@
+"""Compare per-write latency of the legacy JSON cache file against UserStore.
+
+The legacy path rewrites the whole user_cache.json on every change; the
+SQLite store upserts a single row.
+
+Usage: python benchmarks/bench_user_store.py [user counts...]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_user_store_")
+os.environ.setdefault("USER_DB_FILE", os.path.join(WORKDIR, "import.db"))
+os.chdir(WORKDIR)  # importing main opens its store in the working directory
+sys.path.insert(0, REPO_ROOT)
+
+from main import UserStore  # noqa: E402
+
+
+def make_users(count: int) -> dict:
+    return {
+        str(100000000 + i): {
+            'weather_city': "Mumbai" if i % 3 else None,
+            'language_preference': 'en',
+            'timezone': None,
+            'last_active': time.time(),
+            'total_requests': i % 50
+        }
+        for i in range(count)
+    }
+
+
+def bench_json(users: dict, writes: int) -> float:
+    path = os.path.join(WORKDIR, f"users_{len(users)}.json")
+    keys = list(users)
+    started = time.perf_counter()
+    for i in range(writes):
+        users[keys[i % len(keys)]]['total_requests'] += 1
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(users, f, indent=2, ensure_ascii=False)
+    return (time.perf_counter() - started) / writes
+
+
+def bench_sqlite(users: dict, writes: int) -> float:
+    store = UserStore(os.path.join(WORKDIR, f"users_{len(users)}.db"))
+    store.upsert_many(users)
+    keys = list(users)
+    started = time.perf_counter()
+    for i in range(writes):
+        user_id = keys[(i * 7919) % len(keys)]
+        users[user_id]['total_requests'] += 1
+        store.upsert(user_id, users[user_id])
+    elapsed = (time.perf_counter() - started) / writes
+    store.close()
+    return elapsed
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    print(f"{'users':>8}  {'json rewrite (ms/write)':>24}  {'sqlite upsert (ms/write)':>25}  {'speedup':>8}")
+    for count in counts:
+        users = make_users(count)
+        json_writes = max(3, 200_000 // count)
+        json_ms = bench_json(users, json_writes) * 1000
+        sqlite_ms = bench_sqlite(users, 2000) * 1000
+        print(f"{count:>8}  {json_ms:>24.3f}  {sqlite_ms:>25.3f}  {json_ms / sqlite_ms:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
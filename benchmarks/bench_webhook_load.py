@@ -0,0 +1,205 @@
+"""Replay webhook updates against the threaded and the asyncio execution modes.
+
+A local stand-in server plays both the Telegram Bot API and the upstream
+APIs (JioSaavn, OpenWeather, jokes, quotes, Wikipedia) with a fixed delay,
+so the numbers reflect how each mode overlaps I/O rather than network noise.
+Each mode runs in its own subprocess because the mode is fixed at import.
+
+Usage: python benchmarks/bench_webhook_load.py [updates] [upstream_delay_ms] [payloads.jsonl]
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = "123456:BENCH"
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.05
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.delay)
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "sendAudio", "sendPhoto"):
+            result = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+        else:
+            result = True
+        self.reply(200, {"ok": True, "result": result})
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        path = urlsplit(self.path).path
+        if path.endswith("/search"):
+            songs = [{"id": f"s{i}", "title": f"Song {i}", "album": {"name": "Bench"}} for i in range(5)]
+            self.reply(200, {"data": {"songs": {"results": songs}}})
+        elif "/songs/" in path:
+            song_id = path.rsplit("/", 1)[-1]
+            self.reply(200, {"data": [{
+                "id": song_id, "name": f"Song {song_id}", "primaryArtists": "Bench",
+                "downloadUrl": [{"quality": "320kbps", "url": f"http://example.invalid/{song_id}.mp4"}]
+            }]})
+        elif path.endswith("/weather"):
+            self.reply(200, {
+                "name": "Bench", "sys": {"country": "IN", "sunrise": 0, "sunset": 0},
+                "main": {"temp": 30, "feels_like": 31, "humidity": 50, "pressure": 1000},
+                "weather": [{"description": "clear sky", "main": "Clear"}],
+                "wind": {"speed": 1}, "visibility": 10000, "clouds": {"all": 0}, "timezone": 0
+            })
+        elif path.endswith("/joke"):
+            self.reply(200, {"setup": "Why?", "punchline": "Because."})
+        elif path.endswith("/quote"):
+            self.reply(200, {"content": "Bench quote.", "author": "Bench"})
+        elif path.endswith("/w/api.php"):
+            self.reply(200, {"query": {"pages": [{"index": 1, "title": "Bench", "pageid": 1, "extract": "Bench."}]}})
+        else:
+            self.reply(404, {})
+
+
+def make_payloads(count: int) -> list:
+    commands = ["@song tune {i}", "@weather City{i}", "@joke", "@quote", "@w topic {i}"]
+    payloads = []
+    for i in range(count):
+        chat_id = 1000 + i % 200
+        payloads.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "text": commands[i % len(commands)].format(i=i)
+            }
+        })
+    return payloads
+
+
+async def replay(payloads: list, server: str) -> dict:
+    import httpx
+    import main
+
+    main.bot.jiosaavn_api = f"{server}/api"
+    main.bot.openweather_api = f"{server}/weather"
+    main.bot.joke_apis = [f"{server}/joke"]
+    main.bot.quote_apis = [f"{server}/quote"]
+    main.bot.wikipedia_api = f"{server}/w/api.php"
+
+    await main.on_startup()
+    transport = httpx.ASGITransport(app=main.app)
+    acks = []
+    started = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for payload in payloads:
+            sent = time.perf_counter()
+            response = await client.post("/webhook", json=payload)
+            acks.append(time.perf_counter() - sent)
+            assert response.status_code == 200, response.text
+    acked = time.perf_counter() - started
+
+    def done() -> int:
+        if main.async_core is not None:
+            return main.async_core.processed + main.async_core.failed
+        return main.update_pool.processed
+
+    while done() < len(payloads) or main.send_scheduler.stats()['queued']:
+        await asyncio.sleep(0.01)
+    drained = time.perf_counter() - started
+    await main.on_shutdown()
+
+    acks.sort()
+    return {
+        "updates": len(payloads),
+        "ack_p50_ms": acks[len(acks) // 2] * 1000,
+        "ack_p99_ms": acks[int(len(acks) * 0.99) - 1] * 1000,
+        "ack_all_s": acked,
+        "drain_s": drained,
+        "throughput": len(payloads) / drained,
+        "failed": main.async_core.failed if main.async_core else main.update_pool.failed
+    }
+
+
+def run_child(mode: str, server: str, payload_file: str):
+    with open(payload_file, encoding="utf-8") as f:
+        payloads = [json.loads(line) for line in f if line.strip()]
+    result = asyncio.run(replay(payloads, server))
+    print(json.dumps(result))
+
+
+def run_mode(mode: str, server: str, payload_file: str) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"bench_webhook_{mode}_")
+    env = dict(
+        os.environ,
+        BOT_EXECUTION_MODE=mode,
+        TELEGRAM_TOKEN=TOKEN,
+        TELEGRAM_API_BASE=f"{server}/bot",
+        WEBHOOK_URL="http://bench/webhook",
+        USER_DB_FILE=os.path.join(workdir, "users.db"),
+        # The stand-in has no flood limits; keep the send scheduler out of the way
+        TELEGRAM_GLOBAL_RATE="100000",
+        TELEGRAM_CHAT_RATE="100000",
+        TELEGRAM_CHAT_BURST="1000",
+        # Measure live joke/quote fetches rather than the pre-fetched pools
+        CONTENT_POOL_SIZE="0",
+        PYTHONPATH=REPO_ROOT
+    )
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", mode, server, payload_file],
+        cwd=workdir, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    StandInHandler.delay = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    payload_file = sys.argv[3] if len(sys.argv) > 3 else None
+    if payload_file is None:
+        payload_file = os.path.join(tempfile.mkdtemp(prefix="bench_webhook_"), "payloads.jsonl")
+        with open(payload_file, "w", encoding="utf-8") as f:
+            for payload in make_payloads(count):
+                f.write(json.dumps(payload) + "\n")
+
+    server = StandInServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(f"{'mode':<10} {'updates':>8} {'ack p50':>9} {'ack p99':>9} {'drain':>8} {'upd/s':>8} {'failed':>7}")
+    for mode in ("threaded", "async"):
+        r = run_mode(mode, base, payload_file)
+        print(f"{mode:<10} {r['updates']:>8} {r['ack_p50_ms']:>7.2f}ms {r['ack_p99_ms']:>7.2f}ms "
+              f"{r['drain_s']:>7.2f}s {r['throughput']:>8.1f} {r['failed']:>7}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        run_child(*sys.argv[2:5])
+    else:
+        main()
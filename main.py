@@ -3,29 +3,47 @@
 # pip install python-telegram-bot==13.15 requests fastapi uvicorn
 
 import os
+import sys
 import json
 import time
 import random
 import logging
-from typing import List, Dict, Optional
+import threading
+import bisect
+import heapq
+import contextvars
+import multiprocessing
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import List, Dict, Optional, Callable
+import asyncio
 import requests
-from urllib.parse import quote
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, urlsplit
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
 import re
+import sqlite3
+import socket
+import secrets
+import atexit
 
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, 
-    ParseMode, ChatAction, InputMediaAudio, ReplyKeyboardMarkup,
-    KeyboardButton, ReplyKeyboardRemove
+    ParseMode, ChatAction, InputMediaAudio, InputMediaPhoto, ReplyKeyboardMarkup,
+    KeyboardButton, ReplyKeyboardRemove, ReplyMarkup
 )
 from telegram.ext import (
     Updater, MessageHandler, Filters, CallbackContext, 
-    CallbackQueryHandler, CommandHandler, ConversationHandler,
+    CallbackQueryHandler, CommandHandler,
     Dispatcher
 )
 import telegram
+from telegram.utils.request import Request as TelegramRequest
+from telegram.utils.helpers import escape_markdown
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -34,78 +52,2410 @@ logger = logging.getLogger(__name__)
 # 🚨 Bot Configuration
 TOKEN = os.getenv("TELEGRAM_TOKEN", "8289772457:AAEYnZhrwG5r_T3SI-1PkLwC2b3p1unMQUo")
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY", "231a4048dfb482ff12c57b82adce8ee0")
+# Optional movie sources, queried alongside YTS when a key is set
+TMDB_API_KEY = os.getenv("TMDB_API_KEY", "")
+OMDB_API_KEY = os.getenv("OMDB_API_KEY", "")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "https://spark-bot-no0e.onrender.com/webhook")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org/bot")
+
+# Execution mode: "threaded" runs the Dispatcher on worker threads; "async" serves
+# the hot commands from an asyncio core and hands everything else to the threads
+BOT_EXECUTION_MODE = os.getenv("BOT_EXECUTION_MODE", "threaded")
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", "1000"))
+ASYNC_HTTP_CONNECTIONS = int(os.getenv("ASYNC_HTTP_CONNECTIONS", "64"))
+# Threads for the user/session/file_id store calls the asyncio core makes (SQLite or Redis)
+ASYNC_STORE_WORKERS = int(os.getenv("ASYNC_STORE_WORKERS", "16"))
+
+# Outbound send scheduling (Telegram allows ~30 messages/s overall, ~1/s per chat, 20/min per group)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Update worker pool configuration
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "500"))
+
+# Song search configuration
+SONG_SEARCH_DEADLINE = float(os.getenv("SONG_SEARCH_DEADLINE", "8"))
+SONG_LOOKUP_WORKERS = int(os.getenv("SONG_LOOKUP_WORKERS", "16"))
+
+# Movie search: every configured source is queried at once; whatever has
+# answered by the deadline is merged
+MOVIE_SEARCH_DEADLINE = float(os.getenv("MOVIE_SEARCH_DEADLINE", "6"))
+MOVIE_SEARCH_WORKERS = int(os.getenv("MOVIE_SEARCH_WORKERS", "12"))
+MOVIE_CACHE_TTL = float(os.getenv("MOVIE_CACHE_TTL", "3600"))
+MOVIE_CACHE_SIZE = int(os.getenv("MOVIE_CACHE_SIZE", "2000"))
+
+# Song caches: query -> song ids (short lived), song id -> detail record
+SONG_QUERY_CACHE_TTL = float(os.getenv("SONG_QUERY_CACHE_TTL", "900"))
+SONG_QUERY_CACHE_SIZE = int(os.getenv("SONG_QUERY_CACHE_SIZE", "2000"))
+SONG_DETAIL_CACHE_TTL = float(os.getenv("SONG_DETAIL_CACHE_TTL", "21600"))
+SONG_DETAIL_CACHE_SIZE = int(os.getenv("SONG_DETAIL_CACHE_SIZE", "10000"))
+
+# Outbound HTTP configuration
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.25"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "2"))
+
+# (connect, read) timeouts per upstream API
+UPSTREAM_TIMEOUTS = {
+    'jiosaavn': (3.05, 10),
+    'openweather': (3.05, 10),
+    'yts': (3.05, 10),
+    'tmdb': (3.05, 10),
+    'omdb': (3.05, 10),
+    'joke': (3.05, 8),
+    'quote': (3.05, 8),
+    'wikipedia': (3.05, 10),
+    'image': (3.05, 10),
+    'telegram': (3.05, 30),
+    'default': (3.05, 10)
+}
+
+# Circuit breakers: a host's breaker opens after this many consecutive failed or
+# over-budget calls, then rejects calls until a background probe succeeds
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+BREAKER_PROBE_INTERVAL = float(os.getenv("BREAKER_PROBE_INTERVAL", "10"))
+BREAKER_EXEMPT_UPSTREAMS = {'telegram'}  # 429s there are handled by the send scheduler
+
+# Latency budget per upstream (seconds): slower calls count as failures
+UPSTREAM_LATENCY_BUDGETS = {
+    'jiosaavn': 5,
+    'openweather': 3,
+    'yts': 5,
+    'tmdb': 3,
+    'omdb': 3,
+    'joke': 2,
+    'quote': 2,
+    'wikipedia': 3,
+    'image': 8,
+    'default': 5
+}
+
+# Multi-source fetches (jokes, quotes): "hedge" starts the next-fastest source
+# when nothing has answered after HEDGE_DELAY, "race" starts every source at
+# once, "sequential" tries one source after another
+HEDGE_MODE = os.getenv("HEDGE_MODE", "hedge")
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "0.3"))
+
+# Pre-fetched joke/quote pools, topped up in the background and kept on disk
+# across restarts (CONTENT_POOL_SIZE=0 disables them)
+CONTENT_POOL_SIZE = int(os.getenv("CONTENT_POOL_SIZE", "50"))
+CONTENT_POOL_LOW_WATER = int(os.getenv("CONTENT_POOL_LOW_WATER", "15"))
+CONTENT_POOL_REFILL_INTERVAL = float(os.getenv("CONTENT_POOL_REFILL_INTERVAL", "60"))
+CONTENT_POOL_DIR = os.getenv("CONTENT_POOL_DIR", ".")
+
+# Weather response cache
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "600"))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "2000"))
+
+# Wikipedia lookups: query -> top pages with their intro extracts
+WIKIPEDIA_CACHE_TTL = float(os.getenv("WIKIPEDIA_CACHE_TTL", "3600"))
+WIKIPEDIA_CACHE_SIZE = int(os.getenv("WIKIPEDIA_CACHE_SIZE", "5000"))
+WIKIPEDIA_RESULTS = 5
+# Queries kept warm in the cache: a fixed comma-separated list plus the most
+# requested ones, refreshed every WIKIPEDIA_PREWARM_INTERVAL seconds
+WIKIPEDIA_PREWARM = [q.strip() for q in os.getenv("WIKIPEDIA_PREWARM", "").split(",") if q.strip()]
+WIKIPEDIA_PREWARM_TOP = int(os.getenv("WIKIPEDIA_PREWARM_TOP", "20"))
+WIKIPEDIA_PREWARM_INTERVAL = float(os.getenv("WIKIPEDIA_PREWARM_INTERVAL", "1800"))
 
 # Global cache storage for user preferences
 USER_CACHE = {}
-CACHE_FILE = "user_cache.json"
+CACHE_FILE = "user_cache.json"  # legacy store, migrated into USER_DB_FILE on first start
+USER_DB_FILE = os.getenv("USER_DB_FILE", "user_cache.db")
+
+# Resident-set and archival policy for user records
+USER_RESIDENT_IDLE = float(os.getenv("USER_RESIDENT_IDLE", "3600"))
+USER_ARCHIVE_DAYS = float(os.getenv("USER_ARCHIVE_DAYS", "180"))
+USER_MAINTENANCE_INTERVAL = float(os.getenv("USER_MAINTENANCE_INTERVAL", "300"))
+
+# Write-behind flushing of activity counters
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))
+ACTIVITY_FLUSH_BATCH = int(os.getenv("ACTIVITY_FLUSH_BATCH", "500"))
+
+# Shared state: empty keeps everything in the SQLite file at USER_DB_FILE (enough
+# for several workers on one host); "redis://host:6379/0" shares it across instances
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "")
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "sparkbot:")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "86400"))
+# How long button payloads too long for callback_data stay resolvable
+CALLBACK_TTL = int(os.getenv("CALLBACK_TTL", str(7 * 86400)))
+# uvicorn reads WEB_CONCURRENCY as its default --workers
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Whether other processes may change user records, in which case resident records
+# are re-read from the store on every lookup. Detected for Redis, WEB_CONCURRENCY>1
+# and workers spawned by a supervisor (uvicorn --workers N); set USER_STATE_SHARED=1
+# for other multi-process setups (e.g. forking servers) sharing USER_DB_FILE.
+USER_STATE_SHARED_MODE = os.getenv("USER_STATE_SHARED", "auto")  # "auto", "1" or "0"
+USER_STATE_SHARED = USER_STATE_SHARED_MODE == "1" or (USER_STATE_SHARED_MODE == "auto" and (
+    WEB_CONCURRENCY > 1 or STATE_BACKEND_URL.startswith("redis://") or multiprocessing.parent_process() is not None
+))
+
+# Per-update tracing: updates slower than TRACE_SLOW_THRESHOLD seconds (webhook to
+# last Telegram send) are written to TRACE_FILE, a TRACE_SAMPLE_RATE fraction of them.
+# Summarize with: python tools/trace_report.py slow_traces.jsonl
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "3"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "slow_traces.jsonl")
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(20 * 1024 * 1024)))  # then rotated to .1
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "200"))
+
+class LatencyHistogram:
+    """Thread-safe fixed-bucket latency histogram (seconds)"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        """Record a single observation"""
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        """Estimate the q-th quantile (0..1) by interpolating inside the bucket"""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+            observed_max = self.max
+        if not count:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else observed_max
+                upper = min(upper, observed_max)
+                fraction = (rank - cumulative) / bucket_count
+                return lower + (max(upper, lower) - lower) * fraction
+            cumulative += bucket_count
+        return observed_max
+
+    def snapshot(self) -> Dict:
+        """Summary suitable for JSON stats endpoints"""
+        with self._lock:
+            count, total, observed_max = self.count, self.total, self.max
+        return {
+            'count': count,
+            'avg': round(total / count, 4) if count else 0.0,
+            'p50': round(self.percentile(0.50), 4),
+            'p95': round(self.percentile(0.95), 4),
+            'p99': round(self.percentile(0.99), 4),
+            'max': round(observed_max, 4)
+        }
+
+    def cumulative(self):
+        """([(upper_bound, cumulative_count), ...], count, total) with +Inf last"""
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.total
+        running, buckets = 0, []
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            buckets.append((bound, running))
+        return buckets, count, total
+
+class MetricsText:
+    """Builder for the Prometheus text exposition format (version 0.0.4)"""
+
+    def __init__(self, prefix: str = "sparkbot_"):
+        self.prefix = prefix
+        self.lines = []
+
+    @staticmethod
+    def _labels(labels: Dict) -> str:
+        if not labels:
+            return ""
+        pairs = []
+        for key, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{key}="{value}"')
+        return "{" + ",".join(pairs) + "}"
+
+    @staticmethod
+    def _number(value) -> str:
+        if value == float('inf'):
+            return "+Inf"
+        return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+    def _header(self, name: str, kind: str, help_text: str) -> str:
+        name = self.prefix + name
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        return name
+
+    def counter(self, name: str, help_text: str, samples: List[tuple]):
+        """samples: [(labels, value), ...]"""
+        name = self._header(name, "counter", help_text)
+        for labels, value in samples:
+            self.lines.append(f"{name}{self._labels(labels)} {self._number(value)}")
+
+    def gauge(self, name: str, help_text: str, samples: List[tuple]):
+        name = self._header(name, "gauge", help_text)
+        for labels, value in samples:
+            self.lines.append(f"{name}{self._labels(labels)} {self._number(value)}")
+
+    def histogram(self, name: str, help_text: str, samples: List[tuple]):
+        """samples: [(labels, LatencyHistogram), ...]"""
+        name = self._header(name, "histogram", help_text)
+        for labels, histogram in samples:
+            buckets, count, total = histogram.cumulative()
+            for bound, cumulative in buckets:
+                bucket_labels = dict(labels, le=self._number(bound))
+                self.lines.append(f"{name}_bucket{self._labels(bucket_labels)} {cumulative}")
+            self.lines.append(f"{name}_sum{self._labels(labels)} {self._number(float(total))}")
+            self.lines.append(f"{name}_count{self._labels(labels)} {count}")
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+class Trace:
+    """Timed spans of one update, from the webhook to its last Telegram send.
+
+    Spans are flat: a name, the offset from the start of the trace, the
+    duration and a few attributes. The update holds the trace open and so
+    does every queued send; the trace finishes when the last one releases it.
+    """
+
+    def __init__(self, tracer: 'Tracer', kind: str, **attrs):
+        self.tracer = tracer
+        self.trace_id = secrets.token_hex(8)
+        self.kind = kind
+        self.attrs = attrs
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.spans = []
+        self.dropped = 0
+        self.duration = None
+        self._open = 1
+        self._lock = threading.Lock()
+
+    def add(self, name: str, started: float, duration: float, **attrs):
+        with self._lock:
+            if self.duration is not None:
+                return  # finished; e.g. a hedged request that lost the race
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return
+            span = {'name': name, 'start': round(started - self.started, 4), 'duration': round(duration, 4)}
+            span.update(attrs)
+            self.spans.append(span)
+
+    def hold(self):
+        with self._lock:
+            self._open += 1
+
+    def release(self):
+        with self._lock:
+            self._open -= 1
+            if self._open or self.duration is not None:
+                return
+            self.duration = time.monotonic() - self.started
+        self.tracer.finish(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            'trace_id': self.trace_id,
+            'kind': self.kind,
+            'started_at': round(self.started_at, 3),
+            'duration': round(self.duration or 0.0, 4),
+            'attrs': self.attrs,
+            'spans': sorted(self.spans, key=lambda span: span['start']),
+            'dropped_spans': self.dropped
+        }
+
+class Tracer:
+    """Starts traces and appends the slow ones to a JSONL file"""
+
+    def __init__(self, path: str = TRACE_FILE, threshold: float = TRACE_SLOW_THRESHOLD,
+                 sample_rate: float = TRACE_SAMPLE_RATE, max_bytes: int = TRACE_FILE_MAX_BYTES,
+                 enabled: bool = TRACE_ENABLED):
+        self.path = path
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # Counters change on every handler thread and on the event loop; _lock is held over file writes
+        self.counts_lock = threading.Lock()
+
+        # Metrics
+        self.duration = LatencyHistogram()
+        self.started = 0
+        self.finished = 0
+        self.slow = 0
+        self.written = 0
+        self.write_errors = 0
+
+    def start(self, kind: str, **attrs) -> Optional[Trace]:
+        if not self.enabled:
+            return None
+        with self.counts_lock:
+            self.started += 1
+        return Trace(self, kind, **attrs)
+
+    def finish(self, trace: Trace):
+        slow = trace.duration >= self.threshold
+        with self.counts_lock:
+            self.finished += 1
+            self.slow += slow
+        self.duration.observe(trace.duration)
+        if not slow:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        line = json.dumps(trace.to_dict(), default=str)
+        with self._lock:
+            try:
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+                self.written += 1
+            except OSError as e:
+                self.write_errors += 1
+                logger.warning(f"Could not write slow trace {trace.trace_id}: {e}")
+        logger.info(f"Slow update {trace.trace_id} ({trace.attrs.get('command', trace.kind)}): {trace.duration:.2f}s")
+
+    def stats(self) -> Dict:
+        with self.counts_lock:
+            started, finished, slow = self.started, self.finished, self.slow
+        return {
+            'enabled': self.enabled,
+            'threshold': self.threshold,
+            'sample_rate': self.sample_rate,
+            'file': self.path,
+            'started': started,
+            'finished': finished,
+            'in_progress': started - finished,
+            'slow': slow,
+            'written': self.written,
+            'write_errors': self.write_errors,
+            'duration': self.duration.snapshot()
+        }
+
+tracer = Tracer()
+# Trace of the update being handled; asyncio tasks inherit it, thread pools get it
+# through contextvars.copy_context().run
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """Time the block as a span of the current trace; the yielded dict takes extra attributes"""
+    trace = current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+    started = time.monotonic()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        trace.add(name, started, time.monotonic() - started, **attrs)
+
+def annotate_trace(**attrs):
+    """Attach attributes (e.g. the command) to the current trace"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+class UserRecord:
+    """Compact per-user record.
+
+    Uses __slots__ instead of a per-user dict and interns city names, but
+    keeps the dict-style access (record['key'], record.get()) callers use.
+    """
+
+    __slots__ = ('weather_city', 'language_preference', 'timezone', 'last_active', 'total_requests')
+
+    def __init__(self, weather_city: str = None, language_preference: str = 'en', timezone: str = None,
+                 last_active: float = None, total_requests: int = 0):
+        self.weather_city = sys.intern(weather_city) if weather_city else None
+        self.language_preference = sys.intern(language_preference) if language_preference else language_preference
+        self.timezone = sys.intern(timezone) if timezone else None
+        self.last_active = time.time() if last_active is None else last_active
+        self.total_requests = total_requests or 0
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'UserRecord':
+        return cls(**{field: data.get(field) for field in cls.__slots__ if field in data})
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __getitem__(self, key: str):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        if isinstance(value, str) and key != 'last_active':
+            value = sys.intern(value)
+        setattr(self, key, value)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__slots__
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()})"
+
+class UserStore:
+    """SQLite (WAL mode) store of user preferences with per-user upserts"""
+
+    FIELDS = ('weather_city', 'language_preference', 'timezone', 'last_active', 'total_requests')
+    PREFERENCES = ('weather_city', 'language_preference', 'timezone')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                weather_city TEXT,
+                language_preference TEXT,
+                timezone TEXT,
+                last_active REAL,
+                total_requests INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users_archive AS SELECT * FROM users WHERE 0"
+        )
+        self._conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_archive_user_id ON users_archive (user_id)"
+        )
+        self._upsert_sql = (
+            f"INSERT INTO users (user_id, {', '.join(self.FIELDS)}) VALUES (?, ?, ?, ?, ?, ?) "
+            f"ON CONFLICT(user_id) DO UPDATE SET "
+            + ", ".join(f"{field}=excluded.{field}" for field in self.FIELDS)
+        )
+        self._preferences_sql = (
+            f"INSERT INTO users (user_id, {', '.join(self.FIELDS)}) VALUES (?, ?, ?, ?, ?, 0) "
+            f"ON CONFLICT(user_id) DO UPDATE SET "
+            + ", ".join(f"{field}=excluded.{field}" for field in self.PREFERENCES)
+        )
+        self._activity_sql = (
+            "INSERT INTO users (user_id, last_active, total_requests) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET "
+            "last_active=MAX(COALESCE(last_active, 0), excluded.last_active), "
+            "total_requests=total_requests + excluded.total_requests"
+        )
+
+    def _row(self, user_id, record: Dict) -> tuple:
+        return (int(user_id),) + tuple(record.get(field) for field in self.FIELDS)
+
+    def get(self, user_id) -> Optional[UserRecord]:
+        """Load one user record, or None if the user is unknown.
+
+        Archived users are restored to the live table on their next visit.
+        """
+        user_id = int(user_id)
+        columns = ', '.join(self.FIELDS)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {columns} FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                row = self._conn.execute(
+                    f"SELECT {columns} FROM users_archive WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute("BEGIN")
+                    try:
+                        self._conn.execute(self._upsert_sql, (user_id,) + tuple(row))
+                        self._conn.execute("DELETE FROM users_archive WHERE user_id = ?", (user_id,))
+                        self._conn.execute("COMMIT")
+                    except Exception:
+                        self._conn.execute("ROLLBACK")
+                        raise
+        return UserRecord(*row) if row else None
+
+    def upsert(self, user_id, record: Dict):
+        """Insert or update a single user atomically"""
+        with self._lock:
+            self._conn.execute(self._upsert_sql, self._row(user_id, record))
+
+    def upsert_many(self, records: Dict):
+        """Insert or update many users in one transaction"""
+        if not records:
+            return
+        rows = [self._row(user_id, record) for user_id, record in records.items()]
+        self._executemany(self._upsert_sql, rows)
+
+    def save_preferences(self, user_id, record: Dict):
+        """Write only the preference columns, leaving activity counters alone"""
+        with self._lock:
+            self._conn.execute(
+                self._preferences_sql,
+                (int(user_id),) + tuple(record.get(field) for field in self.PREFERENCES) + (record.get('last_active'),)
+            )
+
+    def record_activity(self, activity: Dict):
+        """Apply {user_id: (last_active, new_requests)} as increments.
+
+        Several processes may count the same user, so counters are added to
+        rather than overwritten.
+        """
+        if not activity:
+            return
+        rows = [(int(user_id), last_active, delta) for user_id, (last_active, delta) in activity.items()]
+        self._executemany(self._activity_sql, rows)
+
+    def _executemany(self, sql: str, rows: List[tuple]):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def count(self, table: str = 'users') -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def archive_idle(self, cutoff: float) -> int:
+        """Move users inactive since `cutoff` to the archive table"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO users_archive SELECT * FROM users WHERE last_active < ?", (cutoff,)
+                )
+                archived = self._conn.execute("DELETE FROM users WHERE last_active < ?", (cutoff,)).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return archived
+
+    def import_json(self, path: str) -> int:
+        """One-time migration of the legacy user_cache.json file"""
+        with open(path, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+        self.upsert_many(records)
+        return len(records)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class RespError(Exception):
+    """Error reply from a Redis server"""
+
+class RespClient:
+    """Minimal Redis client speaking RESP2 over one socket per thread"""
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.db = int(parts.path.strip('/') or 0)
+        self.password = parts.password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+            setup = ([('AUTH', self.password)] if self.password else []) + ([('SELECT', self.db)] if self.db else [])
+            if setup:
+                self._roundtrip(conn, setup)
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(out)
+
+    def _read(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode('utf-8')
+        if kind == b'-':
+            return RespError(body.decode('utf-8'))
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            return reader.read(length + 2)[:-2].decode('utf-8')
+        if kind == b'*':
+            length = int(body)
+            return None if length < 0 else [self._read(reader) for _ in range(length)]
+        raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+    def _roundtrip(self, conn, commands) -> list:
+        conn[0].sendall(b''.join(self._encode(command) for command in commands))
+        replies = [self._read(conn[1]) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands: List[tuple]) -> list:
+        """Send several commands in one round trip and return their replies"""
+        for attempt in range(2):
+            try:
+                return self._roundtrip(self._connection(), commands)
+            except (OSError, ConnectionError):
+                # Stale pooled socket: reconnect once
+                self._close()
+                if attempt:
+                    raise
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def close(self):
+        self._close()
+
+class RedisUserStore:
+    """UserStore counterpart that keeps users as Redis hashes.
+
+    Live and archived users are indexed by last_active in two sorted sets,
+    which back count() and archive_idle(). Activity and archiving run as Lua
+    scripts so workers flushing out of order never move last_active back,
+    and a user who became active after the idle scan is not archived.
+    """
+
+    FIELDS = UserStore.FIELDS
+    PREFERENCES = UserStore.PREFERENCES
+
+    # KEYS: user hash, live index; ARGV: last_active, new requests, user id
+    RECORD_ACTIVITY = """-- sparkbot:record_activity
+redis.call('HINCRBY', KEYS[1], 'total_requests', ARGV[2])
+local current = tonumber(redis.call('HGET', KEYS[1], 'last_active') or '0')
+if tonumber(ARGV[1]) > current then
+  redis.call('HSET', KEYS[1], 'last_active', ARGV[1])
+  redis.call('ZADD', KEYS[2], ARGV[1], ARGV[3])
+end
+return 1"""
+
+    # KEYS: user hash, archive hash, live index, archive index; ARGV: user id, cutoff
+    ARCHIVE_USER = """-- sparkbot:archive_user
+local score = redis.call('ZSCORE', KEYS[3], ARGV[1])
+if not score or tonumber(score) >= tonumber(ARGV[2]) then
+  return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('RENAME', KEYS[1], KEYS[2])
+end
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[2], ARGV[1])
+return 1"""
+
+    def __init__(self, client: RespClient, prefix: str = STATE_KEY_PREFIX):
+        self.client = client
+        self.prefix = prefix
+        self._index = {'users': f"{prefix}users", 'users_archive': f"{prefix}users_archive"}
+
+    def _key(self, user_id, table: str = 'users') -> str:
+        return f"{self.prefix}{'user' if table == 'users' else 'user_archive'}:{int(user_id)}"
+
+    @staticmethod
+    def _record(values: list) -> Optional[UserRecord]:
+        if not any(value is not None for value in values):
+            return None
+        weather_city, language, timezone, last_active, total_requests = values
+        return UserRecord(weather_city, language or 'en', timezone,
+                          float(last_active or 0), int(total_requests or 0))
+
+    def get(self, user_id) -> Optional[UserRecord]:
+        """Load one user record, restoring it from the archive if needed"""
+        record = self._record(self.client.execute('HMGET', self._key(user_id), *self.FIELDS))
+        if record is None:
+            archived = self._key(user_id, 'users_archive')
+            record = self._record(self.client.execute('HMGET', archived, *self.FIELDS))
+            if record is not None:
+                self.client.pipeline([
+                    ('RENAME', archived, self._key(user_id)),
+                    ('ZREM', self._index['users_archive'], int(user_id)),
+                    ('ZADD', self._index['users'], record.last_active, int(user_id))
+                ])
+        return record
+
+    def _write(self, user_id, record: Dict, fields: tuple) -> List[tuple]:
+        key = self._key(user_id)
+        present = [(field, record.get(field)) for field in fields if record.get(field) is not None]
+        missing = [field for field in fields if record.get(field) is None]
+        commands = []
+        if present:
+            commands.append(('HSET', key) + tuple(item for pair in present for item in pair))
+        if missing:
+            commands.append(('HDEL', key) + tuple(missing))
+        commands.append(('ZADD', self._index['users'], record.get('last_active') or time.time(), int(user_id)))
+        return commands
+
+    def upsert(self, user_id, record: Dict):
+        self.client.pipeline(self._write(user_id, record, self.FIELDS))
+
+    def upsert_many(self, records: Dict):
+        commands = []
+        for user_id, record in records.items():
+            commands.extend(self._write(user_id, record, self.FIELDS))
+        if commands:
+            self.client.pipeline(commands)
+
+    def save_preferences(self, user_id, record: Dict):
+        """Write only the preference fields, leaving activity counters alone"""
+        self.client.pipeline(self._write(user_id, record, self.PREFERENCES))
+
+    def record_activity(self, activity: Dict):
+        """Apply {user_id: (last_active, new_requests)} as increments; last_active only moves forward"""
+        commands = [
+            ('EVAL', self.RECORD_ACTIVITY, 2, self._key(user_id), self._index['users'], last_active, delta, int(user_id))
+            for user_id, (last_active, delta) in activity.items()
+        ]
+        if commands:
+            self.client.pipeline(commands)
+
+    def count(self, table: str = 'users') -> int:
+        return self.client.execute('ZCARD', self._index[table])
+
+    def archive_idle(self, cutoff: float) -> int:
+        """Move users inactive since `cutoff` to the archive keys"""
+        idle = self.client.execute('ZRANGEBYSCORE', self._index['users'], '-inf', f"({cutoff}")
+        commands = [
+            ('EVAL', self.ARCHIVE_USER, 4, self._key(user_id), self._key(user_id, 'users_archive'),
+             self._index['users'], self._index['users_archive'], user_id, cutoff)
+            for user_id in idle
+        ]
+        # Each move re-checks the user's score, so users active since the scan stay live
+        return sum(self.client.pipeline(commands)) if commands else 0
+
+    def import_json(self, path: str) -> int:
+        """One-time migration of the legacy user_cache.json file"""
+        with open(path, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+        self.upsert_many(records)
+        return len(records)
+
+    def close(self):
+        self.client.close()
+
+class SQLiteStateStore:
+    """Key/value state with expiry, kept next to the user table"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires REAL
+            )"""
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM state WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def set(self, key: str, value: str, ttl: float = None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)",
+                               (key, value, expires))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM state WHERE expires < ?", (time.time(),)).rowcount
+
+class RedisStateStore:
+    """Key/value state with expiry on a Redis server"""
+
+    def __init__(self, client: RespClient, prefix: str = STATE_KEY_PREFIX):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[str]:
+        return self.client.execute('GET', self.prefix + key)
+
+    def set(self, key: str, value: str, ttl: float = None):
+        if ttl:
+            self.client.execute('SET', self.prefix + key, value, 'EX', max(1, int(ttl)))
+        else:
+            self.client.execute('SET', self.prefix + key, value)
+
+    def delete(self, key: str):
+        self.client.execute('DEL', self.prefix + key)
+
+    def purge_expired(self) -> int:
+        return 0  # Redis expires keys itself
+
+def open_state_backend(url: str, path: str):
+    """Return the (user store, key/value state store) pair selected by `url`"""
+    if url.startswith("redis://"):
+        client = RespClient(url)
+        client.execute('PING')
+        return RedisUserStore(client), RedisStateStore(client)
+    if url:
+        raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
+    return UserStore(path), SQLiteStateStore(path)
+
+class SessionStore:
+    """Per-user conversation data (pending replies).
+
+    Kept in the state backend rather than in context.user_data, so a
+    callback or reply can be handled by any worker process.
+    """
+
+    def __init__(self, backend=None, ttl: float = SESSION_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, user_id, field: str, default=None):
+        raw = self.backend.get(f"session:{int(user_id)}:{field}")
+        return default if raw is None else json.loads(raw)
+
+    def set(self, user_id, field: str, value):
+        self.backend.set(f"session:{int(user_id)}:{field}", json.dumps(value, ensure_ascii=False), self.ttl)
+
+    def pop(self, user_id, field: str, default=None):
+        value = self.get(user_id, field, default)
+        self.backend.delete(f"session:{int(user_id)}:{field}")
+        return value
+
+class CallbackCodec:
+    """Versioned, self-contained callback_data for inline buttons.
+
+    A payload is "<action><version>:<field>:<field>..." and carries all a
+    callback needs, so any worker can answer it without per-user state.
+    Payloads over Telegram's 64-byte limit, or with fields containing a
+    separator, are stored in the state backend with a TTL and the button
+    carries "<action><version>~<short id>" instead.
+    """
+
+    VERSION = '1'
+    LIMIT = 64
+
+    def __init__(self, backend=None, ttl: float = CALLBACK_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+        # Metrics
+        self.spilled = 0
+        self.expired = 0
+
+    def encode(self, action: str, *fields) -> str:
+        fields = [str(field) for field in fields]
+        prefix = action + self.VERSION
+        data = ":".join([prefix] + fields)
+        if len(data.encode('utf-8')) <= self.LIMIT and not any(':' in f or '~' in f for f in fields):
+            return data
+        short_id = secrets.token_urlsafe(6)
+        self.backend.set(f"callback:{short_id}", json.dumps(fields, ensure_ascii=False), self.ttl)
+        self.spilled += 1
+        return f"{prefix}~{short_id}"
+
+    def decode(self, data: str):
+        """(action, fields) for a payload, or None if it is unknown or has expired"""
+        if data.startswith("download_file:"):
+            # Buttons sent before the compact encoding; still self-contained
+            return 'f', data.split(":")[1:]
+        if len(data) < 3 or data[1] != self.VERSION or data[2] not in ':~':
+            self.expired += 1
+            return None
+        action, rest = data[0], data[3:]
+        if data[2] == ':':
+            return action, rest.split(":")
+        raw = self.backend.get(f"callback:{rest}")
+        if raw is None:
+            self.expired += 1
+            return None
+        return action, json.loads(raw)
+
+    def stats(self) -> Dict:
+        return {'spilled': self.spilled, 'expired': self.expired}
+
+class FileIdIndex:
+    """Persistent map of content keys to Telegram file_ids.
+
+    Once Telegram has ingested a file, sending its file_id again is instant
+    and costs no bandwidth. Entries live in the same SQLite database as the
+    user store and are mirrored in memory.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS telegram_file_ids (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                file_size INTEGER,
+                created REAL,
+                PRIMARY KEY (kind, key)
+            )"""
+        )
+        self._memory = {}
+        self.hits = {}
+        self.misses = {}
+        self.saved_bytes = {}
+
+    def get(self, kind: str, key: str) -> Optional[str]:
+        """Return the stored file_id, counting the hit and the bytes it saves"""
+        with self._lock:
+            entry = self._memory.get((kind, key))
+            if entry is None:
+                entry = self._conn.execute(
+                    "SELECT file_id, file_size FROM telegram_file_ids WHERE kind = ? AND key = ?", (kind, key)
+                ).fetchone()
+                if entry is not None:
+                    self._memory[(kind, key)] = entry
+            if entry is None:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            self.saved_bytes[kind] = self.saved_bytes.get(kind, 0) + (entry[1] or 0)
+            return entry[0]
+
+    def put(self, kind: str, key: str, file_id: str, file_size: int = None):
+        with self._lock:
+            self._memory[(kind, key)] = (file_id, file_size)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO telegram_file_ids (kind, key, file_id, file_size, created) VALUES (?, ?, ?, ?, ?)",
+                (kind, key, file_id, file_size, time.time())
+            )
+
+    def delete(self, kind: str, key: str):
+        """Forget a file_id Telegram no longer accepts"""
+        with self._lock:
+            self._memory.pop((kind, key), None)
+            self._conn.execute("DELETE FROM telegram_file_ids WHERE kind = ? AND key = ?", (kind, key))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stored = dict(self._conn.execute("SELECT kind, COUNT(*) FROM telegram_file_ids GROUP BY kind").fetchall())
+        result = {}
+        for kind in set(stored) | set(self.hits) | set(self.misses):
+            hits, misses = self.hits.get(kind, 0), self.misses.get(kind, 0)
+            result[kind] = {
+                'stored': stored.get(kind, 0),
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else 0.0,
+                'saved_bytes': self.saved_bytes.get(kind, 0)
+            }
+        return result
+
+class PeriodicTask:
+    """Run a function every `interval` seconds on a daemon thread"""
+
+    def __init__(self, name: str, fn: Callable, interval: float):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.fn()
+            except Exception as e:
+                logger.error(f"{self.name} failed: {e}")
+
+class WriteBehindBuffer:
+    """Collect dirty user ids in memory and flush them in batches.
+
+    A flush happens every `interval` seconds, as soon as `max_batch` users
+    are dirty, and once more on shutdown.
+    """
+
+    def __init__(self, flush_fn: Callable, interval: float = ACTIVITY_FLUSH_INTERVAL,
+                 max_batch: int = ACTIVITY_FLUSH_BATCH):
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_batch = max(1, max_batch)
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self.flush_latency = LatencyHistogram()
+        self.batch_sizes = LatencyHistogram(buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+        self.flushes = 0
+        self.flushed_records = 0
+        self.flush_errors = 0
+
+    def mark(self, user_id):
+        """Remember that a user's record needs persisting"""
+        with self._lock:
+            self._dirty.add(user_id)
+            pending = len(self._dirty)
+        if pending >= self.max_batch:
+            self._wakeup.set()
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="activity-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and write out everything still pending"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Write all dirty records now; returns the batch size"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._dirty = self._dirty, set()
+            if not batch:
+                return 0
+            started = time.monotonic()
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Activity flush failed for {len(batch)} users: {e}")
+                with self._lock:
+                    self._dirty |= batch
+                return 0
+            self.flush_latency.observe(time.monotonic() - started)
+            self.batch_sizes.observe(len(batch))
+            self.flushes += 1
+            self.flushed_records += len(batch)
+            return len(batch)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = len(self._dirty)
+        return {
+            'pending': pending,
+            'flushes': self.flushes,
+            'flushed_records': self.flushed_records,
+            'flush_errors': self.flush_errors,
+            'flush_latency': self.flush_latency.snapshot(),
+            'batch_size': self.batch_sizes.snapshot()
+        }
+
+class CacheManager:
+    """Manage user preferences and caching.
+
+    USER_CACHE maps integer user ids to the UserRecords seen by this
+    process; the UserStore is the durable copy and is read through on a
+    cache miss. Records are only created once a user has real state, idle
+    records are evicted from memory and long-idle users are archived.
+    """
+
+    store: Optional[UserStore] = None
+    _lock = threading.Lock()
+    _pending_requests = {}  # user id -> requests not yet written to the store
+    evicted = 0
+    archived = 0
+    
+    @staticmethod
+    def load_cache():
+        """Open the user store, migrating the legacy JSON cache if present"""
+        global USER_CACHE
+        try:
+            CacheManager.store, sessions.backend = open_state_backend(STATE_BACKEND_URL, USER_DB_FILE)
+            if os.path.exists(CACHE_FILE):
+                migrated = CacheManager.store.import_json(CACHE_FILE)
+                os.replace(CACHE_FILE, CACHE_FILE + ".migrated")
+                logger.info(f"Migrated {migrated} users from {CACHE_FILE}")
+            USER_CACHE = {}
+            logger.info(f"User store opened: {CacheManager.store.count()} users")
+        except Exception as e:
+            logger.error(f"Error loading cache: {e}")
+            USER_CACHE = {}
+            if sessions.backend is None:
+                sessions.backend = SQLiteStateStore(":memory:")
+        callbacks.backend = sessions.backend
+    
+    @staticmethod
+    def save_user(user_id: int):
+        """Persist a single user's preferences (activity is written behind)"""
+        user_id = int(user_id)
+        record = USER_CACHE.get(user_id)
+        if record is None or not CacheManager.store:
+            return
+        try:
+            CacheManager.store.save_preferences(user_id, record)
+        except Exception as e:
+            logger.error(f"Error saving user {user_id}: {e}")
+
+    @staticmethod
+    def flush_users(user_ids):
+        """Write the given users' new activity to the store in one batch"""
+        if not CacheManager.store:
+            return
+        with CacheManager._lock:
+            deltas = {user_id: CacheManager._pending_requests.pop(user_id, 0) for user_id in user_ids}
+        activity = {user_id: (USER_CACHE[user_id].last_active if user_id in USER_CACHE else time.time(), delta)
+                    for user_id, delta in deltas.items()}
+        try:
+            CacheManager.store.record_activity(activity)
+        except Exception:
+            with CacheManager._lock:
+                for user_id, delta in deltas.items():
+                    CacheManager._pending_requests[user_id] = CacheManager._pending_requests.get(user_id, 0) + delta
+            raise
+
+    @staticmethod
+    def _refresh(user_id: int, record: UserRecord):
+        """Pick up changes other worker processes made to a resident record"""
+        try:
+            stored = CacheManager.store.get(user_id) if CacheManager.store else None
+        except Exception as e:
+            logger.error(f"Error reading user {user_id}: {e}")
+            return
+        if stored is None:
+            return
+        for field in UserStore.PREFERENCES:
+            record[field] = stored[field]
+        record['total_requests'] = stored.total_requests + CacheManager._pending_requests.get(user_id, 0)
+        record['last_active'] = max(record.last_active, stored.last_active)
+    
+    @staticmethod
+    def _load_user(user_id: int, create: bool) -> Optional[UserRecord]:
+        user_data = USER_CACHE.get(user_id)
+        if user_data is not None:
+            return user_data
+        with CacheManager._lock:
+            if user_id not in USER_CACHE:
+                stored = None
+                if CacheManager.store:
+                    try:
+                        stored = CacheManager.store.get(user_id)
+                    except Exception as e:
+                        logger.error(f"Error reading user {user_id}: {e}")
+                if stored is None and not create:
+                    return None
+                USER_CACHE[user_id] = stored or UserRecord()
+            return USER_CACHE[user_id]
+
+    @staticmethod
+    def get_user_data(user_id: int) -> UserRecord:
+        """Get user data from cache.
+
+        Unknown users get a detached default record that is not stored, so
+        read-only lookups never grow USER_CACHE.
+        """
+        user_data = CacheManager._load_user(int(user_id), create=False)
+        if user_data is None:
+            return UserRecord()
+        if USER_STATE_SHARED:
+            CacheManager._refresh(int(user_id), user_data)
+        return user_data
+
+    @staticmethod
+    def materialize_user(user_id: int) -> UserRecord:
+        """Get the user's record, creating it if the user is new"""
+        return CacheManager._load_user(int(user_id), create=True)
+    
+    @staticmethod
+    def set_user_weather_city(user_id: int, city: str):
+        """Set user's preferred weather city"""
+        user_data = CacheManager.materialize_user(user_id)
+        user_data['weather_city'] = city
+        CacheManager.update_user_activity(user_id)
+        CacheManager.save_user(user_id)
+    
+    @staticmethod
+    def get_user_weather_city(user_id: int) -> Optional[str]:
+        """Get user's preferred weather city"""
+        user_data = CacheManager.get_user_data(user_id)
+        return user_data.get('weather_city')
+    
+    @staticmethod
+    def update_user_activity(user_id: int):
+        """Update user's last activity (persisted later by the write-behind buffer)"""
+        user_id = int(user_id)
+        user_data = CacheManager.materialize_user(user_id)
+        user_data['last_active'] = time.time()
+        user_data['total_requests'] += 1
+        with CacheManager._lock:
+            CacheManager._pending_requests[user_id] = CacheManager._pending_requests.get(user_id, 0) + 1
+        activity_buffer.mark(user_id)
+
+    @staticmethod
+    def evict_idle_users(now: float = None) -> int:
+        """Drop records idle for USER_RESIDENT_IDLE seconds from memory (they stay in the store)"""
+        now = time.time() if now is None else now
+        cutoff = now - USER_RESIDENT_IDLE
+        # Persist pending activity first; preferences are already written through
+        activity_buffer.flush()
+        evicted = 0
+        with CacheManager._lock:
+            for user_id in [uid for uid, record in list(USER_CACHE.items()) if record.last_active < cutoff]:
+                record = USER_CACHE.get(user_id)
+                if record is not None and record.last_active < cutoff and user_id not in CacheManager._pending_requests:
+                    del USER_CACHE[user_id]
+                    evicted += 1
+        CacheManager.evicted += evicted
+        return evicted
+
+    @staticmethod
+    def run_maintenance():
+        """Evict idle resident users and archive long-idle stored users"""
+        evicted = CacheManager.evict_idle_users()
+        archived = 0
+        if CacheManager.store:
+            archived = CacheManager.store.archive_idle(time.time() - USER_ARCHIVE_DAYS * 86400)
+            CacheManager.archived += archived
+        if sessions.backend is not None:
+            sessions.backend.purge_expired()
+        if evicted or archived:
+            logger.info(f"User maintenance: evicted {evicted}, archived {archived}")
+
+    @staticmethod
+    def stats() -> Dict:
+        store = CacheManager.store
+        return {
+            'backend': 'redis' if isinstance(store, RedisUserStore) else 'sqlite',
+            'shared': USER_STATE_SHARED,
+            'resident_users': len(USER_CACHE),
+            'stored_users': store.count() if store else 0,
+            'archived_users': store.count('users_archive') if store else 0,
+            'evicted_total': CacheManager.evicted,
+            'archived_total': CacheManager.archived
+        }
+
+sessions = SessionStore()
+callbacks = CallbackCodec()
+
+# Activity counters change on every message, so they are written behind in batches
+activity_buffer = WriteBehindBuffer(CacheManager.flush_users)
+atexit.register(activity_buffer.stop)
+user_maintenance = PeriodicTask("user-maintenance", CacheManager.run_maintenance, USER_MAINTENANCE_INTERVAL)
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one execution.
+
+    The first caller runs the function; callers arriving while it runs wait
+    and share its result or exception. do() serves threads; do_async()
+    serves coroutines on one event loop.
+    """
+
+    class _Call:
+        __slots__ = ('event', 'value', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}   # key -> _Call
+        self._tasks = {}   # key -> asyncio.Task
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.deduplicated = 0
+
+    def do(self, key, fn: Callable, *args, **kwargs):
+        """Return fn(*args, **kwargs), sharing a run already in flight for `key`"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+                self.executions += 1
+            else:
+                self.deduplicated += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn(*args, **kwargs)
+            return call.value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    async def do_async(self, key, factory: Callable):
+        """Await factory() once per key in flight.
+
+        The shared call runs as its own task, so a caller that is cancelled
+        (e.g. at a search deadline) does not cancel it for the others.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            self.executions += 1
+
+            def done(finished):
+                self._tasks.pop(key, None)
+                if not finished.cancelled():
+                    finished.exception()  # retrieved, even if every caller gave up
+
+            task.add_done_callback(done)
+        else:
+            self.deduplicated += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict:
+        return {
+            'executions': self.executions,
+            'deduplicated': self.deduplicated,
+            'in_flight': len(self._calls) + len(self._tasks)
+        }
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after a TTL.
+
+    get_or_load collapses concurrent misses for the same key into a single
+    loader call through a SingleFlight; the other callers share its result.
+    """
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = max(1, maxsize)
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        """Return (found, value); caller must hold the lock"""
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _count_lookup(self, key):
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found, value
+
+    def _recheck(self, key):
+        """Lookup without counting, for a load that may have just been filled"""
+        with self._lock:
+            return self._lookup(key)
+
+    def get_or_load(self, key, loader: Callable, cache_if: Callable = None, ttl: float = None):
+        """Return the cached value or load it once, however many callers miss together"""
+        found, value = self._count_lookup(key)
+        if found:
+            return value
+
+        def load():
+            found, value = self._recheck(key)
+            if found:
+                return value
+            value = loader()
+            if cache_if is None or cache_if(value):
+                self.set(key, value, ttl)
+            return value
+
+        return self.flight.do(key, load)
+
+    async def get_or_load_async(self, key, loader: Callable, cache_if: Callable = None, ttl: float = None):
+        """Coroutine version of get_or_load; `loader()` returns an awaitable"""
+        found, value = self._count_lookup(key)
+        if found:
+            return value
+        return await self.load_async(key, loader, cache_if, ttl)
+
+    async def load_async(self, key, loader: Callable, cache_if: Callable = None, ttl: float = None):
+        """The loading half of get_or_load_async, for callers that already counted their miss"""
+        async def load():
+            found, value = self._recheck(key)
+            if found:
+                return value
+            value = await loader()
+            if cache_if is None or cache_if(value):
+                self.set(key, value, ttl)
+            return value
+
+        return await self.flight.do_async(key, load)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> Dict:
+        """Size and hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'collapsed_misses': self.flight.deduplicated,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+class CircuitBreaker:
+    """Per-host breaker: closed -> open -> half-open -> closed.
+
+    Consecutive failures (errors, 5xx/429 replies and calls over the
+    latency budget) open it. While open, calls are rejected at once. After
+    `reset_timeout` a background probe, or one trial call if nothing is
+    probing or the host has no probe URL, decides whether it closes
+    again.
+    """
+
+    def __init__(self, host: str, upstream: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT, latency_budget: float = None):
+        self.host = host
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget or UPSTREAM_LATENCY_BUDGETS.get(upstream, UPSTREAM_LATENCY_BUDGETS['default'])
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_url = None
+        self.last_error = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.opened_total = 0
+        self.short_circuited = 0
+        self.slow_calls = 0
+
+    def allow(self, probing: bool = False) -> bool:
+        """Whether a call may go out now"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            # Hosts without a registered probe URL (e.g. the POST-only image API)
+            # recover through a trial call instead
+            probing = probing and self.probe_url is not None
+            if (self.state == 'open' and not probing and not self._trial
+                    and time.monotonic() - self.opened_at >= self.reset_timeout):
+                # Nobody is probing in the background: let one call through as the trial
+                self.state = 'half_open'
+                self._trial = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def success(self, elapsed: float):
+        if elapsed > self.latency_budget:
+            self.slow_calls += 1
+            self.failure(f"slow call: {elapsed:.2f}s over {self.latency_budget}s budget")
+            return
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"Circuit for {self.upstream} ({self.host}) closed")
+            self.state = 'closed'
+            self.failures = 0
+            self._trial = False
+
+    def failure(self, error: str):
+        with self._lock:
+            self.failures += 1
+            self.last_error = error[:200]
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                if self.state == 'closed':
+                    self.opened_total += 1
+                    logger.warning(f"Circuit for {self.upstream} ({self.host}) opened: {error}")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+    def due_for_probe(self) -> bool:
+        with self._lock:
+            if self.state != 'open' or self._trial or not self.probe_url:
+                return False
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = 'half_open'
+            self._trial = True
+            return True
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'upstream': self.upstream,
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'latency_budget': self.latency_budget,
+                'open_for': round(time.monotonic() - self.opened_at, 1) if self.state != 'closed' else 0.0,
+                'opened_total': self.opened_total,
+                'short_circuited': self.short_circuited,
+                'slow_calls': self.slow_calls,
+                'last_error': self.last_error
+            }
+
+class BreakerRegistry:
+    """Circuit breakers shared by the sync and async HTTP clients, plus their recovery probe.
+
+    The probe requests a fixed URL registered per host with register_probe,
+    never a user's request, so it carries no API keys or search queries.
+    Any answer below 500 (a 401 for a missing key included) means the host
+    is back. Hosts without a probe URL recover through a trial call.
+    """
+
+    def __init__(self, probe_timeout: tuple = (3.05, 5)):
+        self._breakers = {}
+        self._probe_urls = {}   # host -> health-check URL
+        self._lock = threading.Lock()
+        self.probe_timeout = probe_timeout
+        self.probing = False
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = 'SparkBot/1.0'
+
+    def get(self, host: str, upstream: str) -> Optional[CircuitBreaker]:
+        if upstream in BREAKER_EXEMPT_UPSTREAMS:
+            return None
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(host)
+                if breaker is None:
+                    breaker = self._breakers[host] = CircuitBreaker(host, upstream)
+                    breaker.probe_url = self._probe_urls.get(host)
+        return breaker
+
+    def register_probe(self, url: str):
+        """Use `url` (GET, no secrets) to check whether its host has recovered"""
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._probe_urls[host] = url
+            if host in self._breakers:
+                self._breakers[host].probe_url = url
+
+    def probe_open(self):
+        """Try one request against each breaker that has been open long enough"""
+        for breaker in list(self._breakers.values()):
+            if not breaker.due_for_probe():
+                continue
+            started = time.monotonic()
+            try:
+                response = self._session.get(breaker.probe_url, timeout=self.probe_timeout)
+                response.close()
+                if response.status_code >= 500 or response.status_code == 429:
+                    breaker.failure(f"probe: HTTP {response.status_code}")
+                else:
+                    breaker.success(time.monotonic() - started)
+            except requests.RequestException as e:
+                breaker.failure(f"probe: {e}")
+
+    def start_probing(self):
+        self.probing = True
+        breaker_probe.start()
+
+    def stop_probing(self):
+        self.probing = False
+        breaker_probe.stop()
+
+    def status(self) -> Dict:
+        return {host: breaker.status() for host, breaker in list(self._breakers.items())}
+
+circuit_breakers = BreakerRegistry()
+breaker_probe = PeriodicTask("breaker-probe", circuit_breakers.probe_open, BREAKER_PROBE_INTERVAL)
+
+class UpstreamMetrics:
+    """Per-upstream call counts, errors and latency, shared by the sync and async HTTP clients.
+
+    Every attempt counts, retries included; an attempt is an error when it
+    raised or answered with a retryable or 5xx status.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+
+    def observe(self, upstream: str, seconds: float, failed: bool = False):
+        histogram = self.latency.get(upstream)
+        if histogram is None:
+            with self._lock:
+                histogram = self.latency.setdefault(upstream, LatencyHistogram())
+        with self._lock:
+            self.calls[upstream] = self.calls.get(upstream, 0) + 1
+            if failed:
+                self.errors[upstream] = self.errors.get(upstream, 0) + 1
+        histogram.observe(seconds)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            calls, errors = dict(self.calls), dict(self.errors)
+        return {
+            upstream: {
+                'calls': count,
+                'errors': errors.get(upstream, 0),
+                'error_rate': round(errors.get(upstream, 0) / count, 3) if count else 0.0,
+                'latency': self.latency[upstream].snapshot()
+            }
+            for upstream, count in calls.items()
+        }
+
+upstream_metrics = UpstreamMetrics()
+
+def observe_upstream(upstream: str, started: float, failed: bool, **attrs):
+    """Account one outbound HTTP attempt in the metrics and the current trace"""
+    elapsed = time.monotonic() - started
+    upstream_metrics.observe(upstream, elapsed, failed)
+    trace = current_trace.get()
+    # Bot API calls get their own telegram.<method> span
+    if trace is not None and upstream != 'telegram':
+        trace.add(f"http.{upstream}", started, elapsed, **attrs)
+
+class HttpClient:
+    """Shared HTTP client: keep-alive pools per host, per-upstream timeouts and retries"""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeouts: Dict = None, retries: int = HTTP_RETRIES,
+                 backoff_base: float = HTTP_BACKOFF_BASE, backoff_max: float = HTTP_BACKOFF_MAX,
+                 pool_size: int = HTTP_POOL_SIZE, breakers: BreakerRegistry = None):
+        self.timeouts = dict(UPSTREAM_TIMEOUTS if timeouts is None else timeouts)
+        self.breakers = circuit_breakers if breakers is None else breakers
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'SparkBot/1.0'
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._adapter = adapter
+        self._lock = threading.Lock()
+        self._host_stats = {}
+
+    def _record(self, host: str, field: str):
+        with self._lock:
+            stats = self._host_stats.setdefault(host, {'requests': 0, 'errors': 0, 'retries': 0, 'short_circuited': 0})
+            stats[field] += 1
+
+    def _admit(self, breaker: Optional[CircuitBreaker], host: str, upstream: str):
+        """Raise CircuitOpenError if the host's breaker rejects the call"""
+        if breaker is None:
+            return
+        if not breaker.allow(self.breakers.probing):
+            self._record(host, 'short_circuited')
+            raise CircuitOpenError(f"Circuit open for {upstream} ({host})")
+
+    def _backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _retry_delay(self, attempt: int, retries: int, deadline: Optional[float]) -> Optional[float]:
+        """Backoff before the next attempt, or None when out of attempts or of time"""
+        if attempt >= retries:
+            return None
+        delay = self._backoff(attempt)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
 
-class CacheManager:
-    """Manage user preferences and caching"""
-    
     @staticmethod
-    def load_cache():
-        """Load cache from file"""
-        global USER_CACHE
+    def _bounded(timeout, deadline: Optional[float]):
+        """Cap an attempt's (connect, read) timeout at the time left before `deadline`"""
+        if deadline is None:
+            return timeout
+        left = max(0.01, deadline - time.monotonic())
+        if isinstance(timeout, tuple):
+            return tuple(min(part, left) for part in timeout)
+        return min(timeout, left)
+
+    def request(self, method: str, url: str, upstream: str = 'default', timeout=None,
+                retries: int = None, deadline: float = None, **kwargs) -> requests.Response:
+        """Send a request, retrying connection failures and retryable statuses.
+
+        `deadline` (a time.monotonic() value) caps each attempt's timeouts at
+        the time left, and no retry starts once it would be passed.
+        """
+        host = urlsplit(url).netloc
+        if timeout is None:
+            timeout = self.timeouts.get(upstream, self.timeouts['default'])
+        if retries is None:
+            # Only idempotent requests are retried by default
+            retries = self.retries if method.upper() == 'GET' else 0
+        breaker = self.breakers.get(host, upstream)
+
+        for attempt in range(retries + 1):
+            # Checked per attempt so retries stop as soon as the breaker opens
+            self._admit(breaker, host, upstream)
+            if attempt:
+                self._record(host, 'retries')
+            self._record(host, 'requests')
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=self._bounded(timeout, deadline), **kwargs)
+            except requests.ConnectionError as e:
+                # Covers refused/reset connections and connect timeouts, not read timeouts
+                observe_upstream(upstream, started, True, attempt=attempt, error=type(e).__name__)
+                self._record(host, 'errors')
+                if breaker:
+                    breaker.failure(str(e))
+                delay = self._retry_delay(attempt, retries, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except requests.RequestException as e:
+                observe_upstream(upstream, started, True, attempt=attempt, error=type(e).__name__)
+                self._record(host, 'errors')
+                if breaker:
+                    breaker.failure(str(e))
+                raise
+
+            failed = response.status_code in self.RETRY_STATUSES or response.status_code >= 500
+            observe_upstream(upstream, started, failed, attempt=attempt, status=response.status_code)
+            if breaker:
+                if failed:
+                    breaker.failure(f"HTTP {response.status_code}")
+                else:
+                    breaker.success(time.monotonic() - started)
+            delay = self._retry_delay(attempt, retries, deadline) if response.status_code in self.RETRY_STATUSES else None
+            if delay is not None:
+                self._record(host, 'errors')
+                response.close()
+                time.sleep(delay)
+                continue
+            if response.status_code >= 500:
+                self._record(host, 'errors')
+            return response
+
+    def get(self, url: str, upstream: str = 'default', **kwargs) -> requests.Response:
+        return self.request('GET', url, upstream=upstream, **kwargs)
+
+    def post(self, url: str, upstream: str = 'default', **kwargs) -> requests.Response:
+        return self.request('POST', url, upstream=upstream, **kwargs)
+
+    def stats(self) -> Dict:
+        """Per-host request, connection and reuse counters"""
+        connections = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = key.key_host if not key.key_port or key.key_port in (80, 443) else f"{key.key_host}:{key.key_port}"
+            connections[host] = connections.get(host, 0) + pool.num_connections
+
+        with self._lock:
+            host_stats = {host: dict(values) for host, values in self._host_stats.items()}
+        result = {}
+        for host, values in host_stats.items():
+            opened = connections.get(host, 0)
+            values['connections_opened'] = opened
+            values['reuse_rate'] = round(1 - opened / values['requests'], 3) if values['requests'] else 0.0
+            result[host] = values
+        return result
+
+class HedgedFetch:
+    """First usable answer from several interchangeable sources.
+
+    Sources are tried fastest first, ranked by a moving average of their
+    latency in which failures count as a full latency budget. Sources still
+    outstanding when one answers are recorded as no faster than their
+    average, then cancelled. A blocking request cannot be interrupted, so on
+    threads a hedged attempt gets no retries and a deadline of the latency
+    budget, and once the fetch is over it skips reading the body.
+    """
+
+    EWMA_ALPHA = 0.3
+
+    class _Source:
+        __slots__ = ('ewma', 'wins', 'failures', 'latency')
+
+        def __init__(self):
+            self.ewma = 0.0  # untried sources go first
+            self.wins = 0
+            self.failures = 0
+            self.latency = LatencyHistogram()
+
+    def __init__(self, upstream: str, urls: Callable[[], List[str]], parse: Callable[[Dict], str],
+                 mode: str = HEDGE_MODE, delay: float = HEDGE_DELAY):
+        self.upstream = upstream
+        self.urls = urls
+        self.parse = parse
+        self.mode = mode
+        self.delay = delay
+        self.failure_cost = UPSTREAM_LATENCY_BUDGETS.get(upstream, UPSTREAM_LATENCY_BUDGETS['default'])
+        self._sources = {}  # url -> _Source
+        self._lock = threading.Lock()
+        self._executor = None
+
+        # Metrics
+        self.fetches = 0
+        self.hedged = 0
+        self.exhausted = 0
+
+    def _source(self, url: str) -> 'HedgedFetch._Source':
+        source = self._sources.get(url)
+        if source is None:
+            with self._lock:
+                source = self._sources.setdefault(url, HedgedFetch._Source())
+        return source
+
+    def ordered(self) -> List[str]:
+        """Configured URLs, fastest first"""
+        return sorted(self.urls(), key=lambda url: self._source(url).ewma)
+
+    def _observe(self, url: str, elapsed: float, ok: bool):
+        source = self._source(url)
+        sample = elapsed if ok else max(elapsed, self.failure_cost)
+        source.latency.observe(elapsed)
+        with self._lock:
+            source.ewma = sample if not source.ewma else source.ewma + self.EWMA_ALPHA * (sample - source.ewma)
+            if not ok:
+                source.failures += 1
+
+    def _won(self, url: str):
+        with self._lock:
+            self._source(url).wins += 1
+
+    def _abandon(self, pending: Dict):
+        """Record sources that lost the race as at least as slow as they have been.
+
+        Their elapsed time so far is only a lower bound, so it can raise the
+        moving average but never lower it, and it stays out of the latency
+        histogram.
+        """
+        now = time.monotonic()
+        for url, started in pending.values():
+            source = self._source(url)
+            with self._lock:
+                sample = max(now - started, source.ewma)
+                source.ewma = sample if not source.ewma else source.ewma + self.EWMA_ALPHA * (sample - source.ewma)
+
+    def _attempt(self, http: 'HttpClient', url: str, cancelled: threading.Event = None) -> Optional[str]:
+        text = None
         try:
-            if os.path.exists(CACHE_FILE):
-                with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                    USER_CACHE = json.load(f)
-                logger.info(f"Cache loaded: {len(USER_CACHE)} users")
+            if cancelled is None:
+                response = http.get(url, upstream=self.upstream)
+            elif cancelled.is_set():
+                return None
+            else:
+                # The other sources stand in for retries; past the budget this one has lost anyway
+                response = http.get(url, upstream=self.upstream, retries=0, stream=True,
+                                    deadline=time.monotonic() + self.failure_cost)
+            try:
+                if response.status_code == 200 and not (cancelled and cancelled.is_set()):
+                    text = self.parse(response.json())
+            finally:
+                response.close()
         except Exception as e:
-            logger.error(f"Error loading cache: {e}")
-            USER_CACHE = {}
-    
-    @staticmethod
-    def save_cache():
-        """Save cache to file"""
+            logger.debug(f"{self.upstream} source {url} failed: {e}")
+        return text
+
+    def fetch(self, http: 'HttpClient') -> Optional[str]:
+        """Fetch through a thread pool; None when every source failed"""
+        remaining = self.ordered()
+        self.fetches += 1
+        if self.mode == 'sequential':
+            for url in remaining:
+                started = time.monotonic()
+                text = self._attempt(http, url)
+                self._observe(url, time.monotonic() - started, text is not None)
+                if text:
+                    self._won(url)
+                    return text
+            self.exhausted += 1
+            return None
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=UPDATE_WORKERS * 2, thread_name_prefix=f"hedge-{self.upstream}"
+                    )
+        pending = {}  # future -> (url, started)
+        cancelled = threading.Event()
+        launches = len(remaining) if self.mode == 'race' else 1
+        for url in remaining[:launches]:
+            pending[self._executor.submit(contextvars.copy_context().run, self._attempt, http, url, cancelled)] = (
+                url, time.monotonic()
+            )
+        remaining = remaining[launches:]
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=self.delay if remaining else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, started = pending.pop(future)
+                    text = future.result()
+                    self._observe(url, time.monotonic() - started, text is not None)
+                    if text:
+                        self._won(url)
+                        return text
+                if remaining:
+                    # Either the delay passed with no answer or a source failed
+                    if not done:
+                        self.hedged += 1
+                    url = remaining.pop(0)
+                    pending[self._executor.submit(contextvars.copy_context().run, self._attempt, http, url, cancelled)] = (
+                        url, time.monotonic()
+                    )
+        finally:
+            # Queued attempts never start; running ones stop before reading the body
+            cancelled.set()
+            self._abandon(pending)
+            for future in pending:
+                future.cancel()
+        self.exhausted += 1
+        return None
+
+    async def _attempt_async(self, http: 'AsyncHttpClient', url: str) -> Optional[str]:
+        text = None
         try:
-            with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(USER_CACHE, f, indent=2, ensure_ascii=False)
-            logger.info("Cache saved successfully")
+            response = await http.get(url, upstream=self.upstream)
+            if response.status_code == 200:
+                text = self.parse(response.json())
         except Exception as e:
-            logger.error(f"Error saving cache: {e}")
-    
-    @staticmethod
-    def get_user_data(user_id: int) -> Dict:
-        """Get user data from cache"""
-        user_id = str(user_id)
-        if user_id not in USER_CACHE:
-            USER_CACHE[user_id] = {
-                'weather_city': None,
-                'language_preference': 'en',
-                'timezone': None,
-                'last_active': time.time(),
-                'total_requests': 0
+            logger.debug(f"{self.upstream} source {url} failed: {e}")
+        return text
+
+    async def fetch_async(self, http: 'AsyncHttpClient') -> Optional[str]:
+        """Same as fetch() for the event loop; losing requests are cancelled"""
+        remaining = self.ordered()
+        self.fetches += 1
+        if self.mode == 'sequential':
+            for url in remaining:
+                started = time.monotonic()
+                text = await self._attempt_async(http, url)
+                self._observe(url, time.monotonic() - started, text is not None)
+                if text:
+                    self._won(url)
+                    return text
+            self.exhausted += 1
+            return None
+
+        pending = {}  # task -> (url, started)
+        launches = len(remaining) if self.mode == 'race' else 1
+        for url in remaining[:launches]:
+            pending[asyncio.ensure_future(self._attempt_async(http, url))] = (url, time.monotonic())
+        remaining = remaining[launches:]
+        try:
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending, timeout=self.delay if remaining else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    url, started = pending.pop(task)
+                    text = task.result()
+                    self._observe(url, time.monotonic() - started, text is not None)
+                    if text:
+                        self._won(url)
+                        return text
+                if remaining:
+                    if not done:
+                        self.hedged += 1
+                    url = remaining.pop(0)
+                    pending[asyncio.ensure_future(self._attempt_async(http, url))] = (url, time.monotonic())
+        finally:
+            self._abandon(pending)
+            for task in pending:
+                task.cancel()
+        self.exhausted += 1
+        return None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            sources = list(self._sources.items())
+        return {
+            'mode': self.mode,
+            'fetches': self.fetches,
+            'hedged': self.hedged,
+            'exhausted': self.exhausted,
+            'sources': {
+                urlsplit(url).netloc + urlsplit(url).path: {
+                    'ewma': round(source.ewma, 4),
+                    'wins': source.wins,
+                    'failures': source.failures,
+                    'latency': source.latency.snapshot()
+                }
+                for url, source in sources
             }
-        return USER_CACHE[user_id]
-    
-    @staticmethod
-    def set_user_weather_city(user_id: int, city: str):
-        """Set user's preferred weather city"""
-        user_data = CacheManager.get_user_data(user_id)
-        user_data['weather_city'] = city
-        user_data['last_active'] = time.time()
-        user_data['total_requests'] += 1
-        CacheManager.save_cache()
-    
-    @staticmethod
-    def get_user_weather_city(user_id: int) -> Optional[str]:
-        """Get user's preferred weather city"""
-        user_data = CacheManager.get_user_data(user_id)
-        return user_data.get('weather_city')
-    
-    @staticmethod
-    def update_user_activity(user_id: int):
-        """Update user's last activity"""
-        user_data = CacheManager.get_user_data(user_id)
-        user_data['last_active'] = time.time()
-        user_data['total_requests'] += 1
+        }
+
+class ContentPool:
+    """Bounded pool of pre-fetched texts (jokes, quotes) served without a round trip.
+
+    A background thread tops the pool up whenever it drops to `low_water`
+    and every `interval` seconds. Texts already pooled or recently served
+    are skipped. The pool is written to `path` after each refill and on stop,
+    and read back on start.
+    """
+
+    def __init__(self, name: str, fetch: Callable[[], Optional[str]], capacity: int = CONTENT_POOL_SIZE,
+                 low_water: int = CONTENT_POOL_LOW_WATER, interval: float = CONTENT_POOL_REFILL_INTERVAL,
+                 path: str = None):
+        self.name = name
+        self.fetch = fetch
+        self.capacity = capacity
+        self.low_water = min(low_water, capacity)
+        self.interval = interval
+        self.path = path or os.path.join(CONTENT_POOL_DIR, f"{name}_pool.json")
+        self._items = deque()
+        self._recent = OrderedDict()  # pooled and recently served texts, for de-duplication
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Metrics
+        self.served = 0
+        self.empty = 0
+        self.fetched = 0
+        self.duplicates = 0
+        self.fetch_failures = 0
+        self.loaded = 0
+
+    def take(self) -> Optional[str]:
+        """Pop a pooled text, or None when the pool is empty"""
+        with self._lock:
+            text = self._items.popleft() if self._items else None
+            remaining = len(self._items)
+            if text is None:
+                self.empty += 1
+            else:
+                self.served += 1
+        if remaining <= self.low_water:
+            self._wakeup.set()
+        return text
+
+    def add(self, text: str) -> bool:
+        """Pool a text unless it is a duplicate or the pool is full"""
+        with self._lock:
+            if text in self._recent or len(self._items) >= self.capacity:
+                self.duplicates += text in self._recent
+                return False
+            self._items.append(text)
+            self._recent[text] = None
+            while len(self._recent) > self.capacity * 4:
+                self._recent.popitem(last=False)
+            return True
+
+    def refill(self) -> int:
+        """Fetch until the pool is full; gives up after a failed fetch or too many duplicates"""
+        missing = self.capacity - len(self._items)
+        added = 0
+        for _ in range(missing * 2):
+            if self._stopped.is_set() or len(self._items) >= self.capacity:
+                break
+            try:
+                text = self.fetch()
+            except Exception as e:
+                logger.error(f"{self.name} pool fetch failed: {e}")
+                text = None
+            if not text:
+                self.fetch_failures += 1
+                break
+            self.fetched += 1
+            added += self.add(text)
+        if added:
+            self.save()
+        return added
+
+    def load(self):
+        """Read the pool saved by a previous run"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                texts = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read {self.path}: {e}")
+            return
+        self.loaded += sum(self.add(text) for text in texts if isinstance(text, str))
+
+    def save(self):
+        with self._lock:
+            texts = list(self._items)
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(texts, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save {self.name} pool: {e}")
+
+    def start(self):
+        if self._thread or not self.capacity:
+            return
+        self.load()
+        self._stopped.clear()
+        self._wakeup.set()
+        self._thread = threading.Thread(target=self._run, name=f"{self.name}-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+            self.save()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self._stopped.is_set():
+                self.refill()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            size = len(self._items)
+        return {
+            'size': size,
+            'capacity': self.capacity,
+            'served': self.served,
+            'empty': self.empty,
+            'fetched': self.fetched,
+            'duplicates': self.duplicates,
+            'fetch_failures': self.fetch_failures,
+            'loaded_from_disk': self.loaded
+        }
+
+class MessageTemplates:
+    """Messages and keyboards rendered once and reused for every update.
+
+    Texts are stored finished, or as str.format templates when they have
+    per-user slots. Keyboards are stored as the JSON Telegram receives,
+    which both send paths pass through untouched, so no ReplyMarkup
+    objects are built or serialized per update.
+    """
+
+    def __init__(self):
+        self._texts = {}
+        self._markups = {}
+
+    def add_text(self, name: str, text: str):
+        self._texts[name] = text.strip()
+
+    def add_markup(self, name: str, markup: ReplyMarkup):
+        self._markups[name] = markup.to_json()
+
+    def text(self, name: str, **slots) -> str:
+        """The named text, with `slots` filled in"""
+        template = self._texts[name]
+        return template.format_map(slots) if slots else template
+
+    def markup(self, name: str) -> str:
+        """Serialized reply_markup for the named keyboard"""
+        return self._markups[name]
+
+templates = MessageTemplates()
+
+class CommandRouter:
+    """Dispatch text commands by their leading token with a single dict lookup.
+
+    Understands "@cmd args", "/cmd args", "/cmd@BotName args" and the reply
+    keyboard variants that prefix the command with an emoji ("🎵 @song args").
+    Handlers are called as handler(update, context, args).
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+
+    def register(self, name: str, handler: Callable):
+        self._routes[name] = handler
+        self.calls[name] = 0
+        self.errors[name] = 0
+        self.latency[name] = LatencyHistogram()
+
+    def parse(self, text: str):
+        """Return (command, args) for a command message, else None"""
+        parts = text.split(None, 1)
+        if not parts:
+            return None
+        token, rest = parts[0], parts[1] if len(parts) > 1 else ""
+        if token[0] not in "@/":
+            # Keyboard buttons put an emoji before the command
+            if any(ch.isalnum() for ch in token):
+                return None
+            parts = rest.split(None, 1)
+            if not parts or parts[0][0] != "@":
+                return None
+            token, rest = parts[0], parts[1] if len(parts) > 1 else ""
+        name = token[1:].split("@", 1)[0].lower()
+        if name not in self._routes:
+            return None
+        return name, rest.strip()
+
+    def dispatch(self, update: Update, context: CallbackContext) -> bool:
+        """Run the handler for a command message; returns False if it is not one"""
+        parsed = self.parse(update.message.text)
+        if parsed is None:
+            return False
+        name, args = parsed
+        annotate_trace(command=name)
+        started = time.monotonic()
+        failed = True
+        try:
+            self._routes[name](update, context, args)
+            failed = False
+        finally:
+            self.record(name, time.monotonic() - started, failed)
+        return True
+
+    def record(self, name: str, seconds: float, failed: bool = False):
+        """Account one handled command (also used by the asyncio core)"""
+        self.calls[name] += 1
+        if failed:
+            self.errors[name] += 1
+        self.latency[name].observe(seconds)
+
+    def stats(self) -> Dict:
+        """Per-command call counts, errors and latency"""
+        return {
+            name: {
+                'calls': self.calls[name],
+                'errors': self.errors[name],
+                'latency': self.latency[name].snapshot()
+            }
+            for name in self._routes
+        }
 
 class UltimateBot:
     def __init__(self):
+        # One pooled client for every outbound API call
+        self.http = HttpClient()
+
         self.jiosaavn_api = "https://jiosavan-api-with-playlist.vercel.app/api"
         self.openweather_api = "http://api.openweathermap.org/data/2.5/weather"
+        self.wikipedia_api = "https://en.wikipedia.org/w/api.php"
+        self.quote_apis = [
+            "https://api.quotable.io/random"
+        ]
+        self.joke_apis = [
+            "https://official-joke-api.appspot.com/random_joke",
+            "https://v2.jokeapi.dev/joke/Any?blacklistFlags=nsfw,religious,political,racist,sexist,explicit"
+        ]
+        # Jokes and quotes come from whichever source answers first
+        self.joke_fetch = HedgedFetch('joke', lambda: self.joke_apis, self.format_joke)
+        self.quote_fetch = HedgedFetch('quote', lambda: self.quote_apis, self.format_quote)
+        self.content_pools = {
+            'joke': ContentPool('joke', lambda: self.joke_fetch.fetch(self.http)),
+            'quote': ContentPool('quote', lambda: self.quote_fetch.fetch(self.http))
+        }
         
         # Movie APIs
         self.movie_apis = {
@@ -113,6 +2463,12 @@ class UltimateBot:
             'omdb': 'http://www.omdbapi.com/',
             'yts': 'https://yts.mx/api/v2/list_movies.json'
         }
+
+        # Breaker recovery probes: fixed URLs without API keys or user queries
+        for url in [self.jiosaavn_api, self.openweather_api,
+                    f"{self.wikipedia_api}?action=query&meta=siteinfo&format=json",
+                    *self.joke_apis, *self.quote_apis, *self.movie_apis.values()]:
+            self.http.breakers.register_probe(url)
         
         # Emergency contacts (India)
         self.emergency_contacts = {
@@ -150,31 +2506,94 @@ class UltimateBot:
             'fracture': "🦴 **Fracture:** Don't move the person. Immobilize the area. Call 102."
         }
 
-    def get_command_keyboard(self):
-        """Create keyboard with command buttons"""
-        keyboard = [
-            [KeyboardButton("🎵 @song"), KeyboardButton("🌤️ @weather"), KeyboardButton("😄 @joke")],
-            [KeyboardButton("💭 @quote"), KeyboardButton("🎬 @movie"), KeyboardButton("🔍 @fact")],
-            [KeyboardButton("🖼️ @image"), KeyboardButton("📚 @w"), KeyboardButton("❓ @help")],
-            [KeyboardButton("⚙️ @settings"), KeyboardButton("📊 @stats")]
-        ]
-        return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+        # Song detail lookups run concurrently on a shared pool
+        # Identical concurrent fetches that have no cache of their own share one upstream call
+        self.flights = {name: SingleFlight() for name in ('song_search',)}
+        self.song_lookup_executor = ThreadPoolExecutor(max_workers=SONG_LOOKUP_WORKERS, thread_name_prefix="song-lookup")
+        self.song_search_latency = LatencyHistogram()
+        self.song_detail_latency = LatencyHistogram()
+        self.song_search_partial = 0
+        self.song_stats_lock = threading.Lock()
+        self.song_query_cache = TTLCache(SONG_QUERY_CACHE_TTL, SONG_QUERY_CACHE_SIZE)
+        self.song_detail_cache = TTLCache(SONG_DETAIL_CACHE_TTL, SONG_DETAIL_CACHE_SIZE)
+
+        # Movie sources are queried in parallel; TMDB and OMDb only with an API key
+        self.movie_search_executor = ThreadPoolExecutor(max_workers=MOVIE_SEARCH_WORKERS, thread_name_prefix="movie-search")
+        self.movie_search_latency = LatencyHistogram()
+        self.movie_search_partial = 0
+        self.movie_cache = TTLCache(MOVIE_CACHE_TTL, MOVIE_CACHE_SIZE)
+        self.movie_source_stats = {
+            name: {'latency': LatencyHistogram(), 'calls': 0, 'results': 0, 'errors': 0, 'late': 0}
+            for name in ('yts', 'tmdb', 'omdb')
+        }
+        self.movie_stats_lock = threading.Lock()
+
+        # Telegram file_ids of media already uploaded once
+        self.file_ids = FileIdIndex(USER_DB_FILE)
+
+        # Weather responses keyed by normalized city name
+        self.weather_cache = TTLCache(WEATHER_CACHE_TTL, WEATHER_CACHE_SIZE)
+
+        # Wikipedia results keyed by normalized query, plus request counts for pre-warming
+        self.wikipedia_cache = TTLCache(WIKIPEDIA_CACHE_TTL, WIKIPEDIA_CACHE_SIZE)
+        self.wikipedia_latency = LatencyHistogram()
+        self.wikipedia_query_counts = {}
+        self.wikipedia_counts_lock = threading.Lock()
+        self.wikipedia_prewarmed = 0
+
+    def get_command_keyboard(self) -> str:
+        """Keyboard with command buttons, as serialized reply_markup"""
+        return templates.markup('command_keyboard')
+
+    def normalize_query(self, query: str) -> str:
+        """Normalize a search query for use as a cache key"""
+        return " ".join(query.split()).casefold()
 
     def search_jiosaavn(self, query: str) -> List[Dict]:
-        """Search JioSaavn for songs"""
+        """Search JioSaavn for songs, served from the query and detail caches when possible"""
+        started = time.monotonic()
+        deadline = started + SONG_SEARCH_DEADLINE
+        key = self.normalize_query(query)
+        loaded = {}
+
+        def search():
+            records, complete = self._search_song_records(query, deadline)
+            loaded.update((record['id'], record) for record in records)
+            return [record['id'] for record in records], complete
+
         try:
-            url = f"{self.jiosaavn_api}/search?query={quote(query)}"
-            response = requests.get(url, timeout=15)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if 'data' in data and 'songs' in data['data']:
-                    songs = data['data']['songs'].get('results', [])
-                    return self.process_jiosaavn_songs(songs)
-            return []
+            song_ids, _ = self.song_query_cache.get_or_load(
+                key, search, cache_if=lambda result: result[0] and result[1]
+            )
+            # Records this call just fetched are not looked up again, so they
+            # don't show up as detail cache hits
+            songs = [loaded.get(song_id) or self.song_detail_cache.get(song_id) for song_id in song_ids]
+            if all(songs):
+                return songs
+            # Some detail records were evicted; search again to refill them
+            self.song_query_cache.delete(key)
+            songs, complete = self.flights['song_search'].do(key, self._search_song_records, query, deadline)
+            if songs and complete:
+                self.song_query_cache.set(key, ([song['id'] for song in songs], complete))
+            return songs
         except Exception as e:
             logger.error(f"JioSaavn search error: {e}")
             return []
+        finally:
+            self.song_search_latency.observe(time.monotonic() - started)
+
+    def _search_song_records(self, query: str, deadline: float):
+        """Run an upstream search; returns (song records, whether every lookup finished)"""
+        url = f"{self.jiosaavn_api}/search?query={quote(query)}"
+        # The search itself, retries included, has to fit in the deadline too
+        response = self.http.get(url, upstream='jiosaavn', deadline=deadline)
+        
+        if response.status_code == 200:
+            data = response.json()
+            if 'data' in data and 'songs' in data['data']:
+                songs = data['data']['songs'].get('results', [])
+                return self.resolve_song_records(songs, deadline)
+        return [], False
     
     def clean_title(self, title: str) -> str:
         """Clean the song title by removing brackets, special chars, and unwanted words"""
@@ -188,44 +2607,121 @@ class UltimateBot:
         title = re.sub(r'\s+', ' ', title)
         return title.strip()
 
-    def process_jiosaavn_songs(self, songs: List[Dict]) -> List[Dict]:
+    def fetch_song_detail(self, song_id: str) -> Optional[Dict]:
+        """Fetch full song details (including download URLs) from JioSaavn"""
+        started = time.monotonic()
+        try:
+            detail_url = f"{self.jiosaavn_api}/songs/{song_id}"
+            detail_response = self.http.get(detail_url, upstream='jiosaavn')
+            if detail_response.status_code == 200:
+                detail_data = detail_response.json()
+                if 'data' in detail_data and detail_data['data']:
+                    return detail_data['data'][0]
+        except Exception as e:
+            logger.error(f"Error fetching song details for {song_id}: {e}")
+        finally:
+            self.song_detail_latency.observe(time.monotonic() - started)
+        return None
+
+    def build_song_record(self, song: Dict, song_detail: Dict) -> Optional[Dict]:
+        """Combine a search result with its details into the record handlers use.
+
+        Search fields win; the detail fields fill in when only the details are known.
+        """
+        download_urls = song_detail.get('downloadUrl', [])
+        best_url = self.get_best_quality_url(download_urls)
+        if not best_url:
+            return None
+
+        def field(name, default):
+            return song.get(name) or song_detail.get(name) or default
+
+        # Clean title
+        clean_title = self.clean_title(field('title', '') or song_detail.get('name', '')) or 'No Title'
+        # Get primary artist (prefer song_detail if available)
+        artist = song_detail.get('primaryArtists') or song.get('primaryArtists') or 'Unknown Artist'
+        album = field('album', 'Unknown Album')
+        if isinstance(album, dict):
+            album = album.get('name', 'Unknown Album')
+        return {
+            'id': song.get('id') or song_detail.get('id'),
+            'title': clean_title,
+            'artist': artist,
+            'album': album,
+            'duration': field('duration', '0'),
+            'year': field('year', 'Unknown'),
+            'language': field('language', 'Unknown'),
+            'download_url': best_url,
+            'download_urls': download_urls,
+            'image': self.get_best_image(song.get('image') or song_detail.get('image') or []),
+            'play_count': field('playCount', '0'),
+            'has_lyrics': field('hasLyrics', False)
+        }
+
+    def get_song_record(self, song_id: str) -> Optional[Dict]:
+        """Song record with every download variant, fetched only on a cache miss"""
+        def load():
+            song_detail = self.fetch_song_detail(song_id)
+            return self.build_song_record({'id': song_id}, song_detail) if song_detail else None
+
+        return self.song_detail_cache.get_or_load(song_id, load, cache_if=bool)
+
+    def process_jiosaavn_songs(self, songs: List[Dict], deadline: float = None) -> List[Dict]:
         """Process JioSaavn songs and get download links"""
-        processed_songs = []
-        for song in songs[:8]:
+        return self.resolve_song_records(songs, deadline)[0]
+
+    def resolve_song_records(self, songs: List[Dict], deadline: float = None):
+        """Turn search results into song records; returns (records, complete).
+
+        Cached records are reused. The remaining detail lookups run in
+        parallel; anything not resolved by the deadline is dropped so the
+        search returns what it has instead of stalling.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + SONG_SEARCH_DEADLINE
+        candidates = [song for song in songs[:8] if song.get('id')]
+        resolved = {}
+        futures = {}
+        for index, song in enumerate(candidates):
+            cached = self.song_detail_cache.get(song['id'])
+            if cached:
+                resolved[index] = cached
+            else:
+                futures[self.song_lookup_executor.submit(
+                    contextvars.copy_context().run, self.fetch_song_detail, song['id']
+                )] = index
+
+        done, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic())) if futures else (set(), set())
+        if not_done:
+            with self.song_stats_lock:
+                self.song_search_partial += 1
+            logger.warning(f"Song search deadline hit: {len(not_done)} of {len(futures)} lookups unresolved")
+            for future in not_done:
+                future.cancel()
+
+        for future in done:
             try:
-                song_id = song.get('id')
-                if song_id:
-                    detail_url = f"{self.jiosaavn_api}/songs/{song_id}"
-                    detail_response = requests.get(detail_url, timeout=10)
-                    if detail_response.status_code == 200:
-                        detail_data = detail_response.json()
-                        if 'data' in detail_data and detail_data['data']:
-                            song_detail = detail_data['data'][0]
-                            download_urls = song_detail.get('downloadUrl', [])
-                            best_url = self.get_best_quality_url(download_urls)
-                            if best_url:
-                                # Clean title
-                                clean_title = self.clean_title(song.get('title', 'Unknown'))
-                                # Get primary artist (prefer song_detail if available)
-                                artist = song_detail.get('primaryArtists', song.get('primaryArtists', 'Unknown Artist'))
-                                processed_song = {
-                                    'id': song_id,
-                                    'title': clean_title,
-                                    'artist': artist,
-                                    'album': song.get('album', 'Unknown Album'),
-                                    'duration': song.get('duration', '0'),
-                                    'year': song.get('year', 'Unknown'),
-                                    'language': song.get('language', 'Unknown'),
-                                    'download_url': best_url,
-                                    'image': self.get_best_image(song.get('image', [])),
-                                    'play_count': song.get('playCount', '0'),
-                                    'has_lyrics': song.get('hasLyrics', False)
-                                }
-                                processed_songs.append(processed_song)
+                song_detail = future.result()
+                if song_detail:
+                    index = futures[future]
+                    record = self.build_song_record(candidates[index], song_detail)
+                    if record:
+                        self.song_detail_cache.set(record['id'], record)
+                        resolved[index] = record
             except Exception as e:
                 logger.error(f"Error processing song: {e}")
-                continue
-        return processed_songs
+        # Keep the search ranking
+        return [resolved[index] for index in sorted(resolved)], not not_done
+
+    def song_search_stats(self) -> Dict:
+        """Latency figures for the @song search path"""
+        return {
+            'search_latency': self.song_search_latency.snapshot(),
+            'detail_latency': self.song_detail_latency.snapshot(),
+            'partial_results': self.song_search_partial,
+            'query_cache': self.song_query_cache.stats(),
+            'detail_cache': self.song_detail_cache.stats()
+        }
     
     def get_best_quality_url(self, download_urls: List[Dict]) -> str:
         """Get the highest quality download URL"""
@@ -247,6 +2743,22 @@ class UltimateBot:
             return ""
         return images[-1].get('link', '') if images else ""
 
+    def normalize_city(self, city: str) -> str:
+        """Normalize a city name for use as a cache key"""
+        return " ".join(city.split()).casefold()
+
+    def fetch_weather_data(self, city: str):
+        """Fetch current weather as (status_code, data), served from cache when fresh"""
+        def load():
+            url = f"{self.openweather_api}?q={quote(city)}&appid={OPENWEATHER_API_KEY}&units=metric"
+            response = self.http.get(url, upstream='openweather')
+            return response.status_code, response.json() if response.status_code == 200 else None
+
+        # Successful lookups and unknown cities are stable for the TTL; errors are not cached
+        return self.weather_cache.get_or_load(
+            self.normalize_city(city), load, cache_if=lambda result: result[0] in (200, 404)
+        )
+
     def get_weather_with_openweather(self, city: str, user_id: int = None) -> str:
         """Get weather using OpenWeatherMap API with caching support"""
         try:
@@ -260,129 +2772,358 @@ class UltimateBot:
             elif not city:
                 city = "London"  # Default fallback
             
-            url = f"{self.openweather_api}?q={quote(city)}&appid={OPENWEATHER_API_KEY}&units=metric"
-            response = requests.get(url, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                # Save city to cache if user_id provided and city is valid
-                if user_id and city.lower() != "london":
-                    CacheManager.set_user_weather_city(user_id, city)
-                
-                weather_info = f"🌤️ **Weather in {data['name']}, {data['sys']['country']}:**\n\n"
-                weather_info += f"🌡️ **Temperature:** {data['main']['temp']}°C (feels like {data['main']['feels_like']}°C)\n"
-                weather_info += f"📊 **Condition:** {data['weather'][0]['description'].title()}\n"
-                weather_info += f"💧 **Humidity:** {data['main']['humidity']}%\n"
-                weather_info += f"🌪️ **Wind Speed:** {data['wind']['speed']} m/s\n"
-                weather_info += f"👁️ **Visibility:** {data.get('visibility', 'N/A')/1000 if data.get('visibility') else 'N/A'} km\n"
-                weather_info += f"🌅 **Sunrise:** {time.strftime('%H:%M', time.localtime(data['sys']['sunrise']))}\n"
-                weather_info += f"🌇 **Sunset:** {time.strftime('%H:%M', time.localtime(data['sys']['sunset']))}\n"
-                weather_info += f"🏢 **Pressure:** {data['main']['pressure']} hPa"
-                
-                # Add cache info if city was cached
-                if user_id and CacheManager.get_user_weather_city(user_id):
-                    weather_info += f"\n\n💾 **Saved as your default city**\n"
-                    weather_info += f"🔄 Use `@weather <new_city>` to change location"
-                
-                # Add weather emoji based on condition
-                condition = data['weather'][0]['main'].lower()
-                if 'rain' in condition:
-                    weather_info = "🌧️ " + weather_info
-                elif 'cloud' in condition:
-                    weather_info = "☁️ " + weather_info
-                elif 'clear' in condition:
-                    weather_info = "☀️ " + weather_info
-                elif 'snow' in condition:
-                    weather_info = "❄️ " + weather_info
-                
-                return weather_info
-            elif response.status_code == 404:
-                return f"⚠️ City '{city}' not found. Please check the spelling."
-            else:
-                return "⚠️ Could not fetch weather information."
-                
+            status_code, data = self.fetch_weather_data(city)
+            return self.format_weather(status_code, data, city, user_id)
         except Exception as e:
             logger.error(f"Weather API error: {e}")
             return "⚠️ Error fetching weather data."
-    
+
+    def format_weather(self, status_code: int, data: Optional[Dict], city: str, user_id: int = None) -> str:
+        """Render an OpenWeather response, saving the city for the user on success"""
+        if status_code == 200:
+            # Save city to cache if user_id provided and city is valid
+            if user_id and city.lower() != "london":
+                CacheManager.set_user_weather_city(user_id, city)
+            
+            weather_info = f"🌤️ **Weather in {data['name']}, {data['sys']['country']}:**\n\n"
+            weather_info += f"🌡️ **Temperature:** {data['main']['temp']}°C (feels like {data['main']['feels_like']}°C)\n"
+            weather_info += f"📊 **Condition:** {data['weather'][0]['description'].title()}\n"
+            weather_info += f"💧 **Humidity:** {data['main']['humidity']}%\n"
+            weather_info += f"🌪️ **Wind Speed:** {data['wind']['speed']} m/s\n"
+            weather_info += f"👁️ **Visibility:** {data.get('visibility', 'N/A')/1000 if data.get('visibility') else 'N/A'} km\n"
+            weather_info += f"🌅 **Sunrise:** {time.strftime('%H:%M', time.localtime(data['sys']['sunrise']))}\n"
+            weather_info += f"🌇 **Sunset:** {time.strftime('%H:%M', time.localtime(data['sys']['sunset']))}\n"
+            weather_info += f"🏢 **Pressure:** {data['main']['pressure']} hPa"
+            
+            # Add cache info if city was cached
+            if user_id and CacheManager.get_user_weather_city(user_id):
+                weather_info += f"\n\n💾 **Saved as your default city**\n"
+                weather_info += f"🔄 Use `@weather <new_city>` to change location"
+            
+            # Add weather emoji based on condition
+            condition = data['weather'][0]['main'].lower()
+            if 'rain' in condition:
+                weather_info = "🌧️ " + weather_info
+            elif 'cloud' in condition:
+                weather_info = "☁️ " + weather_info
+            elif 'clear' in condition:
+                weather_info = "☀️ " + weather_info
+            elif 'snow' in condition:
+                weather_info = "❄️ " + weather_info
+            
+            return weather_info
+        elif status_code == 404:
+            return f"⚠️ City '{city}' not found. Please check the spelling."
+        else:
+            return "⚠️ Could not fetch weather information."
+
     def get_weather_setup_message(self) -> str:
         """Get weather setup message for first-time users"""
-        return """🌤️ **Weather Setup Required**
+        return templates.text('weather_setup')
+
+    def search_movies(self, query: str) -> List[Dict]:
+        """Search for movies, cached per query; only complete results are cached"""
+        movies, _ = self.movie_cache.get_or_load(
+            self.normalize_query(query), lambda: self._search_movies(query),
+            cache_if=lambda result: result[1]
+        )
+        return movies
+
+    def movie_sources(self) -> Dict[str, Callable]:
+        """Movie sources that are configured, in merge priority order"""
+        sources = {'yts': self._movies_from_yts}
+        if TMDB_API_KEY:
+            sources['tmdb'] = self._movies_from_tmdb
+        if OMDB_API_KEY:
+            sources['omdb'] = self._movies_from_omdb
+        return sources
+
+    def _search_movies(self, query: str):
+        """Query every movie source at once and merge what answers by the deadline.
+
+        Returns (movies, complete); complete is False if a source failed or was late.
+        """
+        started = time.monotonic()
+        deadline = started + MOVIE_SEARCH_DEADLINE
+        futures = {
+            self.movie_search_executor.submit(
+                contextvars.copy_context().run, self._query_movie_source, name, fetch, query
+            ): name
+            for name, fetch in self.movie_sources().items()
+        }
+        done, not_done = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        if not_done:
+            late = [futures[future] for future in not_done]
+            logger.warning(f"Movie search deadline hit, continuing without: {', '.join(late)}")
+            with self.movie_stats_lock:
+                self.movie_search_partial += 1
+                for name in late:
+                    self.movie_source_stats[name]['late'] += 1
+
+        # Merge in source priority order, so richer sources fill the fields first
+        results = {futures[future]: future.result() for future in done}
+        movies = self.merge_movies(
+            [results[name] or [] for name in self.movie_sources() if name in results], query
+        )
+        self.movie_search_latency.observe(time.monotonic() - started)
+        return movies, not not_done and all(result is not None for result in results.values())
+
+    def _count_movie_source(self, name: str, field: str, amount: int = 1):
+        # Sources for concurrent searches report from several executor threads
+        with self.movie_stats_lock:
+            self.movie_source_stats[name][field] += amount
+
+    def _query_movie_source(self, name: str, fetch: Callable, query: str) -> Optional[List[Dict]]:
+        self._count_movie_source(name, 'calls')
+        started = time.monotonic()
+        try:
+            movies = fetch(query)
+            self._count_movie_source(name, 'results', len(movies))
+            return movies
+        except Exception as e:
+            self._count_movie_source(name, 'errors')
+            logger.error(f"{name.upper()} search error: {e}")
+            return None
+        finally:
+            self.movie_source_stats[name]['latency'].observe(time.monotonic() - started)
+
+    def _movie(self, source: str, **fields) -> Dict:
+        """Movie dict with every field the handlers read"""
+        movie = {
+            'title': 'Unknown',
+            'year': 'Unknown',
+            'rating': 'N/A',
+            'genres': '',
+            'runtime': 'N/A',
+            'summary': 'No summary available',
+            'poster': '',
+            'torrents': [],
+            'imdb_code': '',
+            'source': source
+        }
+        movie.update({key: value for key, value in fields.items() if value})
+        return movie
+
+    def _movies_from_yts(self, query: str) -> List[Dict]:
+        """YTS: torrents, ratings and summaries"""
+        response = self.http.get(f"{self.movie_apis['yts']}?query_term={quote(query)}&limit=5", upstream='yts')
+        if response.status_code != 200:
+            return []
+        data = response.json()
+        if data['status'] != 'ok' or 'movies' not in data['data']:
+            return []
+        return [
+            self._movie(
+                'YTS',
+                title=movie.get('title'),
+                year=movie.get('year'),
+                rating=movie.get('rating'),
+                genres=', '.join(movie.get('genres', [])),
+                runtime=f"{movie.get('runtime', 0)} min",
+                summary=movie.get('summary', 'No summary available')[:200] + "...",
+                poster=movie.get('large_cover_image', ''),
+                torrents=movie.get('torrents', []),
+                imdb_code=movie.get('imdb_code', '')
+            )
+            for movie in data['data']['movies']
+        ]
+
+    def _movies_from_tmdb(self, query: str) -> List[Dict]:
+        """TMDB: ratings, summaries and posters (no IMDb ids in search results)"""
+        url = f"{self.movie_apis['tmdb']}?api_key={TMDB_API_KEY}&query={quote(query)}&include_adult=false"
+        response = self.http.get(url, upstream='tmdb')
+        if response.status_code != 200:
+            return []
+        movies = []
+        for movie in response.json().get('results', [])[:5]:
+            overview = movie.get('overview') or ''
+            movies.append(self._movie(
+                'TMDB',
+                title=movie.get('title'),
+                year=(movie.get('release_date') or '')[:4],
+                rating=round(movie['vote_average'], 1) if movie.get('vote_count') else None,
+                summary=overview[:200] + "..." if overview else None,
+                poster=f"https://image.tmdb.org/t/p/w500{movie['poster_path']}" if movie.get('poster_path') else None
+            ))
+        return movies
+
+    def _movies_from_omdb(self, query: str) -> List[Dict]:
+        """OMDb: titles, years, posters and IMDb ids"""
+        response = self.http.get(f"{self.movie_apis['omdb']}?apikey={OMDB_API_KEY}&s={quote(query)}&type=movie",
+                                 upstream='omdb')
+        if response.status_code != 200:
+            return []
+        return [
+            self._movie(
+                'OMDb',
+                title=movie.get('Title'),
+                year=movie.get('Year'),
+                poster=movie.get('Poster') if movie.get('Poster') != 'N/A' else None,
+                imdb_code=movie.get('imdbID')
+            )
+            for movie in response.json().get('Search', [])[:5]
+        ]
 
-Welcome to the weather feature! 
+    def merge_movies(self, result_lists: List[List[Dict]], query: str) -> List[Dict]:
+        """De-duplicate movies across sources and rank them.
 
-**First time setup:**
-• Use `@weather <your_city>` to get weather and save your location
-• Example: `@weather Mumbai` or `@weather New York`
+        Movies are matched by IMDb id, or by title and year when a source has
+        no id. Earlier lists win each field; later ones only fill gaps. Ranking
+        favours titles matching the query, movies several sources agree on,
+        and then rating.
+        """
+        merged = []
+        by_imdb = {}
+        by_title = {}
+        for movies in result_lists:
+            for position, movie in enumerate(movies):
+                title_key = (self.normalize_query(str(movie['title'])), str(movie['year']))
+                existing = by_imdb.get(movie['imdb_code']) if movie['imdb_code'] else None
+                existing = existing or by_title.get(title_key)
+                if existing is None:
+                    existing = dict(movie, sources=[movie['source']], position=position)
+                    merged.append(existing)
+                else:
+                    default = self._movie('')
+                    for field, value in movie.items():
+                        if field in default and value and existing.get(field) in (default[field], None):
+                            existing[field] = value
+                    if movie['source'] not in existing['sources']:
+                        existing['sources'].append(movie['source'])
+                    existing['position'] = min(existing['position'], position)
+                if existing['imdb_code']:
+                    by_imdb[existing['imdb_code']] = existing
+                by_title[title_key] = existing
 
-**After setup:**
-• Just use `@weather` to get weather for your saved city
-• Use `@weather <new_city>` to check other cities
+        wanted = self.normalize_query(query)
 
-**Features:**
-✅ Auto-saves your preferred city
-✅ Detailed weather information  
-✅ Sunrise/sunset times
-✅ Real-time data from OpenWeatherMap
+        def score(movie: Dict) -> float:
+            title = self.normalize_query(str(movie['title']))
+            match = 3 if title == wanted else 1 if wanted in title else 0
+            try:
+                rating = float(movie['rating']) / 10
+            except (TypeError, ValueError):
+                rating = 0.0
+            return match + 2 * len(movie['sources']) + rating - 0.1 * movie['position']
 
-Type `@weather <your_city>` to get started! 🌍"""
+        merged.sort(key=score, reverse=True)
+        for movie in merged:
+            movie['source'] = ', '.join(movie.pop('sources'))
+            movie.pop('position')
+        return merged
 
-    def search_movies(self, query: str) -> List[Dict]:
-        """Search for movies across multiple sources"""
-        movies = []
-        
-        try:
-            # Search YTS for torrents
-            yts_url = f"https://yts.mx/api/v2/list_movies.json?query_term={quote(query)}&limit=5"
-            response = requests.get(yts_url, timeout=10)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data['status'] == 'ok' and 'movies' in data['data']:
-                    for movie in data['data']['movies']:
-                        movie_info = {
-                            'title': movie.get('title', 'Unknown'),
-                            'year': movie.get('year', 'Unknown'),
-                            'rating': movie.get('rating', 'N/A'),
-                            'genres': ', '.join(movie.get('genres', [])),
-                            'runtime': f"{movie.get('runtime', 0)} min",
-                            'summary': movie.get('summary', 'No summary available')[:200] + "...",
-                            'poster': movie.get('large_cover_image', ''),
-                            'torrents': movie.get('torrents', []),
-                            'imdb_code': movie.get('imdb_code', ''),
-                            'source': 'YTS'
-                        }
-                        movies.append(movie_info)
-        except Exception as e:
-            logger.error(f"YTS search error: {e}")
-        
-        return movies
+    def movie_search_stats(self) -> Dict:
+        """Latency and result counts for the @movie search path"""
+        configured = self.movie_sources()
+        with self.movie_stats_lock:
+            partial = self.movie_search_partial
+            sources = {name: dict(stats) for name, stats in self.movie_source_stats.items()}
+        return {
+            'search_latency': self.movie_search_latency.snapshot(),
+            'partial_results': partial,
+            'cache': self.movie_cache.stats(),
+            'sources': {
+                name: dict(stats, latency=stats['latency'].snapshot(), configured=name in configured)
+                for name, stats in sources.items()
+            }
+        }
 
-    def get_joke(self) -> str:
-        """Get a random joke"""
-        joke_apis = [
-            "https://official-joke-api.appspot.com/random_joke",
-            "https://v2.jokeapi.dev/joke/Any?blacklistFlags=nsfw,religious,political,racist,sexist,explicit"
+    def wikipedia_url(self, query: str) -> str:
+        """One call returning the top search hits with their plain-text intro extracts"""
+        return (
+            f"{self.wikipedia_api}?action=query&format=json&formatversion=2&utf8=1"
+            f"&generator=search&gsrsearch={quote(query)}&gsrlimit={WIKIPEDIA_RESULTS}"
+            f"&prop=extracts&exintro=1&explaintext=1&exsentences=2&exlimit={WIKIPEDIA_RESULTS}"
+        )
+
+    def parse_wikipedia(self, data: Dict) -> List[Dict]:
+        """Pages from a generator=search response, in search rank order"""
+        pages = sorted(data.get('query', {}).get('pages', []), key=lambda page: page.get('index', 0))
+        return [
+            {'title': page['title'], 'pageid': page['pageid'], 'extract': (page.get('extract') or '').strip()}
+            for page in pages if 'pageid' in page
         ]
-        
-        for api_url in joke_apis:
+
+    def count_wikipedia_query(self, key: str):
+        # Called from handler threads while the pre-warm thread reads the counts
+        with self.wikipedia_counts_lock:
+            counts = self.wikipedia_query_counts
+            counts[key] = counts.get(key, 0) + 1
+            if len(counts) > WIKIPEDIA_CACHE_SIZE:
+                # Keep the most requested half
+                keep = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:WIKIPEDIA_CACHE_SIZE // 2]
+                self.wikipedia_query_counts = dict(keep)
+
+    def fetch_wikipedia(self, query: str):
+        """Uncached lookup as (status_code, pages)"""
+        started = time.monotonic()
+        try:
+            response = self.http.get(self.wikipedia_url(query), upstream='wikipedia')
+            if response.status_code != 200:
+                return response.status_code, []
+            return 200, self.parse_wikipedia(response.json())
+        finally:
+            self.wikipedia_latency.observe(time.monotonic() - started)
+
+    def search_wikipedia(self, query: str):
+        """Wikipedia search as (status_code, pages), cached per normalized query"""
+        key = self.normalize_query(query)
+        self.count_wikipedia_query(key)
+        return self.wikipedia_cache.get_or_load(
+            key, lambda: self.fetch_wikipedia(query), cache_if=lambda result: result[0] == 200
+        )
+
+    def prewarm_wikipedia(self) -> int:
+        """Refresh the configured and the most requested queries in the cache"""
+        with self.wikipedia_counts_lock:
+            counts = list(self.wikipedia_query_counts.items())
+        top = sorted(counts, key=lambda item: item[1], reverse=True)
+        queries = dict.fromkeys([self.normalize_query(q) for q in WIKIPEDIA_PREWARM]
+                                + [key for key, _ in top[:WIKIPEDIA_PREWARM_TOP]])
+        warmed = 0
+        for key in queries:
             try:
-                response = requests.get(api_url, timeout=8)
-                if response.status_code == 200:
-                    joke_data = response.json()
-                    
-                    if 'setup' in joke_data and 'punchline' in joke_data:
-                        return f"😄 **Random Joke:**\n\n*{joke_data['setup']}*\n\n**{joke_data['punchline']}**"
-                    elif 'joke' in joke_data:
-                        return f"😄 **Random Joke:**\n\n{joke_data['joke']}"
-                    elif joke_data['type'] == 'single':
-                        return f"😄 **Random Joke:**\n\n{joke_data['joke']}"
-                    else:
-                        return f"😄 **Random Joke:**\n\n*{joke_data['setup']}*\n\n**{joke_data['delivery']}**"
-            except:
+                result = self.fetch_wikipedia(key)
+            except Exception as e:
+                logger.warning(f"Wikipedia pre-warm failed for '{key}': {e}")
                 continue
-        
+            if result[0] == 200:
+                self.wikipedia_cache.set(key, result)
+                warmed += 1
+        self.wikipedia_prewarmed += warmed
+        return warmed
+
+    def wikipedia_stats(self) -> Dict:
+        """Cache and upstream figures for @w"""
+        return {
+            'cache': self.wikipedia_cache.stats(),
+            'upstream_latency': self.wikipedia_latency.snapshot(),
+            'tracked_queries': len(self.wikipedia_query_counts),
+            'prewarmed': self.wikipedia_prewarmed
+        }
+
+    def single_flight_stats(self) -> Dict:
+        """Executions and deduplicated calls per coalesced fetch"""
+        stats = {name: flight.stats() for name, flight in self.flights.items()}
+        stats['song_query_cache'] = self.song_query_cache.flight.stats()
+        stats['song_detail_cache'] = self.song_detail_cache.flight.stats()
+        stats['weather_cache'] = self.weather_cache.flight.stats()
+        stats['movie_cache'] = self.movie_cache.flight.stats()
+        stats['wikipedia_cache'] = self.wikipedia_cache.flight.stats()
+        return stats
+
+    def format_joke(self, joke_data: Dict) -> str:
+        """Render a joke API response"""
+        if 'setup' in joke_data and 'punchline' in joke_data:
+            return f"😄 **Random Joke:**\n\n*{joke_data['setup']}*\n\n**{joke_data['punchline']}**"
+        elif 'joke' in joke_data:
+            return f"😄 **Random Joke:**\n\n{joke_data['joke']}"
+        elif joke_data['type'] == 'single':
+            return f"😄 **Random Joke:**\n\n{joke_data['joke']}"
+        else:
+            return f"😄 **Random Joke:**\n\n*{joke_data['setup']}*\n\n**{joke_data['delivery']}**"
+
+    def fallback_joke(self) -> str:
         fallback_jokes = [
             "Why don't scientists trust atoms? Because they make up everything!",
             "I told my wife she was drawing her eyebrows too high. She looked surprised.",
@@ -390,16 +3131,16 @@ Type `@weather <your_city>` to get started! 🌍"""
         ]
         return f"😄 **Random Joke:**\n\n{random.choice(fallback_jokes)}"
 
-    def get_quote(self) -> str:
-        """Get an inspirational quote"""
-        try:
-            response = requests.get("https://api.quotable.io/random", timeout=8)
-            if response.status_code == 200:
-                quote_data = response.json()
-                return f"💭 **Quote of the Day:**\n\n*\"{quote_data['content']}\"*\n\n— **{quote_data['author']}**"
-        except:
-            pass
-        
+    def get_joke(self) -> str:
+        """Get a random joke"""
+        return self.content_pools['joke'].take() or self.joke_fetch.fetch(self.http) or self.fallback_joke()
+
+    def format_quote(self, quote_data: Dict) -> str:
+        """Render a quotable.io response"""
+        content, author = quote_data['content'], quote_data['author']
+        return f"💭 **Quote of the Day:**\n\n*\"{content}\"*\n\n— **{author}**"
+
+    def fallback_quote(self) -> str:
         fallback_quotes = [
             ("The only way to do great work is to love what you do.", "Steve Jobs"),
             ("Innovation distinguishes between a leader and a follower.", "Steve Jobs"),
@@ -408,6 +3149,10 @@ Type `@weather <your_city>` to get started! 🌍"""
         quote, author = random.choice(fallback_quotes)
         return f"💭 **Inspirational Quote:**\n\n*\"{quote}\"*\n\n— **{author}**"
 
+    def get_quote(self) -> str:
+        """Get an inspirational quote"""
+        return self.content_pools['quote'].take() or self.quote_fetch.fetch(self.http) or self.fallback_quote()
+
     def get_user_stats(self, user_id: int) -> str:
         """Get user statistics"""
         user_data = CacheManager.get_user_data(user_id)
@@ -434,13 +3179,10 @@ Type `@weather <your_city>` to get started! 🌍"""
         return stats_text
 
 bot = UltimateBot()
+wikipedia_prewarm = PeriodicTask("wikipedia-prewarm", bot.prewarm_wikipedia, WIKIPEDIA_PREWARM_INTERVAL)
 
-def start_command(update: Update, context: CallbackContext):
-    """Send start message with bot capabilities"""
-    user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
-    
-    help_text = """
+# Static messages and keyboards, rendered once
+templates.add_text('start', """
 🤖 **Ultimate Multi-Feature Bot** 🤖
 
 Welcome! I'm your all-in-one assistant with advanced features.
@@ -461,20 +3203,9 @@ Welcome! I'm your all-in-one assistant with advanced features.
 • Enhanced command keyboard
 
 Type `@help` for detailed command list.
-    """
-    keyboard = bot.get_command_keyboard()
-    update.message.reply_text(
-        help_text, 
-        parse_mode=ParseMode.MARKDOWN, 
-        reply_markup=keyboard
-    )
+""")
 
-def help_command(update: Update, context: CallbackContext):
-    """Show detailed help"""
-    user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
-    
-    help_text = """
+templates.add_text('help', """
 📖 **Detailed Command Guide**
 
 **🎵 MUSIC COMMANDS:**
@@ -505,10 +3236,77 @@ def help_command(update: Update, context: CallbackContext):
 • Just type normally for AI conversation
 
 Need help? Just ask me anything! 😊
-    """
-    update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+""")
+
+templates.add_text('weather_setup', """🌤️ **Weather Setup Required**
+
+Welcome to the weather feature! 
+
+**First time setup:**
+• Use `@weather <your_city>` to get weather and save your location
+• Example: `@weather Mumbai` or `@weather New York`
+
+**After setup:**
+• Just use `@weather` to get weather for your saved city
+• Use `@weather <new_city>` to check other cities
+
+**Features:**
+✅ Auto-saves your preferred city
+✅ Detailed weather information  
+✅ Sunrise/sunset times
+✅ Real-time data from OpenWeatherMap
+
+Type `@weather <your_city>` to get started! 🌍""")
+
+templates.add_text('health', "💊 **Health Tips:**\n\n" + "\n".join(f"• {tip}" for tip in bot.health_tips)
+                   + "\n\n🏥 **For emergencies, use `@emergency` to get contact numbers.**")
+
+templates.add_text('settings', """⚙️ **Bot Settings:**
+
+🌤️ **Weather City:** {city}
+🎯 **Total Requests:** {total_requests}
+🌐 **Language:** {language}
+
+Click the buttons below to modify your settings:""")
+
+templates.add_markup('command_keyboard', ReplyKeyboardMarkup([
+    [KeyboardButton("🎵 @song"), KeyboardButton("🌤️ @weather"), KeyboardButton("😄 @joke")],
+    [KeyboardButton("💭 @quote"), KeyboardButton("🎬 @movie"), KeyboardButton("🔍 @fact")],
+    [KeyboardButton("🖼️ @image"), KeyboardButton("📚 @w"), KeyboardButton("❓ @help")],
+    [KeyboardButton("⚙️ @settings"), KeyboardButton("📊 @stats")]
+], resize_keyboard=True, one_time_keyboard=False))
 
-CHANGE_WEATHER_CITY = range(1)
+templates.add_markup('settings_city', InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌍 Change Weather City", callback_data="change_weather_city")],
+    [InlineKeyboardButton("🗑️ Reset Weather City", callback_data="reset_weather_city")],
+    [InlineKeyboardButton("📊 View Statistics", callback_data="view_stats")]
+]))
+
+templates.add_markup('settings_no_city', InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌍 Set Weather City", callback_data="set_weather_city")],
+    [InlineKeyboardButton("📊 View Statistics", callback_data="view_stats")]
+]))
+
+def start_command(update: Update, context: CallbackContext):
+    """Send start message with bot capabilities"""
+    user_id = update.effective_user.id
+    CacheManager.update_user_activity(user_id)
+    
+    update.message.reply_text(
+        templates.text('start'),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=bot.get_command_keyboard()
+    )
+
+def help_command(update: Update, context: CallbackContext):
+    """Show detailed help"""
+    user_id = update.effective_user.id
+    CacheManager.update_user_activity(user_id)
+    handle_help(update, context)
+
+def handle_help(update: Update, context: CallbackContext, args: str = ""):
+    """Send the detailed command guide"""
+    update.message.reply_text(templates.text('help'), parse_mode=ParseMode.MARKDOWN)
 
 def weather_city_callback(update: Update, context: CallbackContext):
     """Handle weather city change/reset via button callbacks"""
@@ -522,27 +3320,22 @@ def weather_city_callback(update: Update, context: CallbackContext):
             "🌍 Please send your new city name to set as your default for weather updates.",
             parse_mode=ParseMode.MARKDOWN
         )
-        # Set a flag in user_data to expect city name next
-        context.user_data['awaiting_weather_city'] = True
-        return CHANGE_WEATHER_CITY
+        # Expect the city name as the next message, whichever worker receives it
+        sessions.set(user_id, 'awaiting_weather_city', True)
 
     elif data == "reset_weather_city":
         user_data = CacheManager.get_user_data(user_id)
         user_data['weather_city'] = None
-        CacheManager.save_cache()
+        CacheManager.save_user(user_id)
         query.message.reply_text(
             "🌤️ Your saved weather city has been reset.\n\nUse `@weather <city>` to set a new default city.",
             parse_mode=ParseMode.MARKDOWN
         )
-        context.user_data['awaiting_weather_city'] = False
-        return ConversationHandler.END
+        sessions.pop(user_id, 'awaiting_weather_city')
 
     elif data == "view_stats":
         stats_text = bot.get_user_stats(user_id)
         query.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
-        return ConversationHandler.END
-
-    return ConversationHandler.END
 
 def handle_new_weather_city(update: Update, context: CallbackContext):
     """Handle user reply for new weather city after button click"""
@@ -550,335 +3343,358 @@ def handle_new_weather_city(update: Update, context: CallbackContext):
     city_name = update.message.text.strip()
     if len(city_name) < 2:
         update.message.reply_text("🌍 Please provide a valid city name.")
-        return CHANGE_WEATHER_CITY
+        return
     CacheManager.set_user_weather_city(user_id, city_name)
     update.message.reply_text(f"🌤️ Your default weather city has been set to: {city_name}")
-    context.user_data['awaiting_weather_city'] = False
-    return ConversationHandler.END
+    sessions.pop(user_id, 'awaiting_weather_city')
 
 def media_logger(update: Update, context: CallbackContext):
-    """Enhanced media and message handler with caching"""
+    """Route text messages to the reply flow or the command router"""
     try:
-        user_id = update.effective_user.id
-        CacheManager.update_user_activity(user_id)
-        
-        # Handle reply for new weather city
-        if context.user_data.get('awaiting_weather_city'):
-            return handle_new_weather_city(update, context)
-        
-        if update.message and update.message.text:
-            prompt = update.message.text.strip()
-            
-            # Help command
-            if prompt in ["@help", "❓ @help"]:
-                help_command(update, context)
-                return
-            
-            # Settings command
-            elif prompt in ["@settings", "⚙️ @settings"]:
-                user_data = CacheManager.get_user_data(user_id)
-                settings_text = "⚙️ **Bot Settings:**\n\n"
-                
-                if user_data.get('weather_city'):
-                    settings_text += f"🌤️ **Weather City:** {user_data['weather_city']}\n"
-                    keyboard = [
-                        [InlineKeyboardButton("🌍 Change Weather City", callback_data="change_weather_city")],
-                        [InlineKeyboardButton("🗑️ Reset Weather City", callback_data="reset_weather_city")],
-                        [InlineKeyboardButton("📊 View Statistics", callback_data="view_stats")]
-                    ]
-                else:
-                    settings_text += f"🌤️ **Weather City:** Not set\n"
-                    keyboard = [
-                        [InlineKeyboardButton("🌍 Set Weather City", callback_data="set_weather_city")],
-                        [InlineKeyboardButton("📊 View Statistics", callback_data="view_stats")]
-                    ]
-                
-                settings_text += f"🎯 **Total Requests:** {user_data.get('total_requests', 0)}\n"
-                settings_text += f"🌐 **Language:** {user_data.get('language_preference', 'English')}\n\n"
-                settings_text += "Click the buttons below to modify your settings:"
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                update.message.reply_text(settings_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                return
-            
-            # Stats command
-            elif prompt in ["@stats", "📊 @stats"]:
-                stats_text = bot.get_user_stats(user_id)
-                update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
-                return
-            
-            # Music search
-            elif prompt.startswith("@song") or prompt.startswith("🎵 @song"):
-                context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-                
-                song_query = prompt.replace("🎵 @song", "").replace("@song", "").strip()
-                if not song_query:
-                    update.message.reply_text("🎵 Please provide a song name!\n\n**Example:** `@song Kesariya`", parse_mode=ParseMode.MARKDOWN)
-                    return
-                
-                update.message.reply_text(f"🔍 **Searching:** `{song_query}`", parse_mode=ParseMode.MARKDOWN)
-                
-                songs = bot.search_jiosaavn(song_query)
-                
-                if not songs:
-                    update.message.reply_text("😔 No songs found. Try a different search term.")
-                    return
-                
-                keyboard = []
-                for i, song in enumerate(songs):
-                    button_text = f"🎵 {song['title'][:30]}{'...' if len(song['title']) > 30 else ''}"
-                    keyboard.append([InlineKeyboardButton(button_text, callback_data=f"download_song:{i}")])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                context.user_data['songs'] = songs
-                
-                result_text = f"🎵 **Found {len(songs)} songs:**\n\n"
-                for i, song in enumerate(songs[:3]):
-                    result_text += f"**{i+1}.** {song['title']}\n   👤 {song['artist']}\n   💿 {song['album']}\n\n"
-                
-                if len(songs) > 3:
-                    result_text += f"*...and {len(songs)-3} more*\n\n"
-                
-                result_text += "🎧 **Click to download:**"
-                update.message.reply_text(result_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-            
-            # Movie search
-            elif prompt.startswith("@movie") or prompt.startswith("🎬 @movie"):
-                context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-                
-                movie_query = prompt.replace("🎬 @movie", "").replace("@movie", "").strip()
-                if not movie_query:
-                    update.message.reply_text("🎬 Please provide a movie name!\n\n**Example:** `@movie Avengers`", parse_mode=ParseMode.MARKDOWN)
-                    return
-                
-                update.message.reply_text(f"🔍 **Searching movies:** `{movie_query}`", parse_mode=ParseMode.MARKDOWN)
-                
-                movies = bot.search_movies(movie_query)
-                
-                if not movies:
-                    update.message.reply_text("😔 No movies found. Try a different search term.")
-                    return
-                
-                for movie in movies[:3]:  # Show top 3 results
-                    movie_text = f"🎬 **{movie['title']} ({movie['year']})**\n\n"
-                    movie_text += f"⭐ **Rating:** {movie['rating']}/10\n"
-                    movie_text += f"🎭 **Genres:** {movie['genres']}\n"
-                    movie_text += f"⏱️ **Runtime:** {movie['runtime']}\n\n"
-                    movie_text += f"📖 **Summary:** {movie['summary']}\n\n"
-                    
-                    # Add download links
-                    if movie['torrents']:
-                        movie_text += "📥 **Download Options:**\n"
-                        for torrent in movie['torrents']:
-                            quality = torrent.get('quality', 'Unknown')
-                            size = torrent.get('size', 'Unknown')
-                            movie_text += f"• **{quality}** ({size}) - [Magnet Link](magnet:?xt=urn:btih:{torrent.get('hash', '')})\n"
-                    
-                    keyboard = []
-                    if movie['imdb_code']:
-                        keyboard.append([InlineKeyboardButton("🎭 View on IMDb", url=f"https://www.imdb.com/title/{movie['imdb_code']}")])
-                    
-                    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-                    
-                    if movie['poster']:
-                        try:
-                            update.message.reply_photo(
-                                photo=movie['poster'],
-                                caption=movie_text,
-                                parse_mode=ParseMode.MARKDOWN,
-                                reply_markup=reply_markup
-                            )
-                        except:
-                            update.message.reply_text(movie_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    else:
-                        update.message.reply_text(movie_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-            
-            # Enhanced Weather with Caching
-            elif prompt.startswith("@weather") or prompt.startswith("🌤️ @weather"):
-                context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-                
-                weather_query = prompt.replace("🌤️ @weather", "").replace("@weather", "").strip()
-                
-                # Handle weather reset
-                if weather_query.lower() == "reset":
-                    user_data = CacheManager.get_user_data(user_id)
-                    user_data['weather_city'] = None
-                    CacheManager.save_cache()
-                    update.message.reply_text(
-                        "🌤️ Your saved weather city has been reset.\n\nUse `@weather <city>` to set a new default city.",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                    return
-
-                # If user provides a city, fetch and cache it
-                if weather_query:
-                    weather_info = bot.get_weather_with_openweather(weather_query, user_id)
-                    update.message.reply_text(weather_info, parse_mode=ParseMode.MARKDOWN)
-                    return
+        with report_failed_sends(update.message, "❌ Error processing your request. Please try again."):
+            # Every text message counts as activity, command or not
+            CacheManager.update_user_activity(update.effective_user.id)
 
-                # If no city provided, try to get from cache
-                cached_city = CacheManager.get_user_weather_city(user_id)
-                if cached_city:
-                    weather_info = bot.get_weather_with_openweather(cached_city, user_id)
-                    update.message.reply_text(weather_info, parse_mode=ParseMode.MARKDOWN)
-                else:
-                    setup_msg = bot.get_weather_setup_message()
-                    update.message.reply_text(setup_msg, parse_mode=ParseMode.MARKDOWN)
-                return
-
-            # Joke command
-            if prompt.startswith("@joke") or prompt.startswith("😄 @joke"):
-                joke = bot.get_joke()
-                update.message.reply_text(joke, parse_mode=ParseMode.MARKDOWN)
-                return
-
-            # Quote command
-            if prompt.startswith("@quote") or prompt.startswith("💭 @quote"):
-                quote = bot.get_quote()
-                update.message.reply_text(quote, parse_mode=ParseMode.MARKDOWN)
-                return
+            # Handle reply for new weather city
+            if sessions.get(update.effective_user.id, 'awaiting_weather_city'):
+                return handle_new_weather_city(update, context)
 
-            # Image command
-            if prompt.startswith("@image") or prompt.startswith("🖼️ @image"):
-                image_query = prompt.replace("🖼️ @image", "").replace("@image", "").strip()
-                if len(image_query) < 3:
-                    update.message.reply_text("🖼️ Please provide a description for the image.")
-                    return
-                try:
-                    response = requests.post("https://api.example.com/generate-image", json={"prompt": image_query}, timeout=10)
-                    if response.status_code == 200:
-                        image_url = response.json().get('image_url')
-                        update.message.reply_photo(photo=image_url, caption="🖼️ Here is your generated image:")
-                    else:
-                        update.message.reply_text("⚠️ Error generating image.")
-                except Exception as e:
-                    logger.error(f"Image generation error: {e}")
-                    update.message.reply_text("⚠️ Error processing your request.")
-                return
+            if update.message and update.message.text:
+                command_router.dispatch(update, context)
 
     except Exception as e:
         logger.error(f"Media logger error: {e}")
         update.message.reply_text("❌ Error processing your request. Please try again.")
 
-# Command handlers
-def song_command(update: Update, context: CallbackContext):
-    """Handle song search and download"""
+def route_command(update: Update, context: CallbackContext):
+    """Entry point for /commands that share the text command handlers"""
+    try:
+        with report_failed_sends(update.message, "❌ Error processing your request. Please try again."):
+            CacheManager.update_user_activity(update.effective_user.id)
+            command_router.dispatch(update, context)
+    except Exception as e:
+        logger.error(f"Command error: {e}")
+        update.message.reply_text("❌ Error processing your request. Please try again.")
+
+def handle_settings(update: Update, context: CallbackContext, args: str = ""):
+    """Show the user's settings with buttons to change them"""
     user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
+    user_data = CacheManager.get_user_data(user_id)
+    variant = 'settings_city' if user_data.get('weather_city') else 'settings_no_city'
+    settings_text = templates.text(
+        'settings',
+        city=user_data.get('weather_city') or "Not set",
+        total_requests=user_data.get('total_requests', 0),
+        language=user_data.get('language_preference', 'English')
+    )
+    update.message.reply_text(settings_text, parse_mode=ParseMode.MARKDOWN, reply_markup=templates.markup(variant))
+
+def handle_stats(update: Update, context: CallbackContext, args: str = ""):
+    """Show the user's usage statistics"""
+    stats_text = bot.get_user_stats(update.effective_user.id)
+    update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+
+def render_song_results(songs: List[Dict]):
+    """Search results message and its download buttons"""
+    keyboard = []
+    for i, song in enumerate(songs):
+        button_text = f"🎵 {song['title'][:30]}{'...' if len(song['title']) > 30 else ''}"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callbacks.encode('s', song['id']))])
+    
+    result_text = f"🎵 **Found {len(songs)} songs:**\n\n"
+    for i, song in enumerate(songs[:3]):
+        result_text += f"**{i+1}.** {song['title']}\n   👤 {song['artist']}\n   💿 {song['album']}\n\n"
     
-    prompt = update.message.text.strip()
-    media_logger(update, context)
+    if len(songs) > 3:
+        result_text += f"*...and {len(songs)-3} more*\n\n"
+    
+    result_text += "🎧 **Click to download:**"
+    return result_text, InlineKeyboardMarkup(keyboard)
 
-def weather_command(update: Update, context: CallbackContext):
-    """Handle weather requests"""
-    user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
+def render_song_variants(song: Dict, download_urls: List[Dict]):
+    """Variant picker message for one song"""
+    keyboard = []
+    for i, url_data in enumerate(download_urls):
+        quality = url_data.get('quality', 'Unknown')
+        language = url_data.get('language', song.get('language', 'Unknown'))
+        button_text = f"{quality} ({language})"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=callbacks.encode('f', song['id'], i))])
+
+    reply_text = f"🎵 **{song['title']}**\n👤 {song['artist']}\n💿 {song['album']}\n\nSelect a file variant to download:"
+    return reply_text, InlineKeyboardMarkup(keyboard)
+
+def parse_song_callback(action: str, fields: List[str]):
+    """(song_id, variant index or None) for a song button, or None if it is malformed"""
+    try:
+        if action == 's':
+            return fields[0], None
+        if action == 'f':
+            return fields[0], int(fields[1])
+    except (IndexError, ValueError):
+        pass
+    return None
+
+def song_caption(record: Dict, quality: str) -> str:
+    """Plain-text caption for a song file"""
+    artist = record.get('artist')
+    if not artist or not artist.strip():
+        artist = 'No Artist'
+    return (
+        f"🎵 {record['title']}\n"
+        f"👤 {artist}\n"
+        f"🎚️ Quality: {quality}\n"
+        f"📅 Year: {record.get('year', 'Unknown')}"
+    )
+
+def render_wikipedia_results(search_results: List[Dict]) -> str:
+    """Top Wikipedia search results as a message"""
+    results_text = "🔍 **Wikipedia Search Results:**\n\n"
+    for result in search_results[:WIKIPEDIA_RESULTS]:
+        title = escape_markdown(result['title'].replace("[", "(").replace("]", ")"))
+        extract = result['extract']
+        if len(extract) > 300:
+            extract = extract[:300].rsplit(" ", 1)[0] + "..."
+        page_id = result['pageid']
+
+        # Add result to the message
+        results_text += f"• [{title}](https://en.wikipedia.org/?curid={page_id})\n  {escape_markdown(extract)}\n\n"
     
-    prompt = update.message.text.strip()
+    results_text += "🔗 Click on the titles to read more on Wikipedia."
+    return results_text
+
+def handle_song_search(update: Update, context: CallbackContext, song_query: str):
+    """Search songs and offer download buttons"""
+    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    
+    if not song_query:
+        update.message.reply_text("🎵 Please provide a song name!\n\n**Example:** `@song Kesariya`", parse_mode=ParseMode.MARKDOWN)
+        return
+    
+    update.message.reply_text(f"🔍 **Searching:** `{song_query}`", parse_mode=ParseMode.MARKDOWN)
     
-    # Directly call media_logger to handle weather as well
-    media_logger(update, context)
+    songs = bot.search_jiosaavn(song_query)
+    
+    if not songs:
+        update.message.reply_text("😔 No songs found. Try a different search term.")
+        return
+    
+    result_text, reply_markup = render_song_results(songs)
+    update.message.reply_text(result_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
 
-def joke_command(update: Update, context: CallbackContext):
-    """Send a random joke"""
+def handle_movie_search(update: Update, context: CallbackContext, movie_query: str):
+    """Search movies and send the top results"""
+    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    
+    if not movie_query:
+        update.message.reply_text("🎬 Please provide a movie name!\n\n**Example:** `@movie Avengers`", parse_mode=ParseMode.MARKDOWN)
+        return
+    
+    update.message.reply_text(f"🔍 **Searching movies:** `{movie_query}`", parse_mode=ParseMode.MARKDOWN)
+    
+    movies = bot.search_movies(movie_query)
+    
+    if not movies:
+        update.message.reply_text("😔 No movies found. Try a different search term.")
+        return
+    
+    send_movie_results(update.message, movies[:3])  # Show top 3 results
+
+def render_movie_card(movie: Dict, limit: int = None) -> str:
+    """Markdown card for one movie; download lines are dropped to fit `limit` characters"""
+    movie_text = f"🎬 **{movie['title']} ({movie['year']})**\n\n"
+    movie_text += f"⭐ **Rating:** {movie['rating']}/10\n"
+    movie_text += f"🎭 **Genres:** {movie['genres']}\n"
+    movie_text += f"⏱️ **Runtime:** {movie['runtime']}\n\n"
+    movie_text += f"📖 **Summary:** {movie['summary']}\n\n"
+
+    # Add download links
+    if movie['torrents']:
+        lines = []
+        for torrent in movie['torrents']:
+            quality = torrent.get('quality', 'Unknown')
+            size = torrent.get('size', 'Unknown')
+            lines.append(f"• **{quality}** ({size}) - [Magnet Link](magnet:?xt=urn:btih:{torrent.get('hash', '')})\n")
+        while lines and limit and len(movie_text) + len("📥 **Download Options:**\n") + sum(map(len, lines)) > limit:
+            lines.pop()
+        if lines:
+            movie_text += "📥 **Download Options:**\n" + "".join(lines)
+    return movie_text
+
+def imdb_button(movie: Dict, label: str = "🎭 View on IMDb") -> List[InlineKeyboardButton]:
+    return [InlineKeyboardButton(label, url=f"https://www.imdb.com/title/{movie['imdb_code']}")]
+
+def send_movie_results(message, movies: List[Dict]):
+    """Send movie cards: posters as one media group, the rest as text.
+
+    Posters Telegram has already fetched are sent by file_id. Media groups
+    cannot carry buttons, so IMDb links for the posters follow in one message.
+    """
+    posters = [movie for movie in movies if movie['poster']]
+    posters_sent = False
+    if len(posters) == 1:
+        # A media group needs at least two items
+        posters_sent = send_movie_poster(message, posters[0])
+    elif posters:
+        posters_sent = send_movie_album(message, posters)
+        linked = [movie for movie in posters if movie['imdb_code']]
+        if posters_sent and linked:
+            message.reply_text(
+                "🎭 **View on IMDb:**", parse_mode=ParseMode.MARKDOWN,
+                reply_markup=InlineKeyboardMarkup([imdb_button(movie, f"🎭 {movie['title']}") for movie in linked])
+            )
+
+    for movie in movies:
+        if movie['poster'] and posters_sent:
+            continue
+        reply_markup = InlineKeyboardMarkup([imdb_button(movie)]) if movie['imdb_code'] else None
+        message.reply_text(render_movie_card(movie), parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+
+def send_movie_poster(message, movie: Dict) -> bool:
+    """One movie card as a photo; False if it could not be sent"""
+    reply_markup = InlineKeyboardMarkup([imdb_button(movie)]) if movie['imdb_code'] else None
+    caption = render_movie_card(movie, limit=1024)
+    file_id = bot.file_ids.get('poster', movie['poster'])
+    for photo in ([file_id] if file_id else []) + [movie['poster']]:
+        try:
+            sent = send_result(message.reply_photo(
+                photo=photo, caption=caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup
+            ))
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Poster send failed for {movie['poster']}: {e}")
+            if photo == file_id:
+                bot.file_ids.delete('poster', movie['poster'])
+            continue
+        if sent and sent.photo and photo != file_id:
+            bot.file_ids.put('poster', movie['poster'], sent.photo[-1].file_id, sent.photo[-1].file_size)
+        return True
+    return False
+
+def send_movie_album(message, movies: List[Dict]) -> bool:
+    """Movie cards as one media group; False if it could not be sent"""
+    file_ids = {movie['poster']: bot.file_ids.get('poster', movie['poster']) for movie in movies}
+    for reuse in ((True, False) if any(file_ids.values()) else (False,)):
+        media = [
+            InputMediaPhoto(
+                media=(file_ids[movie['poster']] if reuse else None) or movie['poster'],
+                caption=render_movie_card(movie, limit=1024), parse_mode=ParseMode.MARKDOWN
+            )
+            for movie in movies
+        ]
+        try:
+            sent = send_result(message.reply_media_group(media=media))
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Movie album send failed: {e}")
+            if reuse:
+                # One stale file_id fails the whole group; forget them and retry with URLs
+                for poster, file_id in file_ids.items():
+                    if file_id:
+                        bot.file_ids.delete('poster', poster)
+            continue
+        for movie, item in zip(movies, sent or []):
+            if item.photo and not (reuse and file_ids[movie['poster']]):
+                bot.file_ids.put('poster', movie['poster'], item.photo[-1].file_id, item.photo[-1].file_size)
+        return True
+    return False
+
+def handle_weather(update: Update, context: CallbackContext, weather_query: str):
+    """Weather for a city, the saved city, or reset the saved city"""
     user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
+    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
     
+    # Handle weather reset
+    if weather_query.lower() == "reset":
+        user_data = CacheManager.get_user_data(user_id)
+        user_data['weather_city'] = None
+        CacheManager.save_user(user_id)
+        update.message.reply_text(
+            "🌤️ Your saved weather city has been reset.\n\nUse `@weather <city>` to set a new default city.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+
+    # If user provides a city, fetch and cache it
+    if weather_query:
+        weather_info = bot.get_weather_with_openweather(weather_query, user_id)
+        update.message.reply_text(weather_info, parse_mode=ParseMode.MARKDOWN)
+        return
+
+    # If no city provided, try to get from cache
+    cached_city = CacheManager.get_user_weather_city(user_id)
+    if cached_city:
+        weather_info = bot.get_weather_with_openweather(cached_city, user_id)
+        update.message.reply_text(weather_info, parse_mode=ParseMode.MARKDOWN)
+    else:
+        setup_msg = bot.get_weather_setup_message()
+        update.message.reply_text(setup_msg, parse_mode=ParseMode.MARKDOWN)
+
+def handle_joke(update: Update, context: CallbackContext, args: str = ""):
+    """Send a random joke"""
     joke = bot.get_joke()
     update.message.reply_text(joke, parse_mode=ParseMode.MARKDOWN)
 
-def quote_command(update: Update, context: CallbackContext):
+def handle_quote(update: Update, context: CallbackContext, args: str = ""):
     """Send an inspirational quote"""
-    user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
-    
     quote = bot.get_quote()
     update.message.reply_text(quote, parse_mode=ParseMode.MARKDOWN)
 
-def movie_command(update: Update, context: CallbackContext):
-    """Handle movie search"""
-    user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
-    
-    prompt = update.message.text.strip()
-    media_logger(update, context)
-
-def w_command(update: Update, context: CallbackContext):
-    """Handle Wikipedia search"""
-    user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
-    
-    prompt = update.message.text.strip()
-    
-    if len(prompt) < 3:
-        update.message.reply_text("🔍 Please provide a longer search term for Wikipedia.")
+def handle_image(update: Update, context: CallbackContext, image_query: str):
+    """Handle AI image generation"""
+    if len(image_query) < 3:
+        update.message.reply_text("🖼️ Please provide a description for the image.")
         return
-    
     try:
-        url = f"https://en.wikipedia.org/w/api.php?action=query&format=json&list=search&srsearch={quote(prompt)}&utf8=1"
-        response = requests.get(url, timeout=10)
-        
+        # Call to an AI image generation API (placeholder)
+        response = bot.http.post("https://api.example.com/generate-image", upstream='image', json={"prompt": image_query})
         if response.status_code == 200:
-            data = response.json()
-            search_results = data.get('query', {}).get('search', [])
-            
-            if not search_results:
-                update.message.reply_text("🔍 No results found on Wikipedia.")
-                return
-            
-            # Prepare the message with search results
-            results_text = "🔍 **Wikipedia Search Results:**\n\n"
-            for result in search_results[:5]:  # Limit to top 5 results
-                title = result['title']
-                snippet = result['snippet']
-                page_id = result['pageid']
-                
-                # Add result to the message
-                results_text += f"• [{title}](https://en.wikipedia.org/?curid={page_id})\n  {snippet}...\n\n"
-            
-            results_text += "🔗 Click on the titles to read more on Wikipedia."
-            update.message.reply_text(results_text, parse_mode=ParseMode.MARKDOWN)
+            image_url = response.json().get('image_url')
+            send_result(update.message.reply_photo(photo=image_url, caption="🖼️ Here is your generated image:"))
         else:
-            update.message.reply_text("⚠️ Error fetching data from Wikipedia.")
+            update.message.reply_text("⚠️ Error generating image.")
     except Exception as e:
-        logger.error(f"Wikipedia search error: {e}")
+        logger.error(f"Image generation error: {e}")
         update.message.reply_text("⚠️ Error processing your request.")
 
-def image_command(update: Update, context: CallbackContext):
-    """Handle AI image generation"""
-    user_id = update.effective_user.id
-    CacheManager.update_user_activity(user_id)
-    
-    prompt = update.message.text.strip()
-    
-    if len(prompt) < 3:
-        update.message.reply_text("🖼️ Please provide a description for the image.")
+def handle_wikipedia(update: Update, context: CallbackContext, search_query: str):
+    """Handle Wikipedia search"""
+    if len(search_query) < 3:
+        update.message.reply_text("🔍 Please provide a longer search term for Wikipedia.")
         return
     
     try:
-        # Call to an AI image generation API (placeholder)
-        response = requests.post("https://api.example.com/generate-image", json={"prompt": prompt}, timeout=10)
+        status_code, search_results = bot.search_wikipedia(search_query)
         
-        if response.status_code == 200:
-            image_url = response.json().get('image_url')
-            update.message.reply_photo(photo=image_url, caption="🖼️ Here is your generated image:")
+        if status_code == 200:
+            if not search_results:
+                update.message.reply_text("🔍 No results found on Wikipedia.")
+                return
+            
+            results_text = render_wikipedia_results(search_results)
+            update.message.reply_text(results_text, parse_mode=ParseMode.MARKDOWN)
         else:
-            update.message.reply_text("⚠️ Error generating image.")
+            update.message.reply_text("⚠️ Error fetching data from Wikipedia.")
     except Exception as e:
-        logger.error(f"Image generation error: {e}")
+        logger.error(f"Wikipedia search error: {e}")
         update.message.reply_text("⚠️ Error processing your request.")
 
+# Text commands, reachable as "@cmd", "<emoji> @cmd" and "/cmd"
+command_router = CommandRouter()
+command_router.register("help", handle_help)
+command_router.register("settings", handle_settings)
+command_router.register("stats", handle_stats)
+command_router.register("song", handle_song_search)
+command_router.register("movie", handle_movie_search)
+command_router.register("weather", handle_weather)
+command_router.register("joke", handle_joke)
+command_router.register("quote", handle_quote)
+command_router.register("image", handle_image)
+command_router.register("w", handle_wikipedia)
+
 def health_command(update: Update, context: CallbackContext):
     """Send health tips"""
     user_id = update.effective_user.id
     CacheManager.update_user_activity(user_id)
     
-    tips = bot.health_tips
-    health_text = "💊 **Health Tips:**\n\n"
-    health_text += "\n".join([f"• {tip}" for tip in tips])
-    
-    health_text += "\n\n🏥 **For emergencies, use `@emergency` to get contact numbers.**"
-    update.message.reply_text(health_text, parse_mode=ParseMode.MARKDOWN)
+    update.message.reply_text(templates.text('health'), parse_mode=ParseMode.MARKDOWN)
 
 def settings_command(update: Update, context: CallbackContext):
     """Handle settings management"""
@@ -900,7 +3716,7 @@ def settings_command(update: Update, context: CallbackContext):
             # Reset weather city
             user_data = CacheManager.get_user_data(user_id)
             user_data['weather_city'] = None
-            CacheManager.save_cache()
+            CacheManager.save_user(user_id)
             update.message.reply_text(
                 "🌤️ Your weather city has been reset. You can set a new city using `@weather <city>`.",
                 parse_mode=ParseMode.MARKDOWN
@@ -914,29 +3730,7 @@ def settings_command(update: Update, context: CallbackContext):
             return
     
     # Default settings response
-    user_data = CacheManager.get_user_data(user_id)
-    settings_text = "⚙️ **Bot Settings:**\n\n"
-    
-    if user_data.get('weather_city'):
-        settings_text += f"🌤️ **Weather City:** {user_data['weather_city']}\n"
-        keyboard = [
-            [InlineKeyboardButton("🌍 Change Weather City", callback_data="change_weather_city")],
-            [InlineKeyboardButton("🗑️ Reset Weather City", callback_data="reset_weather_city")],
-            [InlineKeyboardButton("📊 View Statistics", callback_data="view_stats")]
-        ]
-    else:
-        settings_text += f"🌤️ **Weather City:** Not set\n"
-        keyboard = [
-            [InlineKeyboardButton("🌍 Set Weather City", callback_data="set_weather_city")],
-            [InlineKeyboardButton("📊 View Statistics", callback_data="view_stats")]
-        ]
-    
-    settings_text += f"🎯 **Total Requests:** {user_data.get('total_requests', 0)}\n"
-    settings_text += f"🌐 **Language:** {user_data.get('language_preference', 'English')}\n\n"
-    settings_text += "Click the buttons below to modify your settings:"
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text(settings_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+    handle_settings(update, context)
 
 def set_weather_city_command(update: Update, context: CallbackContext):
     """Set the weather city"""
@@ -965,7 +3759,7 @@ def reset_weather_city_command(update: Update, context: CallbackContext):
     # Reset city in cache
     user_data = CacheManager.get_user_data(user_id)
     user_data['weather_city'] = None
-    CacheManager.save_cache()
+    CacheManager.save_user(user_id)
     
     update.message.reply_text("🌤️ Your weather city has been reset. You can set a new city using `@weather <city>`.")
 
@@ -974,105 +3768,1224 @@ def view_stats_command(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     CacheManager.update_user_activity(user_id)
     
-    stats_text = bot.get_user_stats(user_id)
-    update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+    handle_stats(update, context)
+
+def send_song_audio(message, song_id: str, quality: str, file_url: str, caption: str):
+    """Send a song, reusing the Telegram file_id from an earlier upload when there is one"""
+    key = f"{song_id}:{quality}"
+    file_id = bot.file_ids.get('audio', key)
+    if file_id:
+        try:
+            send_result(message.reply_audio(audio=file_id, caption=caption, parse_mode=None))
+            return
+        except telegram.error.BadRequest as e:
+            # The file_id is no longer valid; fall back to the CDN URL
+            logger.warning(f"Stale audio file_id for {key}: {e}")
+            bot.file_ids.delete('audio', key)
+
+    sent = send_result(message.reply_audio(audio=file_url, caption=caption, parse_mode=None))
+    if sent and sent.audio:
+        bot.file_ids.put('audio', key, sent.audio.file_id, sent.audio.file_size)
+
+# Song buttons: compact payloads ("s1:<song_id>", "f1:<song_id>:<variant>") plus
+# buttons from older messages
+SONG_CALLBACK = re.compile(r'^(?:[sf]\d[:~]|download_song:|download_file:)')
 
 def song_download_callback(update: Update, context: CallbackContext):
     """Handle song result button click, show variants, and send file"""
     query = update.callback_query
-    user_id = query.from_user.id
     query.answer()
-    data = query.data
+    payload = callbacks.decode(query.data)
+    parsed = parse_song_callback(*payload) if payload else None
+    if parsed is None:
+        query.message.reply_text("⌛ This button has expired. Please search again.")
+        return
+    song_id, variant_idx = parsed
+
+    # Song picked from the results: show all available variants (qualities/languages)
+    if variant_idx is None:
+        record = bot.get_song_record(song_id)
+        download_urls = record.get('download_urls', []) if record else []
+
+        if not download_urls:
+            query.message.reply_text("❌ No download links found for this song.")
+            return
+
+        reply_text, reply_markup = render_song_variants(record, download_urls)
+        query.message.reply_text(reply_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+        return
+
+    # Variant picked: send the file
+    try:
+        record = bot.get_song_record(song_id)
+        download_urls = record.get('download_urls', []) if record else []
+        if 0 <= variant_idx < len(download_urls):
+            file_url = download_urls[variant_idx].get('url')
+            quality = download_urls[variant_idx].get('quality', 'Unknown')
+            safe_caption = song_caption(record, quality)
+            send_song_audio(query.message, song_id, quality, file_url, safe_caption)
+            return
+    except Exception as e:
+        logger.error(f"Error sending song file: {e}")
+    query.message.reply_text("❌ Could not download this file.")
+
+class UpdateWorkerPool:
+    """Bounded queue of webhook updates processed by worker threads.
+
+    Updates are grouped per chat: a chat is only ever handled by one worker at
+    a time, so messages from the same chat keep their order, while different
+    chats run in parallel.
+    """
+
+    def __init__(self, handler: Callable, workers: int = UPDATE_WORKERS, max_queue: int = UPDATE_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self._cond = threading.Condition()
+        self._pending = {}        # chat key -> deque of (enqueued_at, update, trace)
+        self._ready = deque()     # chat keys waiting for a worker
+        self._scheduled = set()   # chat keys either ready or being processed
+        self._depth = 0
+        self._reserved = 0        # slots held for updates already acknowledged elsewhere
+        self._busy = 0
+        self._threads = []
+        self._running = False
+
+        # Metrics
+        self.wait_time = LatencyHistogram()
+        self.processing_time = LatencyHistogram()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth_seen = 0
+
+    def start(self):
+        """Start the worker threads"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"update-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Update worker pool started: {self.workers} workers, queue size {self.max_queue}")
+
+    def stop(self, timeout: float = 10.0):
+        """Stop accepting updates and let workers drain what is queued"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    def reserve(self) -> bool:
+        """Hold a queue slot for an update that will be submitted later; False when full.
+
+        The webhook reserves before answering Telegram, so an update handed
+        over after the 200 (by the asyncio core) always has room.
+        """
+        with self._cond:
+            if not self._running or self._depth + self._reserved >= self.max_queue:
+                self.rejected += 1
+                return False
+            self._reserved += 1
+            return True
+
+    def release(self):
+        """Give back a reserved slot that will not be used"""
+        with self._cond:
+            self._reserved -= 1
+
+    def submit(self, chat_key, update, trace: Trace = None, reserved: bool = False) -> bool:
+        """Queue an update; returns False when the queue is full (backpressure).
+
+        With `reserved` the update takes the slot held by an earlier
+        reserve(). An accepted update's trace is released once the update is
+        handled.
+        """
+        with self._cond:
+            if reserved:
+                self._reserved -= 1
+            if not self._running or (not reserved and self._depth + self._reserved >= self.max_queue):
+                self.rejected += 1
+                return False
+            self._pending.setdefault(chat_key, deque()).append((time.monotonic(), update, trace))
+            self._depth += 1
+            self.accepted += 1
+            self.max_depth_seen = max(self.max_depth_seen, self._depth)
+            if chat_key not in self._scheduled:
+                self._scheduled.add(chat_key)
+                self._ready.append(chat_key)
+                self._cond.notify()
+        return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                chat_key = self._ready.popleft()
+                enqueued_at, update, trace = self._pending[chat_key].popleft()
+                self._depth -= 1
+                self._busy += 1
+
+            started = time.monotonic()
+            self.wait_time.observe(started - enqueued_at)
+            token = current_trace.set(trace)
+            if trace is not None:
+                trace.add('queue.wait', enqueued_at, started - enqueued_at)
+            failed = False
+            try:
+                with trace_span('dispatch'):
+                    self.handler(update)
+            except Exception as e:
+                failed = True
+                logger.error(f"Update worker error{f' [{trace.trace_id}]' if trace else ''}: {e}")
+            finally:
+                current_trace.reset(token)
+                if trace is not None:
+                    trace.release()
+            self.processing_time.observe(time.monotonic() - started)
+
+            with self._cond:
+                self._busy -= 1
+                self.processed += 1
+                self.failed += failed
+                if self._pending[chat_key]:
+                    # More updates from the same chat arrived meanwhile
+                    self._ready.append(chat_key)
+                    self._cond.notify()
+                else:
+                    del self._pending[chat_key]
+                    self._scheduled.discard(chat_key)
+
+    def stats(self) -> Dict:
+        """Queue depth, throughput and wait time"""
+        with self._cond:
+            depth, reserved, busy, chats = self._depth, self._reserved, self._busy, len(self._pending)
+        return {
+            'workers': self.workers,
+            'busy_workers': busy,
+            'queue_depth': depth,
+            'queue_reserved': reserved,
+            'queue_capacity': self.max_queue,
+            'max_depth_seen': self.max_depth_seen,
+            'chats_pending': chats,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'wait_time': self.wait_time.snapshot(),
+            'processing_time': self.processing_time.snapshot()
+        }
+
+def get_update_chat_key(update: Update):
+    """Ordering key for an update: the chat, else the user, else the update itself"""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+class TokenBucket:
+    """Token bucket; not thread-safe, callers hold their own lock"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
 
-    # Expect callback_data like "download_song:0"
-    if data.startswith("download_song:"):
-        idx = int(data.split(":")[1])
-        songs = context.user_data.get('songs', [])
-        if idx < 0 or idx >= len(songs):
-            query.message.reply_text("❌ Song not found.")
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class SendScheduler:
+    """Rate-limited queue for outgoing Telegram calls.
+
+    Sends are queued per chat and released by a dispatcher thread when both
+    the global and the chat's token bucket allow it; a small pool performs
+    the HTTP calls. Each chat has at most one send in flight, so its
+    messages keep their order. A RetryAfter (429) pauses the chat for the
+    time Telegram asks and the send is retried. A chat action is dropped
+    when a message for the same chat is already queued behind it, since the
+    message makes the "typing..." indicator redundant.
+    """
+
+    def __init__(self, workers: int = SEND_WORKERS, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, group_rate: float = TELEGRAM_GROUP_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST, max_retries: int = SEND_MAX_RETRIES):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1, global_rate))
+        self._chats = {}      # chat id -> _Chat
+        self._ready = []      # heap of (not_before, seq, chat id)
+        self._seq = 0
+        self._prune_at = 1024
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._running = False
+
+        # Metrics
+        self.queue_latency = LatencyHistogram()
+        self.send_latency = LatencyHistogram()
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.retry_after = 0
+        self.retry_after_seconds = 0.0
+
+    class _Chat:
+        __slots__ = ('queue', 'bucket', 'paused_until', 'busy', 'scheduled')
+
+        def __init__(self, bucket: TokenBucket):
+            self.queue = deque()
+            self.bucket = bucket
+            self.paused_until = 0.0
+            self.busy = False
+            self.scheduled = False
+
+    class _Send:
+        __slots__ = ('fn', 'args', 'kwargs', 'future', 'chat_action', 'queued', 'attempts', 'trace')
+
+        def __init__(self, fn: Callable, args: tuple, kwargs: Dict, chat_action: bool):
+            self.fn = fn
+            self.args = args
+            self.kwargs = kwargs
+            self.future = Future()
+            self.chat_action = chat_action
+            self.queued = time.monotonic()
+            self.attempts = 0
+            # The update's trace stays open until its sends are done
+            self.trace = current_trace.get()
+            if self.trace is not None:
+                self.trace.hold()
+
+        def done(self):
+            if self.trace is not None:
+                self.trace.release()
+                self.trace = None
+
+    def _chat(self, chat_id) -> '_Chat':
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            chat = self._Chat(TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst))
+            self._chats[chat_id] = chat
+        return chat
+
+    def _schedule(self, chat_id, chat: '_Chat', not_before: float):
+        if not chat.scheduled and not chat.busy and chat.queue:
+            chat.scheduled = True
+            self._seq += 1
+            heapq.heappush(self._ready, (not_before, self._seq, chat_id))
+            self._cond.notify()
+
+    def submit(self, chat_id, fn: Callable, /, *args, chat_action: bool = False, **kwargs) -> Future:
+        """Queue `fn(*args, **kwargs)` as a send to `chat_id` and return its Future"""
+        item = self._Send(fn, args, kwargs, chat_action)
+        if not self._running:
+            # Not started (scripts, tests): send inline
+            self._run(chat_id, item, inline=True)
+            return item.future
+        with self._cond:
+            chat = self._chat(chat_id)
+            if chat_action and chat.queue:
+                # Something is already queued for this chat; the action adds nothing
+                self.coalesced += 1
+                item.future.set_result(None)
+                item.done()
+                return item.future
+            chat.queue.append(item)
+            self.submitted += 1
+            self._schedule(chat_id, chat, chat.paused_until)
+        return item.future
+
+    def start(self):
+        if self._thread:
             return
+        self._running = True
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="telegram-send")
+        self._thread = threading.Thread(target=self._dispatch, name="send-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Send what is queued (within `timeout`) and stop"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while any(chat.queue or chat.busy for chat in self._chats.values()) and time.monotonic() < deadline:
+                self._cond.wait(0.05)
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout=1)
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                not_before, _, chat_id = self._ready[0]
+                if not_before > now:
+                    self._cond.wait(not_before - now)
+                    continue
+                chat = self._chats[chat_id]
+                item = chat.queue[0]
+                if item.chat_action and len(chat.queue) > 1:
+                    # A message is queued behind it, so the action adds nothing
+                    chat.queue.popleft()
+                    self.coalesced += 1
+                    item.future.set_result(None)
+                    item.done()
+                    continue
+                chat_wait = max(chat.paused_until - now, 0.0 if item.chat_action else chat.bucket.delay(now))
+                if chat_wait > 0:
+                    # Only this chat has to wait; move it back so other chats go first
+                    self._seq += 1
+                    heapq.heapreplace(self._ready, (now + chat_wait, self._seq, chat_id))
+                    continue
+                global_wait = self._global.delay(now)
+                if global_wait > 0:
+                    self._cond.wait(global_wait)
+                    continue
+                heapq.heappop(self._ready)
+                chat.scheduled = False
+                chat.queue.popleft()
+                self._global.take(now)
+                if not item.chat_action:
+                    chat.bucket.take(now)
+                chat.busy = True
+            self._executor.submit(self._run, chat_id, item)
 
-        song = songs[idx]
-        # Show all available variants (qualities/languages)
-        download_urls = []
-        # Fetch fresh details to get all variants
+    def _run(self, chat_id, item: '_Send', inline: bool = False):
+        started = time.monotonic()
+        if item.attempts == 0:
+            self.queue_latency.observe(started - item.queued)
+            if item.trace is not None:
+                item.trace.add('telegram.queue', item.queued, started - item.queued)
+        item.attempts += 1
+        retry_after = None
+        token = current_trace.set(item.trace)
         try:
-            detail_url = f"https://jiosavan-api-with-playlist.vercel.app/api/songs/{song['id']}"
-            detail_response = requests.get(detail_url, timeout=10)
-            if detail_response.status_code == 200:
-                detail_data = detail_response.json()
-                if 'data' in detail_data and detail_data['data']:
-                    song_detail = detail_data['data'][0]
-                    download_urls = song_detail.get('downloadUrl', [])
+            result = item.fn(*item.args, **item.kwargs)
+        except telegram.error.RetryAfter as e:
+            self.retry_after += 1
+            self.retry_after_seconds += e.retry_after
+            if inline or item.attempts > self.max_retries:
+                self.failed += 1
+                item.future.set_exception(e)
+            else:
+                retry_after = e.retry_after
+                logger.warning(f"Telegram asked to retry chat {chat_id} after {e.retry_after}s")
         except Exception as e:
-            logger.error(f"Error fetching song details for variants: {e}")
-
-        if not download_urls:
-            query.message.reply_text("❌ No download links found for this song.")
+            self.failed += 1
+            item.future.set_exception(e)
+            logger.warning(f"Send to chat {chat_id} failed: {e}")
+        else:
+            self.sent += 1
+            item.future.set_result(result)
+        finally:
+            current_trace.reset(token)
+            self.send_latency.observe(time.monotonic() - started)
+            if retry_after is None:
+                item.done()
+        if inline:
             return
+        with self._cond:
+            chat = self._chats[chat_id]
+            chat.busy = False
+            now = time.monotonic()
+            if retry_after is not None:
+                chat.paused_until = now + retry_after
+                chat.queue.appendleft(item)
+            self._schedule(chat_id, chat, chat.paused_until)
+            if not chat.queue and chat.bucket.full(now) and chat.paused_until <= now:
+                del self._chats[chat_id]
+            self._cond.notify_all()
 
-        # Show all variants as buttons
-        keyboard = []
-        for i, url_data in enumerate(download_urls):
-            quality = url_data.get('quality', 'Unknown')
-            language = url_data.get('language', song.get('language', 'Unknown'))
-            button_text = f"{quality} ({language})"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"download_file:{song['id']}:{i}")])
+    def reserve(self, chat_id, chat_action: bool = False) -> Optional[float]:
+        """Non-queuing admission for callers that wait themselves (the asyncio core).
 
-        reply_text = f"🎵 **{song['title']}**\n👤 {song['artist']}\n💿 {song['album']}\n\nSelect a file variant to download:"
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.message.reply_text(reply_text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+        Returns 0 once tokens are taken, otherwise how long to wait before
+        asking again; chat actions that cannot go out right away get None
+        and should be skipped.
+        """
+        with self._cond:
+            now = time.monotonic()
+            if len(self._chats) > self._prune_at:
+                self._prune(now)
+            chat = self._chat(chat_id)
+            wait = max(chat.paused_until - now, self._global.delay(now))
+            if not chat_action:
+                wait = max(wait, chat.bucket.delay(now))
+            if wait > 0:
+                if chat_action:
+                    self.coalesced += 1
+                    return None
+                return wait
+            self._global.take(now)
+            if not chat_action:
+                chat.bucket.take(now)
+            return 0.0
+
+    def _prune(self, now: float):
+        """Forget chats with nothing queued and a full bucket (caller holds the lock)"""
+        for chat_id, chat in list(self._chats.items()):
+            if not chat.queue and not chat.busy and chat.paused_until <= now and chat.bucket.full(now):
+                del self._chats[chat_id]
+        self._prune_at = max(1024, 2 * len(self._chats))
+
+    def record(self, chat_id, queued: float, started: float, retry_after: float = None, failed: bool = False):
+        """Account a send made through reserve()"""
+        now = time.monotonic()
+        with self._cond:
+            self.queue_latency.observe(started - queued)
+            self.send_latency.observe(now - started)
+            if retry_after is not None:
+                self.retry_after += 1
+                self.retry_after_seconds += retry_after
+                self._chat(chat_id).paused_until = now + retry_after
+            elif failed:
+                self.failed += 1
+            else:
+                self.sent += 1
+
+    def stats(self) -> Dict:
+        with self._cond:
+            queued = sum(len(chat.queue) for chat in self._chats.values())
+            chats = len(self._chats)
+        return {
+            'queued': queued,
+            'chats_tracked': chats,
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'failed': self.failed,
+            'coalesced_chat_actions': self.coalesced,
+            'retry_after_429': self.retry_after,
+            'retry_after_seconds': round(self.retry_after_seconds, 3),
+            'queue_latency': self.queue_latency.snapshot(),
+            'send_latency': self.send_latency.snapshot()
+        }
+
+send_scheduler = SendScheduler()
+
+# Sends queued by the command being routed, see report_failed_sends
+routed_sends = contextvars.ContextVar('routed_sends', default=None)
+
+class ScheduledBot(telegram.Bot):
+    """telegram.Bot whose message sends go through the SendScheduler.
+
+    The send methods return a Future instead of the Message; handlers that
+    need the sent message, or handle a failed send themselves, call
+    send_result() on it.
+    """
+
+    def __init__(self, *args, scheduler: SendScheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def _post(self, endpoint: str, *args, **kwargs):
+        # Every Bot API call passes through here, queued sends included
+        with trace_span(f"telegram.{endpoint}"):
+            return super()._post(endpoint, *args, **kwargs)
+
+    def _queue(self, method: Callable, args: tuple, kwargs: Dict, chat_action: bool = False) -> Future:
+        chat_id = kwargs.get('chat_id', args[0] if args else None)
+        future = self.scheduler.submit(chat_id, method, *args, chat_action=chat_action, **kwargs)
+        sends = routed_sends.get()
+        if sends is not None and not chat_action:
+            sends.append(future)
+        return future
+
+    def send_message(self, *args, **kwargs):
+        return self._queue(super().send_message, args, kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        return self._queue(super().send_photo, args, kwargs)
+
+    def send_audio(self, *args, **kwargs):
+        return self._queue(super().send_audio, args, kwargs)
+
+    def send_media_group(self, *args, **kwargs):
+        return self._queue(super().send_media_group, args, kwargs)
+
+    def send_chat_action(self, *args, **kwargs):
+        return self._queue(super().send_chat_action, args, kwargs, chat_action=True)
+
+def send_result(result, timeout: float = 120):
+    """The Message from a send, waiting for it if the send was queued.
+
+    A failed send raises here, and is then the caller's to handle rather
+    than report_failed_sends'.
+    """
+    if not isinstance(result, Future):
+        return result
+    sends = routed_sends.get()
+    if sends is not None and result in sends:
+        sends.remove(result)
+    return result.result(timeout)
+
+@contextmanager
+def report_failed_sends(message, text: str):
+    """Reply `text` once if a send queued inside the block fails.
+
+    Queued sends don't raise in the handler, so without this a message
+    Telegram rejects (broken Markdown, a bad photo URL) would only be logged.
+    """
+    sends = []
+    token = routed_sends.set(sends)
+    try:
+        yield
+    finally:
+        routed_sends.reset(token)
+    if not sends:
         return
+    lock = threading.Lock()
+    reported = []
+
+    def check(sent: Future):
+        error = sent.exception()
+        if error is None:
+            return
+        with lock:
+            if reported:
+                return
+            reported.append(error)
+        logger.error(f"Send failed: {error}")
+        message.reply_text(text)
+
+    for sent in sends:
+        sent.add_done_callback(check)
+
+class AsyncHttpClient:
+    """httpx counterpart of HttpClient used by the asyncio core"""
+
+    def __init__(self, timeouts: Dict = None, retries: int = HTTP_RETRIES,
+                 backoff_base: float = HTTP_BACKOFF_BASE, backoff_max: float = HTTP_BACKOFF_MAX,
+                 max_connections: int = ASYNC_HTTP_CONNECTIONS, breakers: BreakerRegistry = None,
+                 transport: httpx.AsyncBaseTransport = None):
+        self.timeouts = dict(UPSTREAM_TIMEOUTS if timeouts is None else timeouts)
+        self.breakers = circuit_breakers if breakers is None else breakers
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_connections = max_connections
+        self.transport = transport  # None: httpx's own connection pool
+        self._client = None
+        self._slots = None
+        self._host_stats = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created lazily so it binds to the running event loop
+        if self._client is None:
+            # Requests wait here rather than in httpcore's pool, whose queue scan
+            # grows with waiters times connections
+            self._slots = asyncio.Semaphore(self.max_connections)
+            self._client = httpx.AsyncClient(
+                headers={'User-Agent': 'SparkBot/1.0'},
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                transport=self.transport
+            )
+        return self._client
+
+    def _record(self, host: str, field: str):
+        stats = self._host_stats.setdefault(host, {'requests': 0, 'errors': 0, 'retries': 0, 'short_circuited': 0})
+        stats[field] += 1
+
+    _admit = HttpClient._admit
+    _backoff = HttpClient._backoff
+    _retry_delay = HttpClient._retry_delay
+    _bounded = staticmethod(HttpClient._bounded)
+
+    async def request(self, method: str, url: str, upstream: str = 'default', timeout=None,
+                      retries: int = None, deadline: float = None, **kwargs) -> httpx.Response:
+        """Send a request, retrying connection failures and retryable statuses (see HttpClient.request)"""
+        host = urlsplit(url).netloc
+        timeout = timeout or self.timeouts.get(upstream, self.timeouts['default'])
+        if retries is None:
+            retries = self.retries if method.upper() == 'GET' else 0
+        breaker = self.breakers.get(host, upstream)
+
+        for attempt in range(retries + 1):
+            self._admit(breaker, host, upstream)
+            if attempt:
+                self._record(host, 'retries')
+            self._record(host, 'requests')
+            started = time.monotonic()
+            try:
+                client = self._get_client()
+                async with self._slots:
+                    connect, read = self._bounded(timeout, deadline)
+                    response = await client.request(
+                        method, url, timeout=httpx.Timeout(read, connect=connect), **kwargs
+                    )
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                observe_upstream(upstream, started, True, attempt=attempt, error=type(e).__name__)
+                self._record(host, 'errors')
+                if breaker:
+                    breaker.failure(str(e) or type(e).__name__)
+                delay = self._retry_delay(attempt, retries, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except httpx.HTTPError as e:
+                observe_upstream(upstream, started, True, attempt=attempt, error=type(e).__name__)
+                self._record(host, 'errors')
+                if breaker:
+                    breaker.failure(str(e) or type(e).__name__)
+                raise
+
+            failed = response.status_code in HttpClient.RETRY_STATUSES or response.status_code >= 500
+            observe_upstream(upstream, started, failed, attempt=attempt, status=response.status_code)
+            if breaker:
+                if failed:
+                    breaker.failure(f"HTTP {response.status_code}")
+                else:
+                    breaker.success(time.monotonic() - started)
+            delay = (self._retry_delay(attempt, retries, deadline)
+                     if response.status_code in HttpClient.RETRY_STATUSES else None)
+            if delay is not None:
+                self._record(host, 'errors')
+                await asyncio.sleep(delay)
+                continue
+            if response.status_code >= 500:
+                self._record(host, 'errors')
+            return response
+
+    async def get(self, url: str, upstream: str = 'default', **kwargs) -> httpx.Response:
+        return await self.request('GET', url, upstream=upstream, **kwargs)
+
+    async def post(self, url: str, upstream: str = 'default', **kwargs) -> httpx.Response:
+        return await self.request('POST', url, upstream=upstream, **kwargs)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict:
+        # Called from the threadpool while the loop may be adding hosts
+        return {host: dict(values) for host, values in list(self._host_stats.items())}
+
+class AsyncTelegramAPI:
+    """Minimal awaitable Telegram Bot API client"""
+
+    def __init__(self, token: str, http: AsyncHttpClient, base_url: str = TELEGRAM_API_BASE,
+                 scheduler: SendScheduler = None):
+        self.http = http
+        self.url = f"{base_url}{token}/"
+        self.scheduler = scheduler
+
+    async def call(self, method: str, **params):
+        """Call a Bot API method and return its result, raising telegram.error types on failure"""
+        payload = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            payload[key] = value.to_dict() if isinstance(value, ReplyMarkup) else value
+        with trace_span(f"telegram.{method}"):
+            response = await self.http.post(self.url + method, upstream='telegram', json=payload)
+        data = response.json()
+        if data.get('ok'):
+            return data.get('result')
+        description = data.get('description', 'Unknown error')
+        retry_after = (data.get('parameters') or {}).get('retry_after')
+        if retry_after:
+            raise telegram.error.RetryAfter(retry_after)
+        if data.get('error_code') == 400:
+            raise telegram.error.BadRequest(description)
+        if data.get('error_code') in (401, 403):
+            raise telegram.error.Unauthorized(description)
+        raise telegram.error.TelegramError(description)
+
+    async def send(self, method: str, chat_id, **params):
+        """Call a send method within the scheduler's rate limits, retrying on RetryAfter"""
+        if self.scheduler is None:
+            return await self.call(method, chat_id=chat_id, **params)
+        chat_action = method == 'sendChatAction'
+        queued = time.monotonic()
+        for attempt in range(self.scheduler.max_retries + 1):
+            waited = time.monotonic()
+            delay = self.scheduler.reserve(chat_id, chat_action)
+            throttled = bool(delay)
+            while delay:
+                await asyncio.sleep(delay)
+                delay = self.scheduler.reserve(chat_id, chat_action)
+            if delay is None:
+                return None
+            started = time.monotonic()
+            trace = current_trace.get()
+            if trace is not None and throttled:
+                trace.add('telegram.queue', waited, started - waited)
+            try:
+                result = await self.call(method, chat_id=chat_id, **params)
+            except telegram.error.RetryAfter as e:
+                self.scheduler.record(chat_id, queued, started, retry_after=e.retry_after)
+                if attempt == self.scheduler.max_retries:
+                    raise
+                continue
+            except Exception:
+                self.scheduler.record(chat_id, queued, started, failed=True)
+                raise
+            self.scheduler.record(chat_id, queued, started)
+            return result
 
-    # Expect callback_data like "download_file:<song_id>:<variant_idx>"
-    if data.startswith("download_file:"):
-        parts = data.split(":")
-        song_id = parts[1]
-        variant_idx = int(parts[2])
+    async def send_message(self, chat_id, text: str, parse_mode: str = None, reply_markup=None):
+        return await self.send('sendMessage', chat_id, text=text, parse_mode=parse_mode,
+                               reply_markup=reply_markup)
 
+    async def send_audio(self, chat_id, audio: str, caption: str = None):
+        return await self.send('sendAudio', chat_id, audio=audio, caption=caption)
+
+    async def send_chat_action(self, chat_id, action: str):
+        return await self.send('sendChatAction', chat_id, action=action)
+
+    async def answer_callback_query(self, callback_query_id: str):
+        return await self.call('answerCallbackQuery', callback_query_id=callback_query_id)
+
+class AsyncBotCore:
+    """Asyncio execution path for the hot commands.
+
+    Updates run as coroutines: upstream calls go through AsyncHttpClient and
+    Telegram sends are awaited, so one event loop serves many in-flight
+    updates. Store calls (users, sessions, file_ids, stored callbacks) block
+    on SQLite or a Redis socket, so they run on a small thread pool rather
+    than on the loop. Updates from one chat are handled in order. Anything not
+    handled here (conversation replies, settings, images, /start) is handed
+    to the threaded Dispatcher via `fallback`.
+    """
+
+    def __init__(self, bot: 'UltimateBot', api: AsyncTelegramAPI, http: AsyncHttpClient,
+                 fallback: Callable, max_inflight: int = ASYNC_MAX_INFLIGHT):
+        self.bot = bot
+        self.api = api
+        self.http = http
+        self.fallback = fallback
+        self.max_inflight = max_inflight
+        self.routes = {
+            'song': self.song,
+            'weather': self.weather,
+            'joke': self.joke,
+            'quote': self.quote,
+            'w': self.wikipedia,
+            'stats': self.stats_command
+        }
+        self._chats = {}      # chat id -> [lock, users]
+        self._inflight = 0
+        self._idle = None
+        self._store_executor = ThreadPoolExecutor(max_workers=ASYNC_STORE_WORKERS, thread_name_prefix="async-store")
+
+        # Metrics
+        self.processing_time = LatencyHistogram()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.fallbacks = 0
+
+    def handles(self, data: Dict) -> bool:
+        """Whether an update is handled here; the rest go to `fallback`"""
+        message = data.get('message')
+        if message and message.get('text'):
+            parsed = command_router.parse(message['text'])
+            return parsed is not None and parsed[0] in self.routes
+        callback = data.get('callback_query')
+        return bool(callback and SONG_CALLBACK.match(callback.get('data') or ''))
+
+    def submit(self, data: Dict, trace: Trace = None, reserved: bool = False) -> bool:
+        """Schedule a raw update; returns False when too many are in flight.
+
+        `reserved` marks an update for `fallback` whose queue slot the caller
+        already holds. An accepted update's trace is released once the update
+        is handled.
+        """
+        if self._inflight >= self.max_inflight:
+            self.rejected += 1
+            return False
+        self._inflight += 1
+        self.accepted += 1
+        asyncio.get_running_loop().create_task(self._run(data, trace, time.monotonic(), reserved))
+        return True
+
+    async def blocking(self, fn: Callable, *args):
+        """Run a blocking store call on the store pool, keeping the current trace"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._store_executor, contextvars.copy_context().run, fn, *args
+        )
+
+    async def drain(self, timeout: float = 10.0):
+        """Wait for in-flight updates to finish"""
+        deadline = time.monotonic() + timeout
+        while self._inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def _run(self, data: Dict, trace: Trace = None, queued: float = None, reserved: bool = False):
+        message = data.get('message') or (data.get('callback_query') or {}).get('message') or {}
+        chat_key = (message.get('chat') or {}).get('id', data.get('update_id'))
+        slot = self._chats.setdefault(chat_key, [asyncio.Lock(), 0])
+        slot[1] += 1
+        started = time.monotonic()
+        # The task runs in its own context copy, so this is local to the update
+        current_trace.set(trace)
         try:
-            detail_url = f"https://jiosavan-api-with-playlist.vercel.app/api/songs/{song_id}"
-            detail_response = requests.get(detail_url, timeout=10)
-            if detail_response.status_code == 200:
-                detail_data = detail_response.json()
+            # asyncio.Lock wakes waiters in FIFO order, which keeps per-chat ordering
+            async with slot[0]:
+                if trace is not None:
+                    # Waiting for the loop to run the task and behind earlier updates of the chat
+                    queued = queued or started
+                    trace.add('queue.wait', queued, time.monotonic() - queued)
+                with trace_span('dispatch'):
+                    if self.handles(data):
+                        await self.handle(data)
+                    else:
+                        # Handed over under the chat's lock, so it queues behind earlier updates
+                        self.fallbacks += 1
+                        self.fallback(data, reserved)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Async update error{f' [{trace.trace_id}]' if trace else ''}: {e}")
+        finally:
+            self.processing_time.observe(time.monotonic() - started)
+            slot[1] -= 1
+            if not slot[1]:
+                self._chats.pop(chat_key, None)
+            self._inflight -= 1
+            if trace is not None:
+                trace.release()
+
+    async def handle(self, data: Dict):
+        """Handle an update for which handles() is true"""
+        message = data.get('message')
+        if message and message.get('text'):
+            user_id = message['from']['id']
+            await self.blocking(CacheManager.update_user_activity, user_id)
+            if await self.blocking(sessions.get, user_id, 'awaiting_weather_city'):
+                # Like media_logger, the reply to "send your city" wins over commands
+                await self.new_weather_city(message['chat']['id'], user_id, message['text'].strip())
+                return
+            name, args = command_router.parse(message['text'])
+            annotate_trace(command=name)
+            started = time.monotonic()
+            failed = True
+            try:
+                await self.routes[name](message['chat']['id'], user_id, args)
+                failed = False
+            except Exception as e:
+                logger.error(f"Async command error: {e}")
+                await self.api.send_message(message['chat']['id'], "❌ Error processing your request. Please try again.")
+            finally:
+                command_router.record(name, time.monotonic() - started, failed)
+            return
+
+        await self.song_callback(data['callback_query'])
+
+    async def new_weather_city(self, chat_id, user_id, city_name: str):
+        """Async twin of handle_new_weather_city"""
+        if len(city_name) < 2:
+            await self.api.send_message(chat_id, "🌍 Please provide a valid city name.")
+            return
+        await self.blocking(CacheManager.set_user_weather_city, user_id, city_name)
+        await self.api.send_message(chat_id, f"🌤️ Your default weather city has been set to: {city_name}")
+        await self.blocking(sessions.pop, user_id, 'awaiting_weather_city')
+
+    # Upstream fetchers
+
+    async def fetch_song_detail(self, song_id: str) -> Optional[Dict]:
+        started = time.monotonic()
+        try:
+            response = await self.http.get(f"{self.bot.jiosaavn_api}/songs/{song_id}", upstream='jiosaavn')
+            if response.status_code == 200:
+                detail_data = response.json()
                 if 'data' in detail_data and detail_data['data']:
-                    song_detail = detail_data['data'][0]
-                    download_urls = song_detail.get('downloadUrl', [])
-                    if 0 <= variant_idx < len(download_urls):
-                        file_url = download_urls[variant_idx].get('url')
-                        quality = download_urls[variant_idx].get('quality', 'Unknown')
-                        # Get and clean title from song_detail, fallback to 'No Title'
-                        title = song_detail.get('title')
-                        if not title or not title.strip():
-                            title = 'No Title'
-                        clean_title = re.sub(r'\(.*?\)', '', title)
-                        clean_title = clean_title.replace('&quot;', '').replace('quot', '')
-                        clean_title = re.sub(r'\s+', ' ', clean_title).strip()
-                        if not clean_title:
-                            clean_title = 'No Title'
-                        # Get artist from song_detail, fallback to 'No Artist'
-                        artist = song_detail.get('primaryArtists')
-                        if not artist or not artist.strip():
-                            artist = 'No Artist'
-                        year = song_detail.get('year', 'Unknown')
-                        safe_caption = (
-                            f"🎵 {clean_title}\n"
-                            f"👤 {artist}\n"
-                            f"🎚️ Quality: {quality}\n"
-                            f"📅 Year: {year}"
-                        )
-                        query.message.reply_audio(audio=file_url, caption=safe_caption, parse_mode=None)
-                        return
+                    return detail_data['data'][0]
+        except Exception as e:
+            logger.error(f"Error fetching song details for {song_id}: {e}")
+        finally:
+            self.bot.song_detail_latency.observe(time.monotonic() - started)
+        return None
+
+    async def _load_song_record(self, song_id: str, song: Dict = None) -> Optional[Dict]:
+        song_detail = await self.fetch_song_detail(song_id)
+        return self.bot.build_song_record(song or {'id': song_id}, song_detail) if song_detail else None
+
+    async def get_song_record(self, song_id: str, song: Dict = None) -> Optional[Dict]:
+        """Detail record through the shared cache; concurrent misses share one fetch"""
+        return await self.bot.song_detail_cache.get_or_load_async(
+            song_id, lambda: self._load_song_record(song_id, song), cache_if=bool
+        )
+
+    async def search_songs(self, query: str) -> List[Dict]:
+        """Async twin of UltimateBot.search_jiosaavn sharing its caches"""
+        key = self.bot.normalize_query(query)
+        return await self.bot.flights['song_search'].do_async(key, lambda: self._search_songs(query, key))
+
+    async def _search_songs(self, query: str, key: str) -> List[Dict]:
+        bot = self.bot
+        started = time.monotonic()
+        deadline = started + SONG_SEARCH_DEADLINE
+        try:
+            cached = bot.song_query_cache.get(key)
+            if cached:
+                songs = [bot.song_detail_cache.get(song_id) for song_id in cached[0]]
+                if all(songs):
+                    return songs
+
+            url = f"{bot.jiosaavn_api}/search?query={quote(query)}"
+            response = await self.http.get(url, upstream='jiosaavn', deadline=deadline)
+            if response.status_code != 200:
+                return []
+            data = response.json()
+            if 'data' not in data or 'songs' not in data['data']:
+                return []
+            candidates = [song for song in data['data']['songs'].get('results', [])[:8] if song.get('id')]
+
+            resolved = {}
+            pending = {}
+            for index, song in enumerate(candidates):
+                cached_record = bot.song_detail_cache.get(song['id'])
+                if cached_record:
+                    resolved[index] = cached_record
+                else:
+                    # The miss is already counted; share the fetch without counting it twice
+                    pending[index] = asyncio.ensure_future(bot.song_detail_cache.load_async(
+                        song['id'], lambda song=song: self._load_song_record(song['id'], song), cache_if=bool
+                    ))
+
+            not_done = set()
+            if pending:
+                _, not_done = await asyncio.wait(pending.values(), timeout=max(0.0, deadline - time.monotonic()))
+                if not_done:
+                    # Threaded searches count into the same figure
+                    with bot.song_stats_lock:
+                        bot.song_search_partial += 1
+                    logger.warning(f"Song search deadline hit: {len(not_done)} of {len(pending)} lookups unresolved")
+                    # Only our wait is cancelled; the shared lookups finish and fill the cache
+                    for task in not_done:
+                        task.cancel()
+            for index, task in pending.items():
+                if task in not_done or task.exception() or not task.result():
+                    continue
+                resolved[index] = task.result()
+
+            songs = [resolved[index] for index in sorted(resolved)]
+            if songs and not not_done:
+                bot.song_query_cache.set(key, ([song['id'] for song in songs], True))
+            return songs
+        except Exception as e:
+            logger.error(f"JioSaavn search error: {e}")
+            return []
+        finally:
+            bot.song_search_latency.observe(time.monotonic() - started)
+
+    # Command handlers
+
+    async def song(self, chat_id, user_id, song_query: str):
+        await self.api.send_chat_action(chat_id, ChatAction.TYPING)
+        if not song_query:
+            await self.api.send_message(chat_id, "🎵 Please provide a song name!\n\n**Example:** `@song Kesariya`", ParseMode.MARKDOWN)
+            return
+        await self.api.send_message(chat_id, f"🔍 **Searching:** `{song_query}`", ParseMode.MARKDOWN)
+        songs = await self.search_songs(song_query)
+        if not songs:
+            await self.api.send_message(chat_id, "😔 No songs found. Try a different search term.")
+            return
+        # Buttons with long song ids spill to the state backend, a store call
+        result_text, reply_markup = await self.blocking(render_song_results, songs)
+        await self.api.send_message(chat_id, result_text, ParseMode.MARKDOWN, reply_markup)
+
+    async def weather(self, chat_id, user_id, weather_query: str):
+        bot = self.bot
+        await self.api.send_chat_action(chat_id, ChatAction.TYPING)
+        if weather_query.lower() == "reset":
+            def reset():
+                user_data = CacheManager.get_user_data(user_id)
+                user_data['weather_city'] = None
+                CacheManager.save_user(user_id)
+
+            await self.blocking(reset)
+            await self.api.send_message(
+                chat_id,
+                "🌤️ Your saved weather city has been reset.\n\nUse `@weather <city>` to set a new default city.",
+                ParseMode.MARKDOWN
+            )
+            return
+
+        city = weather_query or await self.blocking(CacheManager.get_user_weather_city, user_id)
+        if not city:
+            await self.api.send_message(chat_id, bot.get_weather_setup_message(), ParseMode.MARKDOWN)
+            return
+
+        async def load():
+            url = f"{bot.openweather_api}?q={quote(city)}&appid={OPENWEATHER_API_KEY}&units=metric"
+            response = await self.http.get(url, upstream='openweather')
+            return response.status_code, response.json() if response.status_code == 200 else None
+
+        try:
+            result = await bot.weather_cache.get_or_load_async(
+                bot.normalize_city(city), load, cache_if=lambda result: result[0] in (200, 404)
+            )
+        except Exception as e:
+            logger.error(f"Weather API error: {e}")
+            await self.api.send_message(chat_id, "⚠️ Error fetching weather data.", ParseMode.MARKDOWN)
+            return
+        # Formatting a successful reply saves the city as the user's default
+        text = await self.blocking(bot.format_weather, result[0], result[1], city, user_id)
+        await self.api.send_message(chat_id, text, ParseMode.MARKDOWN)
+
+    async def joke(self, chat_id, user_id, args: str):
+        text = self.bot.content_pools['joke'].take() or await self.bot.joke_fetch.fetch_async(self.http)
+        await self.api.send_message(chat_id, text or self.bot.fallback_joke(), ParseMode.MARKDOWN)
+
+    async def quote(self, chat_id, user_id, args: str):
+        text = self.bot.content_pools['quote'].take() or await self.bot.quote_fetch.fetch_async(self.http)
+        await self.api.send_message(chat_id, text or self.bot.fallback_quote(), ParseMode.MARKDOWN)
+
+    async def wikipedia(self, chat_id, user_id, search_query: str):
+        if len(search_query) < 3:
+            await self.api.send_message(chat_id, "🔍 Please provide a longer search term for Wikipedia.")
+            return
+        bot = self.bot
+
+        async def load():
+            started = time.monotonic()
+            try:
+                response = await self.http.get(bot.wikipedia_url(search_query), upstream='wikipedia')
+                if response.status_code != 200:
+                    return response.status_code, []
+                return 200, bot.parse_wikipedia(response.json())
+            finally:
+                bot.wikipedia_latency.observe(time.monotonic() - started)
+
+        key = bot.normalize_query(search_query)
+        bot.count_wikipedia_query(key)
+        try:
+            status_code, search_results = await bot.wikipedia_cache.get_or_load_async(
+                key, load, cache_if=lambda result: result[0] == 200
+            )
+            if status_code != 200:
+                await self.api.send_message(chat_id, "⚠️ Error fetching data from Wikipedia.")
+                return
+            if not search_results:
+                await self.api.send_message(chat_id, "🔍 No results found on Wikipedia.")
+                return
+            await self.api.send_message(chat_id, render_wikipedia_results(search_results), ParseMode.MARKDOWN)
+        except Exception as e:
+            logger.error(f"Wikipedia search error: {e}")
+            await self.api.send_message(chat_id, "⚠️ Error processing your request.")
+
+    async def stats_command(self, chat_id, user_id, args: str):
+        await self.api.send_message(chat_id, await self.blocking(self.bot.get_user_stats, user_id), ParseMode.MARKDOWN)
+
+    async def song_callback(self, callback: Dict):
+        """Async twin of song_download_callback"""
+        chat_id = callback['message']['chat']['id']
+        await self.api.answer_callback_query(callback['id'])
+        payload = await self.blocking(callbacks.decode, callback['data'])
+        parsed = parse_song_callback(*payload) if payload else None
+        if parsed is None:
+            await self.api.send_message(chat_id, "⌛ This button has expired. Please search again.")
+            return
+        song_id, variant_idx = parsed
+
+        if variant_idx is None:
+            record = await self.get_song_record(song_id)
+            download_urls = record.get('download_urls', []) if record else []
+            if not download_urls:
+                await self.api.send_message(chat_id, "❌ No download links found for this song.")
+                return
+            reply_text, reply_markup = await self.blocking(render_song_variants, record, download_urls)
+            await self.api.send_message(chat_id, reply_text, ParseMode.MARKDOWN, reply_markup)
+            return
+
+        try:
+            record = await self.get_song_record(song_id)
+            download_urls = record.get('download_urls', []) if record else []
+            if 0 <= variant_idx < len(download_urls):
+                quality = download_urls[variant_idx].get('quality', 'Unknown')
+                await self.send_song_audio(chat_id, song_id, quality, download_urls[variant_idx].get('url'),
+                                           song_caption(record, quality))
+                return
         except Exception as e:
             logger.error(f"Error sending song file: {e}")
-        query.message.reply_text("❌ Could not download this file.")
-        return
+        await self.api.send_message(chat_id, "❌ Could not download this file.")
+
+    async def send_song_audio(self, chat_id, song_id: str, quality: str, file_url: str, caption: str):
+        key = f"{song_id}:{quality}"
+        file_ids = self.bot.file_ids
+        file_id = await self.blocking(file_ids.get, 'audio', key)
+        if file_id:
+            try:
+                await self.api.send_audio(chat_id, file_id, caption)
+                return
+            except telegram.error.BadRequest as e:
+                logger.warning(f"Stale audio file_id for {key}: {e}")
+                await self.blocking(file_ids.delete, 'audio', key)
+        sent = await self.api.send_audio(chat_id, file_url, caption)
+        audio = (sent or {}).get('audio')
+        if audio:
+            await self.blocking(file_ids.put, 'audio', key, audio['file_id'], audio.get('file_size'))
+
+    def stats(self) -> Dict:
+        return {
+            'in_flight': self._inflight,
+            'max_in_flight': self.max_inflight,
+            'chats_active': len(self._chats),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'fallbacks': self.fallbacks,
+            'processing_time': self.processing_time.snapshot(),
+            'http': self.http.stats()
+        }
 
 # FastAPI app
 app = FastAPI()
+# Time the webhook route takes to acknowledge an update (parse + enqueue)
+webhook_latency = LatencyHistogram()
 
 # Telegram bot and dispatcher setup
-bot_instance = telegram.Bot(token=TOKEN)
+bot_instance = ScheduledBot(
+    scheduler=send_scheduler,
+    token=TOKEN,
+    base_url=TELEGRAM_API_BASE,
+    request=TelegramRequest(con_pool_size=UPDATE_WORKERS + 4)
+)
 dispatcher = Dispatcher(bot_instance, None, workers=0, use_context=True)
 
 # Register handlers (same as in main())
@@ -1080,13 +4993,7 @@ def setup_handlers():
     CacheManager.load_cache()
     dispatcher.add_handler(CommandHandler("start", start_command))
     dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("song", song_command))
-    dispatcher.add_handler(CommandHandler("weather", weather_command))
-    dispatcher.add_handler(CommandHandler("joke", joke_command))
-    dispatcher.add_handler(CommandHandler("quote", quote_command))
-    dispatcher.add_handler(CommandHandler("movie", movie_command))
-    dispatcher.add_handler(CommandHandler("w", w_command))
-    dispatcher.add_handler(CommandHandler("image", image_command))
+    dispatcher.add_handler(CommandHandler(["song", "weather", "joke", "quote", "movie", "w", "image"], route_command))
     dispatcher.add_handler(CommandHandler("health", health_command))
     dispatcher.add_handler(CommandHandler("settings", settings_command))
     dispatcher.add_handler(CommandHandler("set_weather_city", set_weather_city_command))
@@ -1094,42 +5001,226 @@ def setup_handlers():
     dispatcher.add_handler(CommandHandler("view_stats", view_stats_command))
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, media_logger))
     dispatcher.add_handler(CallbackQueryHandler(weather_city_callback, pattern="^(change_weather_city|set_weather_city|reset_weather_city|view_stats)$"))
-    dispatcher.add_handler(CallbackQueryHandler(song_download_callback, pattern="^(download_song:|download_file:)"))
-    conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(weather_city_callback, pattern="^(change_weather_city|set_weather_city|reset_weather_city|view_stats)$")],
-        states={
-            CHANGE_WEATHER_CITY: [MessageHandler(Filters.text & ~Filters.command, handle_new_weather_city)]
-        },
-        fallbacks=[],
-        allow_reentry=True
-    )
-    dispatcher.add_handler(conv_handler)
+    dispatcher.add_handler(CallbackQueryHandler(song_download_callback, pattern=SONG_CALLBACK))
     dispatcher.add_error_handler(lambda update, context: logger.error(f"Update {update} caused error {context.error}"))
 
 setup_handlers()
 
+# Updates are processed off the event loop so slow handlers never block the webhook
+update_pool = UpdateWorkerPool(dispatcher.process_update)
+
+def submit_to_dispatcher(data: Dict, reserved: bool = False) -> bool:
+    """Queue a raw update for the threaded Dispatcher, carrying over the current trace.
+
+    `reserved` says the webhook already holds a queue slot for it.
+    """
+    try:
+        update = Update.de_json(data, bot_instance)
+    except Exception:
+        if reserved:
+            update_pool.release()
+        raise
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add('fallback', time.monotonic(), 0.0)
+        trace.hold()
+    if not update_pool.submit(get_update_chat_key(update), update, trace, reserved=reserved):
+        logger.warning(f"Update queue full, dropping update {update.update_id}")
+        if trace is not None:
+            trace.release()
+        return False
+    return True
+
+async_core = None
+if BOT_EXECUTION_MODE == "async":
+    async_http = AsyncHttpClient()
+    async_core = AsyncBotCore(
+        bot, AsyncTelegramAPI(TOKEN, async_http, scheduler=send_scheduler), async_http,
+        fallback=submit_to_dispatcher
+    )
+
 @app.get("/")
 async def health():
     return {"status": "ok"}
 
+# /stats and /metrics count rows in the user and file_id stores; as plain functions
+# FastAPI runs them on its threadpool instead of the event loop
+@app.get("/stats")
+def stats():
+    return {
+        "execution_mode": BOT_EXECUTION_MODE,
+        "async_core": async_core.stats() if async_core else None,
+        "update_queue": update_pool.stats(),
+        "telegram_sends": send_scheduler.stats(),
+        "song_search": bot.song_search_stats(),
+        "movie_search": bot.movie_search_stats(),
+        "wikipedia": bot.wikipedia_stats(),
+        "http": bot.http.stats(),
+        "circuit_breakers": circuit_breakers.status(),
+        "single_flight": bot.single_flight_stats(),
+        "upstream_calls": upstream_metrics.stats(),
+        "tracing": tracer.stats(),
+        "hedged_fetches": {'joke': bot.joke_fetch.stats(), 'quote': bot.quote_fetch.stats()},
+        "content_pools": {name: pool.stats() for name, pool in bot.content_pools.items()},
+        "callbacks": callbacks.stats(),
+        "weather_cache": bot.weather_cache.stats(),
+        "activity_writes": activity_buffer.stats(),
+        "users": CacheManager.stats(),
+        "commands": command_router.stats(),
+        "file_ids": bot.file_ids.stats()
+    }
+
+def render_metrics() -> str:
+    """All subsystem counters in Prometheus text format; values are per worker process"""
+    metrics = MetricsText()
+    commands = command_router.stats()
+    metrics.counter("command_requests_total", "Text commands handled",
+                    [({'command': name}, values['calls']) for name, values in commands.items()])
+    metrics.counter("command_errors_total", "Text commands whose handler raised",
+                    [({'command': name}, values['errors']) for name, values in commands.items()])
+    metrics.histogram("command_duration_seconds", "Text command handler time",
+                      [({'command': name}, command_router.latency[name]) for name in commands])
+
+    upstreams = upstream_metrics.stats()
+    metrics.counter("upstream_requests_total", "Outbound HTTP attempts per upstream, retries included",
+                    [({'upstream': name}, values['calls']) for name, values in upstreams.items()])
+    metrics.counter("upstream_errors_total", "Outbound HTTP attempts that raised or got a retryable/5xx status",
+                    [({'upstream': name}, values['errors']) for name, values in upstreams.items()])
+    metrics.histogram("upstream_duration_seconds", "Outbound HTTP attempt latency",
+                      [({'upstream': name}, upstream_metrics.latency[name]) for name in upstreams])
+    metrics.gauge("circuit_open", "1 while the host's circuit breaker is not closed",
+                  [({'host': host, 'upstream': status['upstream']}, int(status['state'] != 'closed'))
+                   for host, status in circuit_breakers.status().items()])
+
+    metrics.histogram("webhook_duration_seconds", "Time to acknowledge a webhook update", [({}, webhook_latency)])
+    processing = async_core.processing_time if async_core is not None else update_pool.processing_time
+    metrics.histogram("update_processing_seconds", "Time to process one update",
+                      [({'mode': BOT_EXECUTION_MODE}, processing)])
+    metrics.histogram("update_queue_wait_seconds", "Time a threaded update waits for a worker",
+                      [({}, update_pool.wait_time)])
+    metrics.histogram("update_end_to_end_seconds", "Webhook to last Telegram send, per traced update",
+                      [({}, tracer.duration)])
+    metrics.counter("slow_traces_total", "Traced updates over TRACE_SLOW_THRESHOLD", [({}, tracer.slow)])
+    metrics.histogram("telegram_send_seconds", "Bot API send call latency", [({}, send_scheduler.send_latency)])
+    metrics.histogram("telegram_send_queue_seconds", "Time a send waits for the rate limiter",
+                      [({}, send_scheduler.queue_latency)])
+    sends = send_scheduler.stats()
+    metrics.gauge("telegram_send_queued", "Sends waiting in the scheduler", [({}, sends['queued'])])
+    metrics.counter("telegram_retry_after_total", "Sends delayed by a 429 retry_after", [({}, sends['retry_after_429'])])
+
+    metrics.gauge("user_cache_size", "Users resident in USER_CACHE", [({}, len(USER_CACHE))])
+    caches = {
+        'song_query': bot.song_query_cache, 'song_detail': bot.song_detail_cache,
+        'weather': bot.weather_cache, 'movie': bot.movie_cache, 'wikipedia': bot.wikipedia_cache
+    }
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    for kind, values in bot.file_ids.stats().items():
+        cache_stats[f"file_id_{kind}"] = dict(values, size=values['stored'])
+    metrics.counter("cache_hits_total", "Cache lookups answered from the cache",
+                    [({'cache': name}, values['hits']) for name, values in cache_stats.items()])
+    metrics.counter("cache_misses_total", "Cache lookups that went upstream",
+                    [({'cache': name}, values['misses']) for name, values in cache_stats.items()])
+    metrics.gauge("cache_hit_ratio", "Hits over lookups since start",
+                  [({'cache': name}, float(values['hit_ratio'])) for name, values in cache_stats.items()])
+    metrics.gauge("cache_entries", "Entries held by the cache",
+                  [({'cache': name}, values['size']) for name, values in cache_stats.items()])
+    pools = {name: pool.stats() for name, pool in bot.content_pools.items()}
+    metrics.gauge("content_pool_size", "Pre-fetched items ready to serve",
+                  [({'pool': name}, values['size']) for name, values in pools.items()])
+    metrics.counter("content_pool_served_total", "Items served from the pool",
+                    [({'pool': name}, values['served']) for name, values in pools.items()])
+    metrics.counter("content_pool_empty_total", "Requests that found the pool empty",
+                    [({'pool': name}, values['empty']) for name, values in pools.items()])
+    return metrics.render()
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape target"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/upstreams")
+async def upstreams():
+    """Circuit breaker state per upstream host"""
+    return circuit_breakers.status()
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
+    trace = tracer.start('update', mode=BOT_EXECUTION_MODE)
+    started = time.monotonic()
+    accepted = False
     try:
         data = await request.json()
+        if trace is not None:
+            kind = next((key for key in data if key != 'update_id'), 'unknown')
+            trace.attrs.update(update_id=data.get('update_id'), update_type=kind)
+        if async_core is not None:
+            if trace is not None:
+                trace.add('webhook.parse', started, time.monotonic() - started)
+            # Updates for the threaded Dispatcher need a queue slot before Telegram gets
+            # its 200; once acknowledged, a rejected update is never redelivered
+            reserved = not async_core.handles(data)
+            if reserved and not update_pool.reserve():
+                logger.warning("Update queue full, asking Telegram to retry")
+                return JSONResponse({"ok": False, "error": "busy"}, status_code=503)
+            if not async_core.submit(data, trace, reserved):
+                if reserved:
+                    update_pool.release()
+                logger.warning("Too many updates in flight, asking Telegram to retry")
+                return JSONResponse({"ok": False, "error": "busy"}, status_code=503)
+            accepted = True
+            return JSONResponse({"ok": True})
         update = Update.de_json(data, bot_instance)
-        dispatcher.process_update(update)
+        if trace is not None:
+            trace.add('webhook.parse', started, time.monotonic() - started)
+        if not update_pool.submit(get_update_chat_key(update), update, trace):
+            # Queue full: a non-2xx reply makes Telegram redeliver the update later
+            logger.warning("Update queue full, asking Telegram to retry")
+            return JSONResponse({"ok": False, "error": "busy"}, status_code=503)
+        accepted = True
         return JSONResponse({"ok": True})
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+    finally:
+        webhook_latency.observe(time.monotonic() - started)
+        if trace is not None and not accepted:
+            # Rejected updates end here; accepted ones are released by whoever handles them
+            trace.attrs['rejected'] = True
+            trace.release()
 
 # Set webhook on startup
 @app.on_event("startup")
 async def on_startup():
+    circuit_breakers.start_probing()
+    send_scheduler.start()
+    update_pool.start()
+    activity_buffer.start()
+    user_maintenance.start()
+    for pool in bot.content_pools.values():
+        pool.start()
+    if WIKIPEDIA_PREWARM_INTERVAL > 0:
+        wikipedia_prewarm.start()
+        if WIKIPEDIA_PREWARM:
+            # Warm the configured queries now instead of after the first interval
+            threading.Thread(target=bot.prewarm_wikipedia, name="wikipedia-prewarm-initial", daemon=True).start()
     try:
         bot_instance.set_webhook(WEBHOOK_URL)
         logger.info(f"Webhook set to {WEBHOOK_URL}")
     except Exception as e:
         logger.error(f"Failed to set webhook: {e}")
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    if async_core is not None:
+        await async_core.drain()
+        await async_core.http.aclose()
+    update_pool.stop()
+    send_scheduler.stop()
+    circuit_breakers.stop_probing()
+    user_maintenance.stop()
+    for pool in bot.content_pools.values():
+        pool.stop()
+    wikipedia_prewarm.stop()
+    activity_buffer.stop()
+
 # To run: `uvicorn main:app --host 0.0.0.0 --port 8000`
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="sparkbot_tests_")
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("USER_DB_FILE", os.path.join(WORKDIR, "user_cache.db"))
+os.chdir(WORKDIR)  # importing main opens its store in the working directory
+sys.path.insert(0, REPO_ROOT)
@@ -0,0 +1,206 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+import telegram
+
+import main
+from main import AsyncBotCore, AsyncHttpClient, AsyncTelegramAPI, BreakerRegistry, SendScheduler
+
+
+def make_client(handler, **kwargs) -> AsyncHttpClient:
+    kwargs.setdefault('backoff_base', 0.01)
+    kwargs.setdefault('backoff_max', 0.01)
+    return AsyncHttpClient(breakers=BreakerRegistry(), transport=httpx.MockTransport(handler), **kwargs)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+# AsyncHttpClient
+
+def test_retries_retryable_status_then_succeeds():
+    replies = [503, 200]
+    client = make_client(lambda request: httpx.Response(replies.pop(0)), retries=2)
+    response = run(client.get("http://api.test/x", upstream='jiosaavn'))
+    assert response.status_code == 200
+    assert client.stats()['api.test'] == {'requests': 2, 'errors': 1, 'retries': 1, 'short_circuited': 0}
+
+
+def test_connection_errors_are_counted_and_raised():
+    def refuse(request):
+        raise httpx.ConnectError("refused", request=request)
+
+    client = make_client(refuse, retries=1)
+    with pytest.raises(httpx.ConnectError):
+        run(client.get("http://down.test/x", upstream='jiosaavn'))
+    assert client.stats()['down.test']['errors'] == 2
+    assert client.breakers.get('down.test', 'jiosaavn').failures == 2
+
+
+def test_deadline_stops_retries():
+    calls = []
+
+    def unavailable(request):
+        calls.append(time.monotonic())
+        return httpx.Response(503)
+
+    client = make_client(unavailable, retries=20, backoff_base=0.1, backoff_max=0.1)
+    # Only the deadline should end the retries here, not the breaker
+    client.breakers.get('busy.test', 'jiosaavn').failure_threshold = 100
+    started = time.monotonic()
+    response = run(client.get("http://busy.test/x", upstream='jiosaavn', deadline=started + 0.3))
+    assert response.status_code == 503
+    assert time.monotonic() - started < 0.4
+    assert len(calls) < 21
+
+
+def test_deadline_caps_attempt_timeouts():
+    seen = {}
+
+    def capture(request):
+        seen.update(request.extensions['timeout'])
+        return httpx.Response(200)
+
+    client = make_client(capture, timeouts={'default': (3.05, 10)})
+    run(client.get("http://api.test/x", deadline=time.monotonic() + 0.5))
+    assert seen['read'] <= 0.5
+    assert seen['connect'] <= 0.5
+
+
+# AsyncTelegramAPI
+
+def telegram_api(replies: list, scheduler: SendScheduler = None) -> AsyncTelegramAPI:
+    def reply(request):
+        return httpx.Response(200, json=replies.pop(0))
+
+    return AsyncTelegramAPI("123456:TEST", make_client(reply), base_url="http://telegram.test/bot",
+                            scheduler=scheduler)
+
+
+def test_telegram_errors_map_to_telegram_exceptions():
+    api = telegram_api([
+        {'ok': False, 'error_code': 400, 'description': "Bad Request: can't parse entities"},
+        {'ok': False, 'error_code': 403, 'description': "Forbidden: bot was blocked by the user"},
+    ])
+    with pytest.raises(telegram.error.BadRequest):
+        run(api.call('sendMessage', chat_id=1, text="*"))
+    with pytest.raises(telegram.error.Unauthorized):
+        run(api.call('sendMessage', chat_id=1, text="hi"))
+
+
+def test_send_retries_after_flood_wait_and_counts_failures():
+    scheduler = SendScheduler(global_rate=1000, chat_rate=1000, group_rate=1000, chat_burst=1000, max_retries=2)
+    api = telegram_api([
+        {'ok': False, 'error_code': 429, 'description': "Too Many Requests", 'parameters': {'retry_after': 0.05}},
+        {'ok': True, 'result': {'message_id': 1}},
+        {'ok': False, 'error_code': 400, 'description': "Bad Request: message is empty"},
+    ], scheduler)
+    assert run(api.send_message(1, "hi")) == {'message_id': 1}
+    with pytest.raises(telegram.error.BadRequest):
+        run(api.send_message(1, ""))
+    stats = scheduler.stats()
+    assert (stats['sent'], stats['failed'], stats['retry_after_429']) == (1, 1, 1)
+
+
+# AsyncBotCore
+
+class FakeAPI:
+    def __init__(self, fail: bool = False):
+        self.sent = []
+        self.fail = fail
+
+    async def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
+        if self.fail:
+            raise telegram.error.NetworkError("down")
+        self.sent.append((chat_id, text))
+
+
+def text_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'text': text,
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'}}
+    }
+
+
+def make_core(api=None, fallback=None, **kwargs) -> AsyncBotCore:
+    return AsyncBotCore(main.bot, api or FakeAPI(), None, fallback=fallback or (lambda data, reserved: None), **kwargs)
+
+
+def test_updates_from_one_chat_run_in_order():
+    events = []
+
+    async def joke(chat_id, user_id, args):
+        events.append(('start', chat_id, args))
+        await asyncio.sleep(0.05 if args == 'first' else 0)
+        events.append(('end', chat_id, args))
+
+    async def scenario():
+        core = make_core()
+        core.routes = {'joke': joke}
+        for update_id, (chat_id, text) in enumerate([(1, "@joke first"), (1, "@joke second"), (2, "@joke other")]):
+            assert core.submit(text_update(update_id, chat_id, text))
+        await core.drain(5)
+        return core
+
+    core = run(scenario())
+    chat_one = [event for event in events if event[1] == 1]
+    assert chat_one == [('start', 1, 'first'), ('end', 1, 'first'), ('start', 1, 'second'), ('end', 1, 'second')]
+    # Another chat does not wait behind it
+    assert events.index(('end', 2, 'other')) < events.index(('end', 1, 'first'))
+    assert core.processed == 3
+
+
+def test_command_errors_reply_and_are_counted():
+    async def broken(chat_id, user_id, args):
+        raise ValueError("boom")
+
+    async def scenario(api):
+        core = make_core(api)
+        core.routes = {'quote': broken}
+        core.submit(text_update(1, 5, "@quote"))
+        await core.drain(5)
+        return core
+
+    errors_before = main.command_router.errors.get('quote', 0)
+    api = FakeAPI()
+    core = run(scenario(api))
+    assert api.sent == [(5, "❌ Error processing your request. Please try again.")]
+    assert main.command_router.errors['quote'] == errors_before + 1
+    assert (core.processed, core.failed) == (1, 0)
+
+    # If even the error reply cannot be sent, the update counts as failed
+    core = run(scenario(FakeAPI(fail=True)))
+    assert (core.processed, core.failed) == (0, 1)
+
+
+def test_other_updates_go_to_fallback_with_their_reservation():
+    handed_over = []
+
+    async def scenario():
+        core = make_core(fallback=lambda data, reserved: handed_over.append((data['update_id'], reserved)))
+        assert not core.handles(text_update(1, 5, "@help"))
+        core.submit(text_update(1, 5, "@help"), reserved=True)
+        await core.drain(5)
+        return core
+
+    core = run(scenario())
+    assert handed_over == [(1, True)]
+    assert core.fallbacks == 1
+
+
+def test_rejects_past_max_inflight():
+    async def scenario():
+        core = make_core(max_inflight=1)
+        core.routes = {'joke': lambda chat_id, user_id, args: asyncio.sleep(0.01)}
+        assert core.submit(text_update(1, 5, "@joke"))
+        assert not core.submit(text_update(2, 6, "@joke"))
+        await core.drain(5)
+        return core
+
+    core = run(scenario())
+    assert (core.accepted, core.rejected) == (1, 1)
@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+import main
+from main import CacheManager, UserStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = UserStore(str(tmp_path / "users.db"))
+    monkeypatch.setattr(CacheManager, 'store', store)
+    monkeypatch.setattr(CacheManager, '_pending_requests', {})
+    monkeypatch.setattr(main, 'USER_CACHE', {})
+    monkeypatch.setattr(main, 'USER_STATE_SHARED', False)
+    yield store
+    store.close()
+
+
+def test_lookups_of_unknown_users_do_not_create_records(store):
+    assert CacheManager.get_user_weather_city(1) is None
+    assert main.USER_CACHE == {}
+    CacheManager.update_user_activity(1)
+    assert list(main.USER_CACHE) == [1]
+
+
+def test_idle_users_are_evicted_after_their_activity_is_written(store):
+    CacheManager.set_user_weather_city(1, "Paris")
+    CacheManager.update_user_activity(2)
+    main.USER_CACHE[1]['last_active'] = time.time() - 2 * main.USER_RESIDENT_IDLE
+
+    assert CacheManager.evict_idle_users() == 1
+    assert list(main.USER_CACHE) == [2]
+    # The evicted user is read back from the store on their next visit
+    assert store.get(1)['total_requests'] == 1
+    assert CacheManager.get_user_weather_city(1) == "Paris"
+
+
+def test_long_idle_users_are_archived_and_come_back(store):
+    long_ago = time.time() - (main.USER_ARCHIVE_DAYS + 1) * 86400
+    store.upsert(1, {'weather_city': "Oslo", 'last_active': long_ago, 'total_requests': 3})
+    CacheManager.update_user_activity(2)
+
+    CacheManager.run_maintenance()
+    assert (store.count(), store.count('users_archive')) == (1, 1)
+    assert CacheManager.get_user_weather_city(1) == "Oslo"
+    assert store.count('users_archive') == 0
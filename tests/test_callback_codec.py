@@ -0,0 +1,83 @@
+import pytest
+
+from main import CallbackCodec, SQLiteStateStore
+
+
+@pytest.fixture
+def codec():
+    return CallbackCodec(SQLiteStateStore(":memory:"), ttl=60)
+
+
+def test_short_payload_is_self_contained(codec):
+    data = codec.encode('f', 'abc123', 2)
+    assert data == "f1:abc123:2"
+    assert codec.decode(data) == ('f', ['abc123', '2'])
+    assert codec.spilled == 0
+
+
+def test_long_payload_spills_to_backend(codec):
+    song_id = "x" * 80
+    data = codec.encode('s', song_id)
+    assert data.startswith("s1~")
+    assert len(data.encode('utf-8')) <= CallbackCodec.LIMIT
+    assert codec.decode(data) == ('s', [song_id])
+    assert codec.spilled == 1
+
+
+def test_field_with_separator_spills(codec):
+    data = codec.encode('f', 'a:b', 0)
+    assert '~' in data
+    assert codec.decode(data) == ('f', ['a:b', '0'])
+
+
+def test_multibyte_payload_measured_in_bytes(codec):
+    data = codec.encode('s', "é" * 40)
+    assert data.startswith("s1~")
+
+
+def test_unknown_version_is_expired(codec):
+    assert codec.decode("f9:abc:1") is None
+    assert codec.decode("x") is None
+    assert codec.expired == 2
+
+
+def test_missing_spilled_payload_is_expired(codec):
+    assert codec.decode("s1~nothere") is None
+    assert codec.stats() == {'spilled': 0, 'expired': 1}
+
+
+def test_legacy_download_file_button(codec):
+    assert codec.decode("download_file:abc:3") == ('f', ['abc', '3'])
+
+
+def test_async_song_buttons_are_encoded_off_the_event_loop(monkeypatch):
+    import asyncio
+    import threading
+
+    import main
+
+    class RecordingBackend(SQLiteStateStore):
+        threads = []
+
+        def set(self, key, value, ttl=None):
+            self.threads.append(threading.current_thread())
+            super().set(key, value, ttl)
+
+    class FakeAPI:
+        async def send_chat_action(self, chat_id, action):
+            pass
+
+        async def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
+            self.markup = reply_markup
+
+    monkeypatch.setattr(main.callbacks, 'backend', RecordingBackend(":memory:"))
+    core = main.AsyncBotCore(main.bot, FakeAPI(), None, fallback=lambda data, reserved: None)
+    song = {'id': "x" * 80, 'title': "Song", 'artist': "Artist", 'album': "Album"}
+
+    async def search_songs(query):
+        return [song]
+
+    core.search_songs = search_songs
+    asyncio.run(core.song(1, 1, "song"))
+    assert RecordingBackend.threads
+    assert threading.main_thread() not in RecordingBackend.threads
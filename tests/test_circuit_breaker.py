@@ -0,0 +1,123 @@
+from main import CircuitBreaker
+
+
+def make_breaker(reset_timeout: float = 60, probe_url: str = None) -> CircuitBreaker:
+    breaker = CircuitBreaker("api.example.com", "test", failure_threshold=3,
+                             reset_timeout=reset_timeout, latency_budget=1.0)
+    breaker.probe_url = probe_url
+    return breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = make_breaker()
+    for _ in range(2):
+        breaker.failure("boom")
+        assert breaker.state == 'closed'
+    breaker.failure("boom")
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.status()['short_circuited'] == 1
+    assert breaker.opened_total == 1
+
+
+def test_success_resets_failure_count():
+    breaker = make_breaker()
+    breaker.failure("boom")
+    breaker.failure("boom")
+    breaker.success(0.1)
+    breaker.failure("boom")
+    assert breaker.state == 'closed'
+
+
+def test_slow_call_counts_as_failure():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.success(5.0)
+    assert breaker.state == 'open'
+    assert breaker.slow_calls == 3
+
+
+def test_trial_call_closes_after_reset_timeout():
+    breaker = make_breaker(reset_timeout=0)
+    for _ in range(3):
+        breaker.failure("boom")
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    # Only one trial at a time
+    assert not breaker.allow()
+    breaker.success(0.1)
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens():
+    breaker = make_breaker(reset_timeout=0)
+    for _ in range(3):
+        breaker.failure("boom")
+    assert breaker.allow()
+    breaker.failure("still down")
+    assert breaker.state == 'open'
+    assert breaker.opened_total == 1
+
+
+def test_background_probe_takes_the_trial():
+    breaker = make_breaker(reset_timeout=0, probe_url="https://api.example.com/health")
+    for _ in range(3):
+        breaker.failure("boom")
+    assert not breaker.allow(probing=True)
+    assert breaker.due_for_probe()
+    assert breaker.state == 'half_open'
+    assert not breaker.due_for_probe()
+    breaker.success(0.1)
+    assert breaker.state == 'closed'
+
+
+def test_host_without_probe_url_recovers_through_trial():
+    breaker = make_breaker(reset_timeout=0)
+    for _ in range(3):
+        breaker.failure("boom")
+    assert not breaker.due_for_probe()
+    assert breaker.allow(probing=True)
+    assert breaker.state == 'half_open'
+
+
+def test_stays_open_before_reset_timeout():
+    breaker = make_breaker(reset_timeout=60)
+    for _ in range(3):
+        breaker.failure("boom")
+    assert not breaker.allow()
+    assert not breaker.due_for_probe()
+    assert breaker.state == 'open'
+
+
+def test_probe_uses_the_registered_url_not_user_requests():
+    import asyncio
+
+    import httpx
+
+    from main import AsyncHttpClient, BreakerRegistry
+
+    registry = BreakerRegistry()
+    registry.register_probe("https://api.weather.test/health")
+    client = AsyncHttpClient(breakers=registry, transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+    asyncio.run(client.get("https://api.weather.test/data?q=Pune&appid=SECRET", upstream='openweather'))
+    asyncio.run(client.get("https://other.test/search?query=private", upstream='jiosaavn'))
+    assert registry.get('api.weather.test', 'openweather').probe_url == "https://api.weather.test/health"
+    assert registry.get('other.test', 'jiosaavn').probe_url is None
+
+
+def test_registering_after_the_breaker_exists():
+    from main import BreakerRegistry
+
+    registry = BreakerRegistry()
+    breaker = registry.get('late.test', 'yts')
+    registry.register_probe("https://late.test/ping")
+    assert breaker.probe_url == "https://late.test/ping"
+
+
+def test_bot_probe_urls_carry_no_secrets():
+    import main
+
+    urls = list(main.circuit_breakers._probe_urls.values())
+    assert urls
+    assert not any('appid' in url or 'api_key' in url or 'apikey' in url for url in urls)
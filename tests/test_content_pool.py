@@ -0,0 +1,43 @@
+import itertools
+
+from main import ContentPool
+
+
+def make_pool(tmp_path, texts, **kwargs) -> ContentPool:
+    source = iter(texts)
+    kwargs.setdefault('capacity', 3)
+    kwargs.setdefault('low_water', 1)
+    return ContentPool('joke', lambda: next(source, None), path=str(tmp_path / "joke_pool.json"), **kwargs)
+
+
+def test_refill_skips_duplicates_and_stops_when_full(tmp_path):
+    pool = make_pool(tmp_path, ["a", "a", "b", "c", "d"])
+    assert pool.refill() == 3
+    assert [pool.take() for _ in range(4)] == ["a", "b", "c", None]
+    assert (pool.duplicates, pool.served, pool.empty) == (1, 3, 1)
+
+
+def test_recently_served_texts_are_not_pooled_again(tmp_path):
+    pool = make_pool(tmp_path, itertools.cycle(["a", "b"]))
+    pool.refill()
+    assert pool.take() == "a"
+    # "a" was just served and "b" is still pooled, so the source is exhausted for now
+    assert pool.refill() == 0
+    assert pool.fetch_failures == 0
+
+
+def test_failed_fetch_ends_the_refill(tmp_path):
+    pool = make_pool(tmp_path, ["a"])
+    assert pool.refill() == 1
+    assert pool.fetch_failures == 1
+
+
+def test_pool_survives_a_restart(tmp_path):
+    pool = make_pool(tmp_path, ["a", "b"])
+    pool.refill()
+    pool.take()
+    pool.save()  # as stop() does
+
+    restarted = make_pool(tmp_path, [])
+    restarted.load()
+    assert (restarted.loaded, restarted.take()) == (1, "b")
@@ -0,0 +1,59 @@
+import threading
+
+from main import HedgedFetch
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, url: str, parsed: list):
+        self.url = url
+        self.parsed = parsed
+
+    def json(self):
+        self.parsed.append(self.url)
+        return {'text': self.url}
+
+    def close(self):
+        pass
+
+
+class FakeHttp:
+    """Answers every URL, the slow one only once it is let go"""
+
+    def __init__(self, slow_url: str):
+        self.slow_url = slow_url
+        self.release = threading.Event()
+        self.returned = threading.Event()
+        self.calls = []
+        self.parsed = []
+
+    def get(self, url, upstream=None, **kwargs):
+        self.calls.append((url, kwargs))
+        if url == self.slow_url:
+            self.release.wait(5)
+            self.returned.set()
+        return FakeResponse(url, self.parsed)
+
+
+def test_losers_stop_once_a_source_has_answered():
+    http = FakeHttp(slow_url="http://slow.test")
+    hedge = HedgedFetch('joke', lambda: ["http://slow.test", "http://fast.test"],
+                        parse=lambda data: data['text'], mode='race')
+    assert hedge.fetch(http) == "http://fast.test"
+
+    # The slow request was already running; it must not parse once it returns
+    http.release.set()
+    assert http.returned.wait(5)
+    hedge._executor.shutdown(wait=True)
+    assert http.parsed == ["http://fast.test"]
+    for url, kwargs in http.calls:
+        assert kwargs['retries'] == 0
+        assert kwargs['deadline'] is not None
+
+
+def test_sequential_keeps_the_clients_retries():
+    http = FakeHttp(slow_url=None)
+    hedge = HedgedFetch('joke', lambda: ["http://a.test"], parse=lambda data: data['text'], mode='sequential')
+    assert hedge.fetch(http) == "http://a.test"
+    assert http.calls == [("http://a.test", {})]
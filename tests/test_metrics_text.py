@@ -0,0 +1,32 @@
+from main import LatencyHistogram, MetricsText
+
+
+def test_counters_and_gauges_escape_label_values():
+    metrics = MetricsText()
+    metrics.counter("commands_total", "Handled commands", [({'command': 'song'}, 3), ({}, 5)])
+    metrics.gauge("queue_depth", "Queued updates", [({'name': 'a "b"\\c\nd'}, 1.5)])
+    assert metrics.render().splitlines() == [
+        "# HELP sparkbot_commands_total Handled commands",
+        "# TYPE sparkbot_commands_total counter",
+        'sparkbot_commands_total{command="song"} 3',
+        "sparkbot_commands_total 5",
+        "# HELP sparkbot_queue_depth Queued updates",
+        "# TYPE sparkbot_queue_depth gauge",
+        'sparkbot_queue_depth{name="a \\"b\\"\\\\c\\nd"} 1.5',
+    ]
+
+
+def test_histogram_buckets_are_cumulative_and_end_at_inf():
+    histogram = LatencyHistogram(buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(seconds)
+    metrics = MetricsText()
+    metrics.histogram("latency_seconds", "Latency", [({'upstream': 'omdb'}, histogram)])
+    lines = metrics.render().splitlines()
+    assert lines[2:] == [
+        'sparkbot_latency_seconds_bucket{upstream="omdb",le="0.1"} 1',
+        'sparkbot_latency_seconds_bucket{upstream="omdb",le="1.0"} 3',
+        'sparkbot_latency_seconds_bucket{upstream="omdb",le="+Inf"} 4',
+        'sparkbot_latency_seconds_sum{upstream="omdb"} 4.25',
+        'sparkbot_latency_seconds_count{upstream="omdb"} 4',
+    ]
@@ -0,0 +1,26 @@
+from main import bot
+
+
+def test_merge_movies_dedups_across_sources():
+    yts = [
+        bot._movie('YTS', title="Inception", year=2010, rating=8.8, imdb_code="tt1375666", torrents=[{'quality': '1080p'}]),
+        bot._movie('YTS', title="Inception: The Cobol Job", year=2010, imdb_code="tt5295894"),
+    ]
+    omdb = [
+        # Same film by IMDb id, adding a poster
+        bot._movie('OMDb', title="Inception", year="2010", poster="http://img/inception.jpg", imdb_code="tt1375666"),
+        # No id: matched by title and year
+        bot._movie('OMDb', title="Inception: The Cobol Job", year="2010"),
+    ]
+    tmdb = [bot._movie('TMDb', title="Inception", year="2010", summary="Dreams within dreams")]
+
+    merged = bot.merge_movies([yts, omdb, tmdb], "inception")
+    assert [movie['title'] for movie in merged] == ["Inception", "Inception: The Cobol Job"]
+    inception = merged[0]
+    assert inception['source'] == "YTS, OMDb, TMDb"
+    # Earlier sources win each field; later ones only fill gaps
+    assert inception['year'] == 2010
+    assert inception['poster'] == "http://img/inception.jpg"
+    assert inception['summary'] == "Dreams within dreams"
+    assert inception['torrents'] == [{'quality': '1080p'}]
+    assert merged[1]['source'] == "YTS, OMDb"
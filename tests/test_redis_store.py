@@ -0,0 +1,56 @@
+import pytest
+
+from main import RedisStateStore, RedisUserStore, open_state_backend
+from tools.fake_redis import FakeRedisServer
+
+
+@pytest.fixture
+def server():
+    server = FakeRedisServer().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def store(server):
+    store, _ = open_state_backend(server.url, None)
+    assert isinstance(store, RedisUserStore)
+    yield store
+    store.close()
+
+
+def test_preferences_leave_activity_counters_alone(store):
+    store.upsert(1, {'weather_city': "Paris", 'last_active': 10.0, 'total_requests': 4})
+    store.save_preferences(1, {'weather_city': "Oslo", 'language_preference': 'en', 'last_active': 20.0})
+    record = store.get(1)
+    assert (record['weather_city'], record['total_requests']) == ("Oslo", 4)
+    assert store.get(2) is None
+
+
+def test_activity_adds_up_and_last_active_only_moves_forward(store):
+    store.record_activity({1: (50.0, 2)})
+    # A worker flushing an older batch later must not move last_active back
+    store.record_activity({1: (40.0, 3)})
+    record = store.get(1)
+    assert (record['last_active'], record['total_requests']) == (50.0, 5)
+    assert store.count() == 1
+
+
+def test_idle_users_are_archived_and_restored_on_their_next_visit(store):
+    store.record_activity({1: (10.0, 1), 2: (100.0, 1)})
+    assert store.archive_idle(cutoff=50.0) == 1
+    assert (store.count(), store.count('users_archive')) == (1, 1)
+
+    record = store.get(1)
+    assert record['total_requests'] == 1
+    assert (store.count(), store.count('users_archive')) == (2, 0)
+
+
+def test_state_store_round_trip(server):
+    _, state = open_state_backend(server.url, None)
+    assert isinstance(state, RedisStateStore)
+    state.set("session:1", "{}", ttl=60)
+    assert state.get("session:1") == "{}"
+    state.delete("session:1")
+    assert state.get("session:1") is None
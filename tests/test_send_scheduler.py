@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+import telegram
+
+from main import SendScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = SendScheduler(workers=4, global_rate=1000, chat_rate=1000, group_rate=1000,
+                              chat_burst=1000, max_retries=2)
+    scheduler.start()
+    yield scheduler
+    scheduler.stop(timeout=2)
+
+
+def test_sends_inline_when_not_started():
+    scheduler = SendScheduler()
+    future = scheduler.submit(1, lambda text: text.upper(), "hi")
+    assert future.done()
+    assert future.result() == "HI"
+
+
+def test_keeps_order_within_a_chat(scheduler):
+    sent = []
+    futures = [scheduler.submit(7, sent.append, i) for i in range(30)]
+    for future in futures:
+        future.result(timeout=5)
+    assert sent == list(range(30))
+
+
+def test_retry_after_pauses_and_retries(scheduler):
+    sent = []
+    attempts = []
+
+    def flaky(text):
+        attempts.append(text)
+        if len(attempts) == 1:
+            raise telegram.error.RetryAfter(0.05)
+        sent.append(text)
+
+    first = scheduler.submit(7, flaky, "first")
+    second = scheduler.submit(7, sent.append, "second")
+    second.result(timeout=5)
+    assert first.done() and first.exception() is None
+    assert sent == ["first", "second"]
+    stats = scheduler.stats()
+    assert stats['retry_after_429'] == 1
+    assert stats['failed'] == 0
+
+
+def test_retry_after_gives_up_after_max_retries(scheduler):
+    def always_limited():
+        raise telegram.error.RetryAfter(0.01)
+
+    future = scheduler.submit(7, always_limited)
+    with pytest.raises(telegram.error.RetryAfter):
+        future.result(timeout=5)
+    assert scheduler.stats()['retry_after_429'] == 3
+    assert scheduler.failed == 1
+
+
+def test_failed_send_sets_exception(scheduler):
+    def rejected():
+        raise telegram.error.BadRequest("Can't parse entities")
+
+    future = scheduler.submit(7, rejected)
+    with pytest.raises(telegram.error.BadRequest):
+        future.result(timeout=5)
+    assert scheduler.failed == 1
+
+
+def test_chat_action_coalesced_behind_queued_message(scheduler):
+    release = threading.Event()
+    sent = []
+    blocking = scheduler.submit(7, release.wait, 5)
+    queued = scheduler.submit(7, sent.append, "message")
+    action = scheduler.submit(7, sent.append, "typing", chat_action=True)
+    assert action.done() and action.result() is None
+    release.set()
+    blocking.result(timeout=5)
+    queued.result(timeout=5)
+    assert sent == ["message"]
+    assert scheduler.stats()['coalesced_chat_actions'] == 1
@@ -0,0 +1,58 @@
+import json
+import threading
+
+from main import Tracer
+
+
+def make_tracer(tmp_path, **kwargs) -> Tracer:
+    kwargs.setdefault('threshold', 0.0)
+    kwargs.setdefault('sample_rate', 1.0)
+    return Tracer(path=str(tmp_path / "traces.jsonl"), enabled=True, **kwargs)
+
+
+def test_trace_finishes_when_its_last_holder_releases_it(tmp_path):
+    tracer = make_tracer(tmp_path)
+    trace = tracer.start('webhook', update_id=1)
+    trace.hold()  # e.g. a queued send
+    trace.add('dispatch', trace.started, 0.01)
+    trace.release()
+    assert tracer.stats()['in_progress'] == 1
+
+    trace.release()
+    # Spans after the finish are dropped
+    trace.add('late', trace.started, 0.01)
+    stats = tracer.stats()
+    assert (stats['finished'], stats['in_progress'], stats['written']) == (1, 0, 1)
+    with open(tracer.path, encoding='utf-8') as f:
+        written = json.loads(f.readline())
+    assert written['trace_id'] == trace.trace_id
+    assert [span['name'] for span in written['spans']] == ['dispatch']
+
+
+def test_only_slow_traces_are_written(tmp_path):
+    tracer = make_tracer(tmp_path, threshold=60.0)
+    tracer.start('webhook').release()
+    stats = tracer.stats()
+    assert (stats['finished'], stats['slow'], stats['written']) == (1, 0, 0)
+
+
+def test_counts_stay_exact_across_threads(tmp_path):
+    tracer = make_tracer(tmp_path, threshold=60.0)
+
+    def run():
+        for _ in range(500):
+            tracer.start('webhook').release()
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = tracer.stats()
+    assert (stats['started'], stats['finished'], stats['in_progress']) == (4000, 4000, 0)
+
+
+def test_disabled_tracer_starts_nothing(tmp_path):
+    tracer = Tracer(path=str(tmp_path / "traces.jsonl"), enabled=False)
+    assert tracer.start('webhook') is None
+    assert tracer.stats()['started'] == 0
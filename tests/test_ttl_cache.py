@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+
+from main import TTLCache
+
+
+def test_get_and_set_count_hits_and_misses():
+    cache = TTLCache(ttl=60, maxsize=10)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 0.5)
+
+
+def test_entries_expire():
+    cache = TTLCache(ttl=60, maxsize=10)
+    cache.set('a', 1, ttl=0)
+    assert cache.get('a', 'gone') == 'gone'
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(ttl=60, maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.evictions == 1
+
+
+def test_get_or_load_collapses_concurrent_misses():
+    cache = TTLCache(ttl=60, maxsize=10)
+    calls = []
+    started = threading.Event()
+
+    def loader():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('k', loader))) for _ in range(5)]
+    threads[0].start()
+    started.wait(1)
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['value'] * 5
+    assert len(calls) == 1
+    assert cache.stats()['collapsed_misses'] == 4
+
+
+def test_get_or_load_respects_cache_if():
+    cache = TTLCache(ttl=60, maxsize=10)
+    assert cache.get_or_load('k', lambda: [], cache_if=bool) == []
+    assert cache.get('k', 'missing') == 'missing'
+    assert cache.get_or_load('k', lambda: [1], cache_if=bool) == [1]
+    assert cache.get('k') == [1]
+
+
+def test_get_or_load_async_shares_one_load():
+    cache = TTLCache(ttl=60, maxsize=10)
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_load_async('k', loader) for _ in range(5)))
+
+    assert asyncio.run(run()) == ['value'] * 5
+    assert len(calls) == 1
+    assert cache.get('k') == 'value'
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from main import UpdateWorkerPool
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+
+    def make(handler, **kwargs) -> UpdateWorkerPool:
+        pool = UpdateWorkerPool(handler, **kwargs)
+        pool.start()
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.stop(timeout=5)
+
+
+def wait_processed(pool: UpdateWorkerPool, count: int):
+    deadline = time.monotonic() + 5
+    while pool.stats()['processed'] < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool.stats()['processed'] == count
+
+
+def test_updates_from_one_chat_run_in_order(make_pool):
+    events = []
+    lock = threading.Lock()
+
+    def handler(update):
+        chat, n = update
+        with lock:
+            events.append(('start', chat, n))
+        time.sleep(0.02 if n == 0 else 0)
+        with lock:
+            events.append(('end', chat, n))
+
+    pool = make_pool(handler, workers=4, max_queue=10)
+    for update in [('a', 0), ('a', 1), ('a', 2), ('b', 0)]:
+        assert pool.submit(update[0], update)
+    wait_processed(pool, 4)
+
+    chat_a = [event for event in events if event[1] == 'a']
+    assert chat_a == [(kind, 'a', n) for n in range(3) for kind in ('start', 'end')]
+    # Another chat runs next to it rather than behind it
+    assert events.index(('end', 'b', 0)) < events.index(('end', 'a', 0))
+
+
+def test_rejects_when_queue_is_full(make_pool):
+    release = threading.Event()
+    busy = threading.Event()
+
+    def handler(update):
+        busy.set()
+        release.wait(5)
+
+    pool = make_pool(handler, workers=1, max_queue=2)
+    assert pool.submit(1, object())
+    assert busy.wait(5)
+    assert pool.submit(1, object()) and pool.submit(2, object())
+    assert not pool.submit(3, object())
+    stats = pool.stats()
+    assert (stats['accepted'], stats['rejected'], stats['queue_depth']) == (3, 1, 2)
+    release.set()
+    wait_processed(pool, 3)
+
+
+def test_handler_errors_are_counted_and_do_not_stop_the_chat(make_pool):
+    handled = []
+
+    def handler(update):
+        if update == 'bad':
+            raise ValueError("boom")
+        handled.append(update)
+
+    pool = make_pool(handler, workers=2, max_queue=10)
+    for update in ['bad', 'good', 'bad']:
+        pool.submit(1, update)
+    wait_processed(pool, 3)
+    assert handled == ['good']
+    assert pool.stats()['failed'] == 2
+
+
+def test_stopped_pool_rejects_updates():
+    pool = UpdateWorkerPool(lambda update: None, workers=1, max_queue=1)
+    assert not pool.submit(1, object())
+    assert pool.stats()['rejected'] == 1
@@ -0,0 +1,31 @@
+import sqlite3
+
+import pytest
+
+from main import UserStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = UserStore(str(tmp_path / "users.db"))
+    yield store
+    store.close()
+
+
+def test_preferences_leave_activity_counters_alone(store):
+    store.upsert(1, {'weather_city': "Paris", 'last_active': 10.0, 'total_requests': 4})
+    store.save_preferences(1, {'weather_city': "Oslo", 'language_preference': 'en', 'last_active': 20.0})
+    record = store.get(1)
+    assert (record['weather_city'], record['total_requests']) == ("Oslo", 4)
+
+
+def test_failed_restore_from_archive_rolls_back(store):
+    store.upsert(1, {'weather_city': "Paris", 'last_active': 10.0, 'total_requests': 4})
+    assert store.archive_idle(cutoff=11.0) == 1
+
+    store._upsert_sql = "INSERT INTO missing_table VALUES (?, ?, ?, ?, ?, ?)"
+    with pytest.raises(sqlite3.OperationalError):
+        store.get(1)
+    # No transaction is left open and the archived row is still there
+    assert not store._conn.in_transaction
+    assert store.count('users_archive') == 1
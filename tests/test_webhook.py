@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import main
+
+
+def text_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"}
+        }
+    }
+
+
+@pytest.fixture
+def full_pool(monkeypatch):
+    """A started pool of capacity 2 whose only worker is stuck on a first update"""
+    release = threading.Event()
+    busy = threading.Event()
+
+    def handler(update):
+        busy.set()
+        release.wait(5)
+
+    pool = main.UpdateWorkerPool(handler, workers=1, max_queue=2)
+    pool.start()
+    pool.submit(1, object())
+    busy.wait(5)
+    assert pool.submit(1, object()) and pool.submit(1, object())
+    monkeypatch.setattr(main, 'update_pool', pool)
+    yield pool
+    release.set()
+    pool.stop(timeout=5)
+
+
+def post(payload: dict) -> httpx.Response:
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+            return await client.post("/webhook", json=payload)
+    return asyncio.run(run())
+
+
+def test_threaded_webhook_asks_for_retry_when_queue_full(full_pool, monkeypatch):
+    monkeypatch.setattr(main, 'async_core', None)
+    assert post(text_update(10, 7, "@help")).status_code == 503
+    assert full_pool.stats()['rejected'] == 1
+
+
+def test_async_webhook_reserves_a_slot_for_fallback_updates(full_pool, monkeypatch):
+    core = main.AsyncBotCore(main.bot, None, None, fallback=main.submit_to_dispatcher)
+    monkeypatch.setattr(main, 'async_core', core)
+    # @help is not an async route, so it would reach the full threaded queue after the 200
+    assert not core.handles(text_update(10, 7, "@help"))
+    assert post(text_update(10, 7, "@help")).status_code == 503
+    assert core.accepted == 0
+    assert full_pool.stats()['queue_reserved'] == 0
+
+
+def test_reserved_slot_survives_the_queue_filling_up():
+    release = threading.Event()
+    pool = main.UpdateWorkerPool(lambda update: release.wait(5), workers=1, max_queue=1)
+    pool.start()
+    try:
+        assert pool.reserve()
+        # The reservation counts against capacity
+        assert not pool.submit(2, object())
+        assert pool.submit(2, object(), reserved=True)
+        assert pool.stats()['queue_reserved'] == 0
+    finally:
+        release.set()
+        pool.stop(timeout=5)
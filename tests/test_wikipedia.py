@@ -0,0 +1,23 @@
+from main import bot, render_wikipedia_results
+
+
+def test_parse_wikipedia_keeps_search_order_and_pages_without_extract():
+    data = {'query': {'pages': [
+        {'pageid': 1, 'ns': 0, 'title': "Pythonidae", 'index': 3, 'extract': "Snakes."},
+        {'pageid': 7, 'ns': 0, 'title': "Python [disambiguation]", 'index': 2},
+        {'pageid': 2, 'ns': 0, 'title': "Python (programming language)", 'index': 1,
+         'extract': "Python is a high-level programming language. "},
+        {'ns': 0, 'title': "Missing page", 'missing': True},
+    ]}}
+    pages = bot.parse_wikipedia(data)
+    assert pages == [
+        {'title': "Python (programming language)", 'pageid': 2, 'extract': "Python is a high-level programming language."},
+        {'title': "Python [disambiguation]", 'pageid': 7, 'extract': ""},
+        {'title': "Pythonidae", 'pageid': 1, 'extract': "Snakes."},
+    ]
+    # A page with no extract still renders as a link
+    assert "[Python (disambiguation)](https://en.wikipedia.org/?curid=7)" in render_wikipedia_results(pages)
+
+
+def test_parse_wikipedia_without_hits():
+    assert bot.parse_wikipedia({'batchcomplete': True}) == []
@@ -0,0 +1,43 @@
+import threading
+
+from main import WriteBehindBuffer
+
+
+def test_stop_flushes_everything_still_pending():
+    batches = []
+    buffer = WriteBehindBuffer(lambda batch: batches.append(set(batch)), interval=3600, max_batch=100)
+    buffer.start()
+    for user_id in (1, 2, 2, 3):
+        buffer.mark(user_id)
+    buffer.stop()
+    assert batches == [{1, 2, 3}]
+    assert buffer.stats()['pending'] == 0
+
+
+def test_full_batch_wakes_the_flusher():
+    flushed = threading.Event()
+    buffer = WriteBehindBuffer(lambda batch: flushed.set(), interval=3600, max_batch=2)
+    buffer.start()
+    try:
+        buffer.mark(1)
+        buffer.mark(2)
+        assert flushed.wait(5)
+    finally:
+        buffer.stop()
+
+
+def test_failed_flush_keeps_the_batch_for_the_next_one():
+    attempts = []
+
+    def flaky(batch):
+        attempts.append(set(batch))
+        if len(attempts) == 1:
+            raise OSError("disk full")
+
+    buffer = WriteBehindBuffer(flaky, interval=3600)
+    buffer.mark(1)
+    assert buffer.flush() == 0
+    buffer.mark(2)
+    assert buffer.flush() == 2
+    assert attempts == [{1}, {1, 2}]
+    assert buffer.stats()['flush_errors'] == 1
@@ -0,0 +1,221 @@
+"""In-process stand-in for a Redis server, for trying STATE_BACKEND_URL=redis://.
+
+Implements only the commands the bot's state backend sends (strings with
+expiry, hashes, sorted sets) over the RESP2 protocol. EVAL cannot run Lua;
+it runs Python twins of the bot's own scripts, recognised by their leading
+"-- sparkbot:<name>" line. Data lives in memory and is lost when the
+process exits.
+
+Usage: python tools/fake_redis.py [port]    then
+       STATE_BACKEND_URL=redis://127.0.0.1:<port>/0 uvicorn main:app --workers 4
+"""
+
+import socketserver
+import sys
+import threading
+import time
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}      # key -> value (str, dict for hashes, dict member->score for zsets)
+        self.expires = {}   # key -> deadline
+        self.lock = threading.Lock()
+
+    def _live(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def execute(self, name, *args):
+        handler = getattr(self, "cmd_" + name.lower(), None)
+        if handler is None:
+            return Exception(f"ERR unknown command '{name}'")
+        with self.lock:
+            return handler(*args)
+
+    def cmd_ping(self, *args):
+        return "PONG"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_auth(self, password):
+        return "OK"
+
+    def cmd_flushdb(self):
+        self.data.clear()
+        self.expires.clear()
+        return "OK"
+
+    def cmd_get(self, key):
+        return self._live(key)
+
+    def cmd_set(self, key, value, *options):
+        self.data[key] = value
+        self.expires.pop(key, None)
+        for option, amount in zip(options[::2], options[1::2]):
+            option = option.upper()
+            if option == "EX":
+                self.expires[key] = time.time() + int(amount)
+            elif option == "PX":
+                self.expires[key] = time.time() + int(amount) / 1000
+        return "OK"
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._live(key) is not None:
+                removed += 1
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return removed
+
+    def cmd_rename(self, key, new_key):
+        if self._live(key) is None:
+            return Exception("ERR no such key")
+        self.data[new_key] = self.data.pop(key)
+        self.expires.pop(new_key, None)
+        if key in self.expires:
+            self.expires[new_key] = self.expires.pop(key)
+        return "OK"
+
+    def cmd_hset(self, key, *pairs):
+        table = self.data.setdefault(key, {})
+        added = sum(1 for field in pairs[::2] if field not in table)
+        table.update(zip(pairs[::2], pairs[1::2]))
+        return added
+
+    def cmd_hdel(self, key, *fields):
+        table = self._live(key) or {}
+        removed = sum(1 for field in fields if table.pop(field, None) is not None)
+        if key in self.data and not table:
+            del self.data[key]
+        return removed
+
+    def cmd_hmget(self, key, *fields):
+        table = self._live(key) or {}
+        return [table.get(field) for field in fields]
+
+    def cmd_hincrby(self, key, field, amount):
+        table = self.data.setdefault(key, {})
+        table[field] = str(int(table.get(field, 0)) + int(amount))
+        return int(table[field])
+
+    def cmd_zadd(self, key, *pairs):
+        scores = self.data.setdefault(key, {})
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in scores
+            scores[member] = float(score)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        scores = self._live(key) or {}
+        return sum(1 for member in members if scores.pop(member, None) is not None)
+
+    def cmd_zcard(self, key):
+        return len(self._live(key) or {})
+
+    def cmd_zscore(self, key, member):
+        score = (self._live(key) or {}).get(member)
+        return None if score is None else repr(score)
+
+    def cmd_eval(self, script, numkeys, *args):
+        name = script.split("\n", 1)[0].replace("-- sparkbot:", "", 1).strip()
+        handler = getattr(self, "script_" + name, None)
+        if handler is None:
+            return Exception("ERR fake redis only runs the bot's own scripts")
+        numkeys = int(numkeys)
+        return handler(args[:numkeys], args[numkeys:])
+
+    def script_record_activity(self, keys, argv):
+        user_key, index = keys
+        last_active, delta, user_id = argv
+        self.cmd_hincrby(user_key, "total_requests", delta)
+        if float(last_active) > float(self.data[user_key].get("last_active") or 0):
+            self.cmd_hset(user_key, "last_active", last_active)
+            self.cmd_zadd(index, last_active, user_id)
+        return 1
+
+    def script_archive_user(self, keys, argv):
+        user_key, archive_key, index, archive_index = keys
+        user_id, cutoff = argv
+        score = (self._live(index) or {}).get(user_id)
+        if score is None or score >= float(cutoff):
+            return 0
+        if self._live(user_key) is not None:
+            self.cmd_rename(user_key, archive_key)
+        self.cmd_zrem(index, user_id)
+        self.cmd_zadd(archive_index, cutoff, user_id)
+        return 1
+
+    def cmd_zrangebyscore(self, key, low, high):
+        def bound(text, default):
+            exclusive = text.startswith("(")
+            text = text.lstrip("(")
+            value = default if text in ("-inf", "+inf", "inf") else float(text)
+            return value, exclusive
+        (low, low_open), (high, high_open) = bound(low, float("-inf")), bound(high, float("inf"))
+        scores = self._live(key) or {}
+        members = [
+            (score, member) for member, score in scores.items()
+            if (score > low if low_open else score >= low) and (score < high if high_open else score <= high)
+        ]
+        return [member for _, member in sorted(members)]
+
+
+def encode(reply) -> bytes:
+    if isinstance(reply, Exception):
+        return b"-" + str(reply).encode() + b"\r\n"
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool) or isinstance(reply, int):
+        return b":%d\r\n" % int(reply)
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
+    if reply in ("OK", "PONG"):
+        return b"+" + reply.encode() + b"\r\n"
+    data = str(reply).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.startswith(b"*"):
+                continue
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+            self.wfile.write(encode(self.server.store.execute(*args)))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        super().__init__(address, RespHandler)
+        self.store = FakeRedis()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def start(self) -> "FakeRedisServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+if __name__ == "__main__":
+    server = FakeRedisServer(("127.0.0.1", int(sys.argv[1]) if len(sys.argv) > 1 else 6379))
+    print(f"Fake Redis listening on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,94 @@
+"""Summarize the slow update traces the bot writes to TRACE_FILE.
+
+Prints the slowest traces span by span, then where the time went across
+all of them: per command, and per span name (how often it appears, its
+median and worst duration, and its share of the summed trace time). Spans
+nest (dispatch contains the http.* and telegram.* calls made by the
+handler), so the shares do not add up to 100%.
+
+Usage: python tools/trace_report.py [slow_traces.jsonl] [top] [command]
+"""
+
+import json
+import sys
+import time
+
+
+def load(path: str, command: str = None) -> list:
+    traces = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                trace = json.loads(line)
+            except ValueError:
+                print(f"skipping malformed line {number}", file=sys.stderr)
+                continue
+            if command and trace.get("attrs", {}).get("command") != command:
+                continue
+            traces.append(trace)
+    return traces
+
+
+def label(trace: dict) -> str:
+    attrs = trace.get("attrs", {})
+    return attrs.get("command") or attrs.get("update_type") or trace.get("kind", "?")
+
+
+def median(values: list) -> float:
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0.0
+
+
+def print_trace(trace: dict):
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(trace.get("started_at", 0)))
+    dropped = f", {trace['dropped_spans']} spans dropped" if trace.get("dropped_spans") else ""
+    print(f"{trace['trace_id']}  {trace['duration']:.3f}s  {label(trace)}  {started} UTC{dropped}")
+    for span in trace.get("spans", []):
+        extra = " ".join(f"{key}={value}" for key, value in span.items() if key not in ("name", "start", "duration"))
+        print(f"    +{span['start']:>8.3f}s {span['duration']:>8.3f}s  {span['name']:<28} {extra}".rstrip())
+    print()
+
+
+def print_commands(traces: list):
+    by_command = {}
+    for trace in traces:
+        by_command.setdefault(label(trace), []).append(trace["duration"])
+    print(f"{'command':<20} {'traces':>7} {'p50':>9} {'max':>9}")
+    for name, durations in sorted(by_command.items(), key=lambda item: -sum(item[1])):
+        print(f"{name:<20} {len(durations):>7} {median(durations):>8.3f}s {max(durations):>8.3f}s")
+    print()
+
+
+def print_spans(traces: list):
+    total = sum(trace["duration"] for trace in traces) or 1.0
+    by_name = {}
+    for trace in traces:
+        for span in trace.get("spans", []):
+            by_name.setdefault(span["name"], []).append(span["duration"])
+    print(f"{'span':<28} {'count':>7} {'p50':>9} {'max':>9} {'share':>7}")
+    for name, durations in sorted(by_name.items(), key=lambda item: -sum(item[1])):
+        share = sum(durations) / total * 100
+        print(f"{name:<28} {len(durations):>7} {median(durations):>8.3f}s {max(durations):>8.3f}s {share:>6.1f}%")
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "slow_traces.jsonl"
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    command = sys.argv[3] if len(sys.argv) > 3 else None
+    traces = load(path, command)
+    if not traces:
+        print(f"No traces in {path}" + (f" for {command}" if command else ""))
+        return
+
+    traces.sort(key=lambda trace: trace["duration"], reverse=True)
+    print(f"{len(traces)} slow traces, worst {min(top, len(traces))}:\n")
+    for trace in traces[:top]:
+        print_trace(trace)
+    print_commands(traces)
+    print_spans(traces)
+
+
+if __name__ == "__main__":
+    main()